@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# This python script benchmarks promote.py end to end against synthetic
+# deployment repositories.
+#
+# For every combination of the requested dimensions, it generates a deployment
+# repository with the given number of overlays (nested the given number of
+# directories deep below a shared base), each declaring the given number of
+# images and helm charts, where every chart carries a valuesInline block of
+# the given number of keys. It then promotes every image and chart to every
+# overlay, half of the images directly and the other half (and all charts)
+# from a source overlay, and reports:
+#
+# - The wall time of `promote.main`, run exactly as the action runs it.
+# - The wall time of each phase (load_input, validate, plan, apply, ...) of a
+#   run of `promote.main`, as recorded in `promote.metrics`.
+# - The peak memory allocated by Python during a run, and the peak RSS of the
+#   benchmark process.
+# - The YAML implementation in use, libyaml or python.
+#
+# Every run uses a freshly generated repository and an empty kustomization
+# cache, and the median of the repeated runs is reported as one JSON object
+# per line on stdout.
+#
+# Example Usage:
+#   python benchmark.py --overlays 10,100,1000 --images 10 --charts 2 --values-size 1000
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import promote
+
+from typing import Callable
+
+
+def generate_deployment_repo(
+    root: str,
+    overlays: int,
+    images: int,
+    charts: int,
+    values_size: int = 10,
+    depth: int = 2,
+) -> list[str]:
+    """
+    Generate a synthetic deployment repository.
+
+    Args:
+        root (str): The directory to generate the repository in.
+        overlays (int): The number of target overlays to generate.
+        images (int): The number of images declared by each overlay.
+        charts (int): The number of helm charts declared by each overlay.
+        values_size (int): The number of keys in the valuesInline of each chart.
+        depth (int): The number of directories between the root and each overlay.
+
+    Returns:
+        list: The target overlays, relative to the root. A `source` overlay is
+        generated as well, declaring newer versions of every image and chart.
+    """
+    write_kustomization(os.path.join(root, "base"), "", [], [], 0)
+    targets = []
+    for i in range(overlays):
+        groups = [f"group-{(i // 10**level) % 10}" for level in range(depth - 1, 0, -1)]
+        overlay = os.path.join(*groups, f"overlay-{i}")
+        write_kustomization(
+            os.path.join(root, overlay),
+            "../" * depth + "base",
+            [(f"image-{j}", "1.0.0") for j in range(images)],
+            [(f"chart-{j}", "1.0.0") for j in range(charts)],
+            values_size,
+        )
+        targets.append(overlay)
+    write_kustomization(
+        os.path.join(root, "source"),
+        "../base",
+        [(f"image-{j}", "2.0.0") for j in range(images)],
+        [(f"chart-{j}", "2.0.0") for j in range(charts)],
+        values_size,
+    )
+
+    return targets
+
+
+def write_kustomization(
+    directory: str,
+    base: str,
+    images: list[tuple[str, str]],
+    charts: list[tuple[str, str]],
+    values_size: int,
+) -> None:
+    lines = [
+        "apiVersion: kustomize.config.k8s.io/v1beta1",
+        "kind: Kustomization",
+    ]
+    if base:
+        lines += ["resources:", f"- {base}"]
+    if images:
+        lines.append("images:")
+    for name, tag in images:
+        lines += [
+            f"- name: {name}",
+            f"  newName: registry.example.com/{name}",
+            f"  newTag: {tag}",
+        ]
+    if charts:
+        lines.append("helmCharts:")
+    for name, version in charts:
+        lines += [
+            f"- name: {name}",
+            "  repo: https://charts.example.com",
+            f"  version: {version}",
+            f"  releaseName: {name}",
+            "  valuesInline:",
+        ]
+        for k in range(values_size):
+            lines += [f"    key-{k}:", "      enabled: true", f"      replicas: {k}"]
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "kustomization.yaml"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def promotion_inputs(targets: list[str], images: int, charts: int) -> dict[str, str]:
+    """
+    Build the promotion inputs that promote every image and chart to every target.
+
+    Args:
+        targets (list): The target overlays.
+        images (int): The number of images declared by each overlay.
+        charts (int): The number of helm charts declared by each overlay.
+
+    Returns:
+        dict: The IMAGES_TO_UPDATE and CHARTS_TO_UPDATE environment variables.
+    """
+    images_to_update = []
+    for j in range(images):
+        image: dict = {"name": f"image-{j}", "overlays": targets}
+        if j % 2:
+            image["fromOverlay"] = "source"
+        else:
+            image["newTag"] = "3.0.0"
+        images_to_update.append(image)
+    charts_to_update = [
+        {"name": f"chart-{j}", "fromOverlay": "source", "overlays": targets}
+        for j in range(charts)
+    ]
+
+    return {
+        "IMAGES_TO_UPDATE": json.dumps(images_to_update),
+        "CHARTS_TO_UPDATE": json.dumps(charts_to_update),
+    }
+
+
+@contextlib.contextmanager
+def environment(variables: dict[str, str]):
+    saved = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run_main() -> None:
+    # promote.main prints the manifest and always exits
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            promote.main()
+        except SystemExit as e:
+            if e.code:
+                raise RuntimeError(f"promote.main exited with {e.code}")
+
+
+def run_phases() -> dict[str, float]:
+    # promote.main records the time spent in each of its phases
+    run_main()
+    return {
+        phase: recorded["seconds"]
+        for phase, recorded in promote.metrics.to_dict()["phases"].items()
+    }
+
+
+def measure(dimensions: dict, repeat: int, variables: dict[str, str]) -> dict:
+    """
+    Benchmark promote.py against freshly generated repositories of the given dimensions.
+
+    Args:
+        dimensions (dict): The overlays, images, charts, values_size and depth
+            of the generated repositories.
+        repeat (int): The number of times to run each measurement.
+        variables (dict): Additional environment variables for promote.py.
+
+    Returns:
+        dict: The dimensions, the median wall time of `promote.main` and of
+        each phase in seconds, the peak memory in MiB and the YAML implementation.
+    """
+
+    def fresh_run(function: Callable):
+        with tempfile.TemporaryDirectory() as root:
+            targets = generate_deployment_repo(root, **dimensions)
+            inputs = promotion_inputs(
+                targets, dimensions["images"], dimensions["charts"]
+            )
+            promote.kustomization_cache.clear()
+            with environment({**variables, **inputs, "DEPLOYMENT_DIR": root}):
+                start = time.perf_counter()
+                result = function()
+                return time.perf_counter() - start, result
+
+    runs = [fresh_run(run_phases) for _ in range(repeat)]
+    main_timings = [seconds for seconds, _ in runs]
+    phase_timings = [phases for _, phases in runs]
+
+    tracemalloc.start()
+    fresh_run(run_main)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        max_rss //= 1024
+
+    return {
+        **dimensions,
+        "main": statistics.median(main_timings),
+        "phases": {
+            phase: statistics.median(timings[phase] for timings in phase_timings)
+            for phase in phase_timings[0]
+        },
+        "peakMemoryMiB": peak / 2**20,
+        "maxRssMiB": max_rss / 1024,
+        "yaml": promote.yaml_implementation(),
+    }
+
+
+def integers(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--overlays", type=integers, default=[10, 100])
+    parser.add_argument("--images", type=integers, default=[10])
+    parser.add_argument("--charts", type=integers, default=[2])
+    parser.add_argument("--values-size", type=integers, default=[100])
+    parser.add_argument("--depth", type=integers, default=[2])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backend", choices=promote.IMAGE_BACKENDS, default="native")
+    parser.add_argument("--max-workers", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    # Logging every overlay would dominate the timings
+    promote.logger.setLevel(logging.WARNING)
+
+    variables = {
+        "PROMOTE_IMAGE_BACKEND": args.backend,
+        "PROMOTE_MAX_WORKERS": str(args.max_workers),
+    }
+    for overlays in args.overlays:
+        for images in args.images:
+            for charts in args.charts:
+                for values_size in args.values_size:
+                    for depth in args.depth:
+                        dimensions = {
+                            "overlays": overlays,
+                            "images": images,
+                            "charts": charts,
+                            "values_size": values_size,
+                            "depth": depth,
+                        }
+                        result = measure(dimensions, args.repeat, variables)
+                        print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,8 @@ function wait_for_result_not_found {
   local -i attempt=0
   while [[ "${attempt}" -lt "${attempts}" ]]; do
     set +e
-    if ! output="$(${command} 2>&1)"; then
+    # shellcheck disable=SC2086
+    if ! output="$(trace_run "${command}" ${command} 2>&1)"; then
       if [[ "${fail_on_nonzero}" == "true" ]]; then
         echo "${output}"
         echo "Command failed. Exiting."
@@ -38,6 +39,12 @@ function wait_for_result_not_found {
   exit 1
 }
 
+# Stage the files listed in PROMOTE_CHANGED_FILES by promote.py, rather than
+# everything in the deployment repository
+function git_add_changed_files {
+  git --literal-pathspecs add --pathspec-from-file="${PROMOTE_CHANGED_FILES}"
+}
+
 function git_commit_with_metadata {
   # Default the title if no provided
   if [[ -z "${PR_TITLE:-}" ]]; then
@@ -83,42 +90,45 @@ if [[ "${DEBUG}" == "true" ]]; then
   env
 fi
 
+# shellcheck source=src/trace.sh
+source /trace.sh
+
 if [[ "${PROMOTION_METHOD}" == "pull_request" ]]; then
   if [[ "${AGGREGATE_PR_CHANGES}" == "true" ]]; then
     BRANCH_REGEX=$(echo "promotion/${GITHUB_REPOSITORY:?}/${TARGET_BRANCH:?}/${OVERLAY_NAMES_NO_SLASH:?}/${PR_UNIQUE_KEY:?}"|tr "/" "-")
     HEAD_REF_NAME=$(gh pr list --json headRefName | jq -rc '.[].headRefName')
     if [[ "${HEAD_REF_NAME}" =~ .*${BRANCH_REGEX}.* ]]; then
       BRANCH=$(gh pr list --json headRefName | jq -rc '.[].headRefName' | grep "${BRANCH_REGEX}")
-      git stash
-      git checkout -B "${BRANCH}"
-      git rebase "${TARGET_BRANCH}"
-      git stash apply
+      trace_run "git stash" git stash
+      trace_run "git checkout" git checkout -B "${BRANCH}"
+      trace_run "git rebase" git rebase "${TARGET_BRANCH}"
+      trace_run "git stash apply" git stash apply
     else
       BRANCH=$(echo "promotion/${GITHUB_REPOSITORY:?}/${TARGET_BRANCH:?}/${OVERLAY_NAMES_NO_SLASH:?}/${PR_UNIQUE_KEY:?}/${GITHUB_SHA:?}" | tr "/" "-")
-      git checkout -B "${BRANCH}"
+      trace_run "git checkout" git checkout -B "${BRANCH}"
     fi
   else
     BRANCH="$(echo "promotion/${GITHUB_REPOSITORY:?}/${TARGET_BRANCH:?}/${OVERLAY_NAMES_NO_SLASH:?}/${PR_UNIQUE_KEY:?}/${GITHUB_SHA:?}" | tr "/" "-")"
-    git checkout -B "${BRANCH}"
+    trace_run "git checkout" git checkout -B "${BRANCH}"
   fi
 
-  git add .
-  git_commit_with_metadata
-  git show
+  trace_run "git add" git_add_changed_files
+  trace_run "git commit" git_commit_with_metadata
+  trace_run "git show" git show
 
   if [[ "${DRY_RUN}" == "true" ]]; then
     echo "Dry run is enabled. Not pushing changes."
     exit 0
   fi
 
-  git push origin "${BRANCH}" -f
+  trace_run "git push" git push origin "${BRANCH}" -f
   set +e
   PR="$(gh pr view 2>&1)"
   set -e
   # We're just looking for the sub-string here, not a regex
   # shellcheck disable=SC2076
   if [[ "${PR}" =~ "no pull requests found" ]]; then
-    gh pr create --fill
+    trace_run "gh pr create" gh pr create --fill
   else
     echo "PR Already exists:"
     gh pr view
@@ -136,7 +146,7 @@ if [[ "${PROMOTION_METHOD}" == "pull_request" ]]; then
 
   echo
   echo "Waiting for status checks to complete..."
-  wait_for_result_not_found "reported\|Waiting\|pending" "gh pr checks" "${STATUS_ATTEMPTS}" "${STATUS_INTERVAL}" "false"
+  trace_run "wait for status checks" wait_for_result_not_found "reported\|Waiting\|pending" "gh pr checks" "${STATUS_ATTEMPTS}" "${STATUS_INTERVAL}" "false"
 
   echo
   if [[ "${AUTO_MERGE}" == "true" ]]; then
@@ -144,7 +154,7 @@ if [[ "${PROMOTION_METHOD}" == "pull_request" ]]; then
     # Ref: https://github.com/cli/cli/issues/8092
     for i in {1..3}; do
       echo "Status checks have all passed. Merging PR..."
-      if gh pr merge --squash --admin --delete-branch; then
+      if trace_run "gh pr merge" gh pr merge --squash --admin --delete-branch; then
         break
       fi
       if [[ $i -eq 3 ]]; then
@@ -164,16 +174,16 @@ if [[ "${PROMOTION_METHOD}" == "pull_request" ]]; then
   PULL_REQUEST_URL="$(gh pr view --json url -q '.url')"
   
 elif [[ "${PROMOTION_METHOD}" == "push" ]]; then
-  git add .
-  git_commit_with_metadata
-  git show
+  trace_run "git add" git_add_changed_files
+  trace_run "git commit" git_commit_with_metadata
+  trace_run "git show" git show
 
   if [[ "${DRY_RUN}" == "true" ]]; then
     echo "Dry run is enabled. Not pushing changes."
     exit 0
   fi
 
-  git push origin "${TARGET_BRANCH}"
+  trace_run "git push" git push origin "${TARGET_BRANCH}"
   echo
   # If we have both images and charts, the output should reflect that.
   if [[ "${IMAGES}" != "[]" && "${CHARTS}" != "[]" ]]; then
@@ -17,6 +17,15 @@ if [[ "${DEBUG}" == "true" ]]; then
 
   env
 fi
+
+# Record a Chrome trace of the run if TRACE_FILE is set
+if [[ -n "${TRACE_FILE:-}" ]]; then
+  PROMOTE_TRACE_FILE="${GITHUB_WORKSPACE}/${TRACE_FILE}"
+  export PROMOTE_TRACE_FILE
+fi
+# shellcheck source=src/trace.sh
+source /trace.sh
+
 # Sets images-updated early so that it is always set, even if promote fails
 echo "images-updated=[]" >> "${GITHUB_OUTPUT}"
 
@@ -39,7 +48,7 @@ echo "GITHUB_WORKFLOW_RUN_URL=${GITHUB_WORKFLOW_RUN_URL}" >> "${GITHUB_ENV}"
 #   - KUSTOMIZE_CHECKSUM
 #   - KUSTOMIZE_BIN_DIR
 #   - KUSTOMIZE_FILENAME
-/download-and-checksum.sh
+trace_run "download-and-checksum.sh" /download-and-checksum.sh
 PATH="${KUSTOMIZE_BIN_DIR}:${PATH}"
 
 git config --global user.name "${GIT_COMMIT_USER}"
@@ -52,14 +61,21 @@ git config --global user.email "${GIT_COMMIT_EMAIL}"
 DEPLOYMENT_DIR="${GITHUB_WORKSPACE}/${DEPLOYMENT_DIR}"
 export DEPLOYMENT_DIR
 
+# promote.py lists the kustomization files it may have changed, relative to
+# DEPLOYMENT_DIR, so that only those are checked and committed. The list is kept
+# out of the workspace, so that it cannot end up in the commit itself.
+PROMOTE_CHANGED_FILES="$(mktemp)"
+export PROMOTE_CHANGED_FILES
+
 # If IMAGES is not an empty string or empty array, then we need to promote the images
 if [[ "${IMAGES}" != "[]" || "${CHARTS}" != "[]" ]]; then
-  IMAGES_TO_UPDATE="${IMAGES}" CHARTS_TO_UPDATE="${CHARTS}" poetry run python /promote.py > manifest.json
+  IMAGES_TO_UPDATE="${IMAGES}" CHARTS_TO_UPDATE="${CHARTS}" trace_run "promote.py" poetry run python /promote.py > manifest.json
 else
   echo "No images or charts to promote"
   echo "{}" > manifest.json
 fi
 
+trace_begin "outputs"
 MANIFEST_JSON="$(jq -c -r '.' manifest.json)"
 export MANIFEST_JSON
 
@@ -97,6 +113,7 @@ jq -c -r '[.[] | .charts | map(.name)] | unique | sort | flatten | join(", ")' <
 echo "charts=$(cat charts.txt)" >> "${GITHUB_OUTPUT}"
 CHARTS_NAMES="$(cat charts.txt)"
 export CHARTS_NAMES
+trace_end "outputs"
 
 # Because the parent workflow is the one who has run the `checkout` action,
 # we need to tell configure git to consider that directory as "safe" in order
@@ -104,8 +121,11 @@ export CHARTS_NAMES
 # "dubious ownership" error.
 git config --global --add safe.directory "${DEPLOYMENT_DIR}"
 pushd "${DEPLOYMENT_DIR}" || exit 1
-# If there are no changes, then we don't need to do anything
-if [[ -z "$(git status --porcelain)" ]]; then
+# If there are no changes to the promoted files, then we don't need to do anything.
+# Only the promoted files are checked, rather than the whole repository, and
+# git is not run at all if promote.py found that nothing needed to change.
+mapfile -t CHANGED_FILES < "${PROMOTE_CHANGED_FILES}"
+if [[ "${#CHANGED_FILES[@]}" -eq 0 || -z "$(trace_run "git status" git --literal-pathspecs status --porcelain --untracked-files=no -- "${CHANGED_FILES[@]}")" ]]; then
   echo "No changes to commit"
 # Otherwise, we need to commit the changes with the relevant metadata
 # in the commit message.
@@ -23,6 +23,8 @@
 #   # If from is specified, the image will be updated using the values found for
 #   # the image with the specified name in the fromOverlay.
 #   "fromOverlay": "overlay-name",
+#   # Optionally, read the fromOverlay as it was at a git revision (e.g. a tag).
+#   "fromRef": "git-revision",
 #   "overlays": ["TARGET_DIR", "TARGET_DIR2"]
 # }
 #
@@ -34,6 +36,8 @@
 #     "version": "new-chart-version",
 #     # ... or fromOverlay is required
 #     "fromOverlay": "overlay-name",
+#     # Optionally, read the fromOverlay as it was at a git revision
+#     "fromRef": "git-revision",
 #     # Optionally, update the release name
 #     "releaseName": "new-release-name",
 #     "overlays": ["target-env", "target-env2"]
@@ -47,27 +51,1457 @@
 # will be batched together and run once per overlay, so that the kustomize edit set image
 # command is only run once per overlay. This prevents an overlay from ending in a half-updated
 # state if the script fails partway through.
+#
+# Run as `promote.py serve`, the script instead stays up as a daemon that keeps the
+# deployment directory parsed in memory and applies promotions submitted over HTTP (on
+# PROMOTE_SERVE_ADDRESS) or a Unix socket (on PROMOTE_SERVE_SOCKET) one after another.
+#
+# If PROMOTE_GIT_DIR is set, the promotion is instead committed straight to a branch of
+# that (possibly bare) git repository, without checking it out.
+#
+# Run as `promote.py find <name>`, the script prints the overlays that reference the
+# image or chart with that name, from an index of the deployment directory that is
+# persisted to PROMOTE_INDEX_FILE, if set, and refreshed incrementally.
+import contextlib
+import functools
+import hashlib
+import http.server
 import json
 import logging
 import os
+import posixpath
+import queue
+import re
+import signal
+import socketserver
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 import yaml
 
-from typing import Callable, Iterator, Union, Optional  # noqa: F401
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Sequence,
+    cast,
+)
 
 # Initialize logger
 logger = logging.getLogger()
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.DEBUG)
 
+# Parse and emit YAML with libyaml's C implementation when PyYAML was built
+# with it, and with PyYAML's pure-Python implementation otherwise
+try:
+    from yaml import CSafeDumper as YamlDumper, CSafeLoader as YamlLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper as YamlDumper, SafeLoader as YamlLoader  # type: ignore[assignment]
+
+
+class PromotionError(Exception):
+    """
+    Raised when a promotion cannot be planned or applied.
+
+    The command line entrypoints log the error and exit with a failure, while
+    the daemon and other callers of `Promoter` can handle it and carry on.
+    """
+
+    def to_dict(self) -> dict:
+        """
+        Return the error as a JSON-serializable dictionary.
+        """
+        return {"type": type(self).__name__, "message": str(self)}
+
+
+class ValidationError(PromotionError):
+    """
+    Raised when the promotion input or the configuration is invalid.
+
+    Invalid images and charts carry every problem found in them as `errors`,
+    as returned by `validate_promotions`.
+    """
+
+    def __init__(self, message: str, errors: Optional[list[dict]] = None) -> None:
+        super().__init__(message)
+        self.errors = errors or []
+
+    def to_dict(self) -> dict:
+        error = super().to_dict()
+        if self.errors:
+            error["errors"] = self.errors
+        return error
+
+
+class OverlayNotFoundError(PromotionError):
+    """
+    Raised when an overlay or its kustomization file does not exist.
+    """
+
+
+class KustomizationError(PromotionError):
+    """
+    Raised when a kustomization file is invalid or cannot be updated.
+    """
+
+
+class ChartNotFoundError(KustomizationError):
+    """
+    Raised when a promoted chart is not declared in an overlay.
+    """
+
+
+class CommandError(PromotionError):
+    """
+    Raised when a command the promotion depends on is unavailable or fails.
+    """
+
+
+class Metrics:
+    """
+    Records the wall time of the phases of a run and counters of the work done.
+
+    Phases are timed with the `phase` context manager. The total time and
+    number of times each phase ran are aggregated, and every run of a phase
+    with labels (e.g. the overlay being applied or the command being run) is
+    also recorded as a span, so slow overlays and subprocesses can be found.
+    Every run of every phase can also be exported as Chrome trace events.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Drop all recorded phases, spans and counters.
+        """
+        with self._lock:
+            self.started = time.perf_counter()
+            self.epoch = time.time()
+            self.phases: dict[str, dict[str, float]] = {}
+            self.runs: list[tuple[str, dict, float, float, int]] = []
+            self.counters: dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Time the code run inside the context as a phase with the given name.
+
+        Args:
+            name (str): The name of the phase.
+            **labels (str): Labels identifying this run of the phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                phase = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+                phase["count"] += 1
+                phase["seconds"] += seconds
+                self.runs.append(
+                    (
+                        name,
+                        labels,
+                        start - self.started,
+                        seconds,
+                        threading.get_native_id(),
+                    )
+                )
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Add to a counter.
+
+        Args:
+            name (str): The name of the counter.
+            value (int): The amount to add.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self) -> dict:
+        """
+        Return the recorded metrics as a JSON-serializable dictionary.
+        """
+        with self._lock:
+            return {
+                "seconds": time.perf_counter() - self.started,
+                "phases": {name: dict(phase) for name, phase in self.phases.items()},
+                "counters": dict(self.counters),
+                "yaml": yaml_implementation(),
+                "spans": [
+                    {"name": name, **labels, "start": start, "seconds": seconds}
+                    for name, labels, start, seconds, _ in self.runs
+                    if labels
+                ],
+            }
+
+    def trace_events(self) -> list[dict]:
+        """
+        Return every run of every phase as Chrome trace events.
+
+        Timestamps are microseconds since the epoch, so the events line up
+        with those recorded by the shell scripts in the same trace.
+
+        Returns:
+            list: Complete ("X") events, preceded by a metadata event naming the process.
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = [
+                {
+                    "name": "process_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "args": {"name": "promote.py"},
+                }
+            ]
+            for name, labels, start, seconds, thread in self.runs:
+                event = {
+                    "name": name,
+                    "cat": "promote.py",
+                    "ph": "X",
+                    "ts": round((self.epoch + start) * 1e6),
+                    "dur": round(seconds * 1e6),
+                    "pid": pid,
+                    "tid": thread,
+                }
+                if labels:
+                    event["args"] = labels
+                events.append(event)
+            return events
+
+
+# Shared by every phase of a run. Written to the PROMOTE_METRICS_FILE, if set,
+# when the run finishes.
+metrics = Metrics()
+
+
+class RoundTripFallback(Exception):
+    """
+    Raised when an edit cannot be expressed as a patch of the original text.
+    """
+
+
+def yaml_implementation() -> str:
+    """
+    Return the YAML implementation in use: libyaml or python.
+    """
+    return "python" if YamlLoader is yaml.SafeLoader else "libyaml"
+
+
+def load_yaml(text: str):
+    """
+    Parse a YAML document into Python objects, like `yaml.safe_load`.
+    """
+    return yaml.load(text, Loader=YamlLoader)
+
+
+def compose_yaml(text: str) -> Optional[yaml.Node]:
+    """
+    Parse a YAML document into its node tree, like `yaml.compose`.
+    """
+    return yaml.compose(text, Loader=YamlLoader)
+
+
+def parse_yaml(text: str) -> Iterator[yaml.Event]:
+    """
+    Parse a YAML document into a stream of events, like `yaml.parse`.
+    """
+    return yaml.parse(text, Loader=YamlLoader)
+
+
+def dump_yaml(value, **options) -> str:
+    """
+    Render a value as YAML, like `yaml.safe_dump`.
+
+    Args:
+        value: The value to render.
+        **options: The options of `yaml.dump`, e.g. sort_keys.
+    """
+    return yaml.dump(value, Dumper=YamlDumper, **options)
+
+
+class RoundTripDocument:
+    """
+    A YAML document that can be written back with its comments, key order and
+    formatting intact.
+
+    The document keeps the original text and the node tree it was composed
+    from. When it is dumped, the (possibly mutated) `data` is compared with the
+    original and only the changed parts of the text are rewritten: changed
+    scalars are replaced in place, new keys and list items are inserted after
+    their siblings, and lists of named entries (such as `images` and
+    `helmCharts`) are reordered by moving their original text. If an edit
+    cannot be expressed that way, the whole document is dumped instead.
+    """
+
+    def __init__(self, text: str, node: Optional[yaml.Node] = None) -> None:
+        self.text = text
+        self.node = compose_yaml(text) if node is None else node
+        self.original = self._construct()
+        self.data = self._construct()
+
+    def _construct(self):
+        if self.node is None:
+            return None
+        return yaml.constructor.SafeConstructor().construct_document(self.node)
+
+    def copy(self) -> "RoundTripDocument":
+        """
+        Return a copy of the document with its own mutable data, without parsing
+        the text again.
+        """
+        return RoundTripDocument(self.text, self.node)
+
+    def changed(self) -> bool:
+        """
+        Return whether the data has been changed since the document was parsed.
+        """
+        return not _same_yaml_value(self.original, self.data)
+
+    def dump(self) -> str:
+        """
+        Render the data as YAML, preserving the original text where it has not
+        changed.
+
+        Returns:
+            str: The rendered document.
+        """
+        if not self.changed():
+            return self.text
+        if self.node is not None:
+            try:
+                patcher = _RoundTripPatcher(self.text)
+                patcher.diff(self.node, self.original, self.data)
+                return patcher.render(0, len(self.text))
+            except RoundTripFallback as e:
+                logger.debug(f"Falling back to a full YAML dump: {e}")
+
+        return dump_yaml(self.data, sort_keys=False)
+
+
+def dump_yaml_scalar(value, style: Optional[str] = None) -> str:
+    """
+    Render a scalar value as it would appear in a YAML document, keeping the
+    given quoting style if it is a quoted style.
+
+    Args:
+        value: The scalar value to render.
+        style (str): The style of the scalar that is being replaced.
+
+    Returns:
+        str: The rendered scalar.
+
+    Raises:
+        RoundTripFallback: If the value cannot be rendered on a single line.
+    """
+    if isinstance(value, str) and "\n" in value:
+        raise RoundTripFallback("multi-line strings are not patched")
+    if style not in ("'", '"'):
+        style = None
+    # The widest line libyaml accepts, so that the scalar is never folded
+    rendered = dump_yaml(value, default_style=style, width=2**31 - 1)
+    if rendered.endswith("\n...\n"):
+        rendered = rendered[: -len("\n...\n")]
+    return rendered.rstrip("\n")
+
+
+def _same_yaml_value(a, b) -> bool:
+    # Compare the types too, since True == 1 and 1 == 1.0 in Python
+    return type(a) is type(b) and a == b
+
+
+def _is_yaml_scalar(value) -> bool:
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+def _item_name(item):
+    return item.get("name") if isinstance(item, dict) else None
+
+
+def _named_items(items: list) -> Optional[dict]:
+    names = {}
+    for item in items:
+        if not isinstance(item, dict) or "name" not in item:
+            return None
+        if not _is_yaml_scalar(item["name"]) or item["name"] in names:
+            return None
+        names[item["name"]] = item
+    return names
+
+
+class _RoundTripPatcher:
+    """
+    Collects replacements of spans of the original text.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.edits: list[tuple[int, int, str]] = []
+
+    def render(self, start: int, end: int) -> str:
+        """
+        Render the text between start and end with the edits inside it applied.
+        """
+        parts = []
+        position = start
+        for edit_start, edit_end, replacement in sorted(
+            edit for edit in self.edits if start <= edit[0] and edit[1] <= end
+        ):
+            parts.append(self.text[position:edit_start])
+            parts.append(replacement)
+            position = edit_end
+        parts.append(self.text[position:end])
+        return "".join(parts)
+
+    def insert(self, index: int, block: str) -> None:
+        if index > 0 and self.text[index - 1] != "\n":
+            block = "\n" + block
+        self.edits.append((index, index, block))
+
+    def line_start(self, index: int) -> int:
+        return self.text.rfind("\n", 0, index) + 1
+
+    def line_prefix(self, index: int) -> str:
+        start = self.line_start(index)
+        return self.text[start:index]
+
+    def block_end(self, node: yaml.Node) -> int:
+        """
+        Return the index just past the line on which the node ends, including
+        any trailing comment on that line.
+        """
+        while isinstance(node, yaml.CollectionNode) and not node.flow_style:
+            if not node.value:
+                break
+            node = node.value[-1]
+            if isinstance(node, tuple):
+                node = node[1]
+        end = node.end_mark.index
+        if end > 0 and self.text[end - 1] == "\n":
+            return end
+        newline = self.text.find("\n", end)
+        return len(self.text) if newline == -1 else newline + 1
+
+    def dump_block(self, value, indent: int) -> str:
+        rendered = dump_yaml(value, default_flow_style=False, sort_keys=False)
+        return "".join(
+            " " * indent + line for line in rendered.splitlines(keepends=True)
+        )
+
+    def diff(self, node: yaml.Node, original, value) -> None:
+        if _same_yaml_value(original, value):
+            return
+        if isinstance(node, yaml.ScalarNode) and _is_yaml_scalar(value):
+            replacement = dump_yaml_scalar(value, node.style)
+            if node.start_mark.index == node.end_mark.index:
+                # An empty value, e.g. `key:`, needs a separating space
+                replacement = " " + replacement
+            self.edits.append((node.start_mark.index, node.end_mark.index, replacement))
+        elif getattr(node, "flow_style", True):
+            raise RoundTripFallback(f"cannot patch line {node.start_mark.line + 1}")
+        elif isinstance(node, yaml.MappingNode) and isinstance(value, dict):
+            self.diff_mapping(node, original, value)
+        elif isinstance(node, yaml.SequenceNode) and isinstance(value, list):
+            self.diff_sequence(node, original, value)
+        else:
+            raise RoundTripFallback(f"cannot patch line {node.start_mark.line + 1}")
+
+    def diff_mapping(self, node: yaml.MappingNode, original: dict, value: dict):
+        keys = []
+        for key_node, value_node in node.value:
+            if not isinstance(key_node, yaml.ScalarNode):
+                raise RoundTripFallback("complex mapping keys are not patched")
+            key = yaml.constructor.SafeConstructor().construct_object(key_node)
+            keys.append(key)
+            if key in value:
+                self.diff(value_node, original[key], value[key])
+                continue
+            # The key was removed, which is only possible if it is on its own line
+            if self.line_prefix(key_node.start_mark.index).strip():
+                raise RoundTripFallback(f"cannot remove {key} from its line")
+            start = self.line_start(key_node.start_mark.index)
+            self.edits.append((start, self.block_end(value_node), ""))
+
+        added = {key: value[key] for key in value if key not in keys}
+        if added:
+            if not node.value:
+                raise RoundTripFallback("cannot add keys to an empty mapping")
+            self.insert(
+                self.block_end(node.value[-1][1]),
+                self.dump_block(added, node.value[0][0].start_mark.column),
+            )
+
+    def diff_sequence(self, node: yaml.SequenceNode, original: list, value: list):
+        items = node.value
+        if not items:
+            raise RoundTripFallback("cannot add items to an empty sequence")
+        dash = self.text.rfind("-", 0, items[0].start_mark.index)
+        indent = dash - self.line_start(dash)
+
+        if len(items) <= len(value) and all(
+            _same_yaml_value(_item_name(a), _item_name(b))
+            for a, b in zip(original, value)
+        ):
+            # Items are only updated in place or appended
+            for item_node, old, new in zip(items, original, value):
+                self.diff(item_node, old, new)
+            count = len(items)
+            if len(value) > count:
+                self.insert(
+                    self.block_end(items[-1]), self.dump_block(value[count:], indent)
+                )
+            return
+
+        original_names, names = _named_items(original), _named_items(value)
+        if original_names is None or names is None:
+            raise RoundTripFallback("cannot reorder unnamed sequence items")
+
+        # Move the text of each named item to its new position
+        blocks = {}
+        for i, item_node in enumerate(items):
+            start = self.line_start(item_node.start_mark.index)
+            if self.line_prefix(item_node.start_mark.index).strip() != "-":
+                raise RoundTripFallback("sequence items must start on the dash line")
+            end = (
+                self.line_start(items[i + 1].start_mark.index)
+                if i + 1 < len(items)
+                else self.block_end(item_node)
+            )
+            name = original[i]["name"]
+            if name in names:
+                item_patcher = _RoundTripPatcher(self.text)
+                item_patcher.diff(item_node, original[i], names[name])
+                blocks[name] = item_patcher.render(start, end)
+
+        start = self.line_start(items[0].start_mark.index)
+        self.edits.append(
+            (
+                start,
+                self.block_end(items[-1]),
+                "".join(
+                    blocks[name] if name in blocks else self.dump_block([item], indent)
+                    for name, item in names.items()
+                ),
+            )
+        )
+
+
+class ScalarSpan(NamedTuple):
+    """
+    The location of a scalar value in the text of a YAML document.
+    """
+
+    start: int
+    end: int
+    style: Optional[str]
+    value: object
+
+
+# The sections of a kustomization.yaml whose entries can be edited by
+# splicing, and the fields whose spans are recorded for each of their entries.
+SPAN_FIELDS = {
+    "images": ("name", "newName", "newTag", "digest"),
+    "helmCharts": ("name", "version", "releaseName"),
+}
+
+
+def scan_kustomization_spans(
+    text: str,
+) -> dict[str, Optional[list[dict[str, ScalarSpan]]]]:
+    """
+    Record the spans of the image and chart fields of a kustomization.yaml.
+
+    The document is read as a stream of parser events, so no objects are built
+    for the rest of the document (e.g. large valuesInline blocks).
+
+    Args:
+        text (str): The contents of the kustomization.yaml file.
+
+    Returns:
+        dict: A dictionary mapping each section in SPAN_FIELDS that is declared
+        in the document to the list of its entries, where each entry maps the
+        fields that it sets to their spans. A section is mapped to None if its
+        entries cannot be edited by splicing (e.g. it is in flow style or uses
+        anchors).
+
+    Raises:
+        yaml.YAMLError: If the kustomization.yaml file is invalid.
+    """
+    sections: dict[str, Optional[list[dict[str, ScalarSpan]]]] = {}
+    events = iter(parse_yaml(text))
+    for event in events:
+        if isinstance(event, yaml.MappingStartEvent):
+            break
+        if not isinstance(event, (yaml.StreamStartEvent, yaml.DocumentStartEvent)):
+            return sections
+    else:
+        return sections
+
+    for key in events:
+        if isinstance(key, yaml.MappingEndEvent):
+            break
+        value = next(events)
+        if not isinstance(key, yaml.ScalarEvent) or key.value not in SPAN_FIELDS:
+            _skip_yaml_events(events, key)
+            _skip_yaml_events(events, value)
+        elif isinstance(value, yaml.SequenceStartEvent) and not value.flow_style:
+            sections[key.value] = _scan_entries(events, SPAN_FIELDS[key.value])
+        else:
+            _skip_yaml_events(events, value)
+            sections[key.value] = None
+
+    return sections
+
+
+def _scan_entries(events: Iterator, fields: tuple) -> Optional[list]:
+    entries: Optional[list] = []
+    for item in events:
+        if isinstance(item, yaml.SequenceEndEvent):
+            break
+        if not isinstance(item, yaml.MappingStartEvent) or item.anchor:
+            _skip_yaml_events(events, item)
+            entries = None
+            continue
+
+        entry = {}
+        for key in events:
+            if isinstance(key, yaml.MappingEndEvent):
+                break
+            value = next(events)
+            recorded = isinstance(key, yaml.ScalarEvent) and key.value in fields
+            if recorded and isinstance(value, yaml.ScalarEvent) and not value.anchor:
+                # Parsed events always carry their marks
+                assert value.start_mark is not None and value.end_mark is not None
+                entry[key.value] = ScalarSpan(
+                    value.start_mark.index,
+                    value.end_mark.index,
+                    value.style,
+                    _construct_scalar_event(value),
+                )
+            else:
+                _skip_yaml_events(events, key)
+                _skip_yaml_events(events, value)
+        if entries is not None:
+            entries.append(entry)
+
+    return entries
+
+
+def _skip_yaml_events(events: Iterator, event: yaml.Event) -> None:
+    # Skip the rest of the collection that the event starts, if any
+    depth = int(isinstance(event, yaml.CollectionStartEvent))
+    while depth:
+        event = next(events)
+        if isinstance(event, yaml.CollectionStartEvent):
+            depth += 1
+        elif isinstance(event, yaml.CollectionEndEvent):
+            depth -= 1
+
+
+def _scalar_event_node(
+    event: yaml.ScalarEvent, resolver: yaml.resolver.BaseResolver
+) -> yaml.ScalarNode:
+    # Build the node of a scalar event, resolving its tag like yaml.compose does.
+    # libyaml's marks are its own class, with the same attributes as PyYAML's.
+    tag = event.tag
+    if tag is None or tag == "!":
+        tag = resolver.resolve(yaml.ScalarNode, event.value, event.implicit)
+    return yaml.ScalarNode(
+        cast(str, tag),
+        event.value,
+        cast(Optional[yaml.Mark], event.start_mark),
+        cast(Optional[yaml.Mark], event.end_mark),
+        event.style,
+    )
+
+
+def _construct_scalar_event(event: yaml.ScalarEvent):
+    node = _scalar_event_node(event, yaml.resolver.Resolver())
+    return yaml.constructor.SafeConstructor().construct_object(node)
+
+
+class _LazyParseFallback(Exception):
+    """
+    Raised when a section cannot be read from parser events alone.
+    """
+
+
+def load_kustomization_section(text: str, section: str) -> dict:
+    """
+    Parse one section of a kustomization.yaml, building only the fields of its
+    entries that are listed in SPAN_FIELDS.
+
+    The document is read as a stream of parser events, and the rest of it
+    (e.g. large valuesInline blocks and patches) is skipped event by event,
+    without building any nodes or objects for it. The whole document is
+    parsed instead if the section uses aliases or merge keys.
+
+    Args:
+        text (str): The contents of the kustomization.yaml file.
+        section (str): images or helmCharts.
+
+    Returns:
+        dict: The document with only the section, or an empty dictionary if
+        the section is not declared.
+
+    Raises:
+        yaml.YAMLError: If the kustomization.yaml file is invalid.
+    """
+    events = iter(parse_yaml(text))
+    for event in events:
+        if isinstance(event, yaml.MappingStartEvent):
+            break
+        if not isinstance(event, (yaml.StreamStartEvent, yaml.DocumentStartEvent)):
+            return load_yaml(text) or {}
+    else:
+        return {}
+
+    document = {}
+    try:
+        for key in events:
+            if isinstance(key, yaml.MappingEndEvent):
+                break
+            value = next(events)
+            if isinstance(key, yaml.ScalarEvent) and key.value == section:
+                document[section] = _load_section_events(
+                    events, value, SPAN_FIELDS[section]
+                )
+            else:
+                _skip_yaml_events(events, key)
+                _skip_yaml_events(events, value)
+    except _LazyParseFallback:
+        return load_yaml(text) or {}
+
+    # Read the rest of the stream, so that errors after the mapping are reported
+    for _ in events:
+        pass
+
+    return document
+
+
+def _load_section_events(events: Iterator, event: yaml.Event, fields: tuple):
+    if not isinstance(event, yaml.SequenceStartEvent):
+        return _construct_events(events, event)
+
+    entries = []
+    for item in events:
+        if isinstance(item, yaml.SequenceEndEvent):
+            break
+        if not isinstance(item, yaml.MappingStartEvent):
+            entries.append(_construct_events(events, item))
+            continue
+
+        entry = {}
+        for key in events:
+            if isinstance(key, yaml.MappingEndEvent):
+                break
+            value = next(events)
+            if not isinstance(key, yaml.ScalarEvent) or key.value == "<<":
+                raise _LazyParseFallback()
+            if key.value in fields:
+                entry[key.value] = _construct_events(events, value)
+            else:
+                _skip_yaml_events(events, value)
+        entries.append(entry)
+
+    return entries
+
+
+def _construct_events(events: Iterator, event: yaml.Event):
+    node = _compose_events(events, event, yaml.resolver.Resolver())
+    return yaml.constructor.SafeConstructor().construct_document(node)
+
+
+def _compose_events(
+    events: Iterator, event: yaml.Event, resolver: yaml.resolver.Resolver
+) -> yaml.Node:
+    # Build the node that the event starts, like yaml.compose does for a document
+    if isinstance(event, yaml.ScalarEvent):
+        return _scalar_event_node(event, resolver)
+    if not isinstance(event, yaml.CollectionStartEvent):
+        # Aliases refer to anchors that may be anywhere in the document
+        raise _LazyParseFallback()
+
+    kind = (
+        yaml.SequenceNode
+        if isinstance(event, yaml.SequenceStartEvent)
+        else yaml.MappingNode
+    )
+    tag = event.tag
+    if tag is None or tag == "!":
+        tag = resolver.resolve(kind, None, event.implicit)
+    node = kind(
+        cast(str, tag),
+        [],
+        cast(Optional[yaml.Mark], event.start_mark),
+        None,
+        event.flow_style,
+    )
+    for child in events:
+        if isinstance(child, yaml.CollectionEndEvent):
+            node.end_mark = child.end_mark
+            return node
+        if kind is yaml.SequenceNode:
+            node.value.append(_compose_events(events, child, resolver))
+        else:
+            node.value.append(
+                (
+                    _compose_events(events, child, resolver),
+                    _compose_events(events, next(events), resolver),
+                )
+            )
+    raise _LazyParseFallback()
+
+
+class SpanEditor:
+    """
+    Edits the images and helmCharts of a kustomization.yaml by splicing new
+    scalar values into the original text.
+
+    Only fields that are already set on an entry can be edited, so that the
+    cost of an edit is proportional to the size of the edit and not of the
+    file. Anything else (adding fields or entries) must be done with a
+    RoundTripDocument instead.
+    """
+
+    def __init__(
+        self, text: str, spans: dict[str, Optional[list[dict[str, ScalarSpan]]]]
+    ) -> None:
+        self.text = text
+        self.spans = spans
+        self.edits: dict[ScalarSpan, object] = {}
+
+    def entries(self, section: str) -> Optional[list[dict]]:
+        """
+        Return the values of the recorded fields of each entry of a section.
+
+        Args:
+            section (str): images or helmCharts.
+
+        Returns:
+            list: The entries of the section, or None if the section is not
+            declared or cannot be edited by splicing.
+        """
+        entries = self.spans.get(section)
+        if entries is None:
+            return None
+        return [
+            {field: span.value for field, span in entry.items()} for entry in entries
+        ]
+
+    def set(self, section: str, index: int, field: str, value) -> bool:
+        """
+        Set a field of an entry of a section.
+
+        Args:
+            section (str): images or helmCharts.
+            index (int): The index of the entry in the section.
+            field (str): The field to set.
+            value: The new value of the field.
+
+        Returns:
+            bool: True if the field was set, False if it cannot be set by
+            splicing because it is not set on the entry yet.
+        """
+        entries = self.spans.get(section)
+        if entries is None or field not in entries[index]:
+            return False
+        if isinstance(value, str) and "\n" in value:
+            return False
+        self.edits[entries[index][field]] = value
+        return True
+
+    def changed(self) -> bool:
+        """
+        Return whether any field has been set to a different value.
+        """
+        return any(
+            not _same_yaml_value(span.value, value)
+            for span, value in self.edits.items()
+        )
+
+    def dump(self) -> str:
+        """
+        Render the text with the new values spliced in.
+
+        Returns:
+            str: The updated contents of the kustomization.yaml file.
+        """
+        parts = []
+        position = 0
+        for span, value in sorted(self.edits.items(), key=lambda edit: edit[0].start):
+            if _same_yaml_value(span.value, value):
+                continue
+            start, end = span.start, span.end
+            parts.append(self.text[position:start])
+            parts.append(dump_yaml_scalar(value, span.style))
+            position = end
+        parts.append(self.text[position:])
+        return "".join(parts)
+
+
+class KustomizationCache:
+    """
+    A per-run cache of kustomization.yaml files.
+
+    Files are keyed by their resolved path and revalidated against their mtime
+    and size on every lookup, so a file that is rewritten during the run (e.g.
+    by `kustomize edit set image`) is read again, while a fromOverlay that is
+    referenced by many images and target overlays is only read and parsed once.
+
+    The text of a file is read eagerly, while its parsed document and its
+    scalar spans are built the first time they are requested. Values derived
+    from a document (e.g. the validated images of an overlay) can be cached
+    alongside it with `derived`, and are dropped together with the document
+    when the file changes.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[str, tuple[int, int, str, dict]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.reads = 0
+        self.parses = 0
+        self.section_parses = 0
+
+    def _lookup(self, path: str) -> tuple[int, int, str, dict]:
+        resolved = os.path.realpath(path)
+        # Raises FileNotFoundError if the kustomization file does not exist
+        info = os.stat(resolved)
+        with self._lock:
+            entry = self._entries.get(resolved)
+            if entry is not None and entry[:2] == (info.st_mtime_ns, info.st_size):
+                self.hits += 1
+                return entry
+
+        with open(resolved) as f:
+            entry = (info.st_mtime_ns, info.st_size, f.read(), {})
+        with self._lock:
+            self.reads += 1
+            self._entries[resolved] = entry
+        metrics.count("files_read")
+        metrics.count("bytes_read", info.st_size)
+
+        return entry
+
+    def _build(self, entry: tuple, key: str, build: Callable):
+        derived = entry[3]
+        if key not in derived:
+            derived[key] = build()
+        return derived[key]
+
+    def text(self, path: str) -> str:
+        """
+        Read the kustomization file at the given path.
+
+        Args:
+            path (str): The path to the kustomization.yaml file.
+
+        Returns:
+            str: The contents of the file.
+
+        Raises:
+            FileNotFoundError: If the kustomization.yaml file does not exist.
+        """
+        return self._lookup(path)[2]
+
+    def document(self, path: str) -> RoundTripDocument:
+        """
+        Parse the kustomization file at the given path.
+
+        Args:
+            path (str): The path to the kustomization.yaml file.
+
+        Returns:
+            RoundTripDocument: The cached document, which must not be modified.
+
+        Raises:
+            FileNotFoundError: If the kustomization.yaml file does not exist.
+            yaml.YAMLError: If the kustomization.yaml file is invalid.
+        """
+        entry = self._lookup(path)
+        return self._build(entry, "document", lambda: self._parse(entry[2]))
+
+    def _parse(self, text: str) -> RoundTripDocument:
+        document = RoundTripDocument(text)
+        with self._lock:
+            self.parses += 1
+        metrics.count("files_parsed")
+        return document
+
+    def load(self, path: str) -> dict:
+        """
+        Load the kustomization document at the given path, parsing it only if
+        it has not been parsed yet or has changed on disk since it was parsed.
+
+        Args:
+            path (str): The path to the kustomization.yaml file.
+
+        Returns:
+            dict: The parsed kustomization document. It is shared between
+            callers and must be treated as read-only.
+
+        Raises:
+            FileNotFoundError: If the kustomization.yaml file does not exist.
+            yaml.YAMLError: If the kustomization.yaml file is invalid.
+        """
+        return self.document(path).original
+
+    def edit(self, path: str) -> RoundTripDocument:
+        """
+        Load the kustomization document at the given path for editing.
+
+        Args:
+            path (str): The path to the kustomization.yaml file.
+
+        Returns:
+            RoundTripDocument: A copy of the cached document whose data can be
+            updated and dumped without affecting other readers.
+
+        Raises:
+            FileNotFoundError: If the kustomization.yaml file does not exist.
+            yaml.YAMLError: If the kustomization.yaml file is invalid.
+        """
+        return self.document(path).copy()
+
+    def splice(self, path: str) -> "SpanEditor":
+        """
+        Load the kustomization file at the given path for editing its images
+        and helmCharts by splicing, without parsing the whole document.
+
+        Args:
+            path (str): The path to the kustomization.yaml file.
+
+        Returns:
+            SpanEditor: A new editor over the cached text and spans.
+
+        Raises:
+            FileNotFoundError: If the kustomization.yaml file does not exist.
+            yaml.YAMLError: If the kustomization.yaml file is invalid.
+        """
+        entry = self._lookup(path)
+        spans = self._build(entry, "spans", lambda: self._scan(entry[2]))
+        return SpanEditor(entry[2], spans)
+
+    def _scan(self, text: str) -> dict:
+        spans = scan_kustomization_spans(text)
+        metrics.count("files_scanned")
+        return spans
+
+    def derived(
+        self,
+        path: str,
+        key: str,
+        build: Callable[[dict], object],
+        section: Optional[str] = None,
+    ):
+        """
+        Return a value derived from the kustomization document at the given
+        path, building it with `build(document)` the first time it is requested
+        for the current version of the file.
+
+        Args:
+            path (str): The path to the kustomization.yaml file.
+            key (str): The name of the derived value.
+            build (Callable): Builds the derived value from the document.
+            section (str): If set, the value only needs this section of the
+                document (images or helmCharts), so unless the document has
+                already been parsed, only the section is parsed with
+                `load_kustomization_section`.
+
+        Returns:
+            The derived value.
+        """
+        entry = self._lookup(path)
+
+        def document() -> dict:
+            if section is not None and "document" not in entry[3]:
+                return self._parse_section(entry[2], section)
+            return self._build(
+                entry, "document", lambda: self._parse(entry[2])
+            ).original
+
+        return self._build(entry, f"derived:{key}", lambda: build(document()))
+
+    def _parse_section(self, text: str, section: str) -> dict:
+        document = load_kustomization_section(text, section)
+        with self._lock:
+            self.section_parses += 1
+        metrics.count("sections_parsed")
+        return document
+
+    def invalidate(self, path: str) -> None:
+        """
+        Drop the cached document for the given path, e.g. after rewriting it.
+
+        Args:
+            path (str): The path to the kustomization.yaml file.
+        """
+        with self._lock:
+            self._entries.pop(os.path.realpath(path), None)
+
+    def clear(self) -> None:
+        """
+        Drop all cached documents and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.reads = 0
+            self.parses = 0
+            self.section_parses = 0
+
+
+# Shared by every reader of kustomization.yaml files in this module, so that
+# each file is parsed once per run.
+kustomization_cache = KustomizationCache()
+
+
+def git_blob_hash(data: bytes) -> str:
+    """
+    Compute the id git gives to a blob with the given contents.
+
+    Args:
+        data (bytes): The contents of the file.
+
+    Returns:
+        str: The hex SHA-1 of the blob, as printed by `git hash-object`.
+    """
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def _scan_directory(path: str) -> tuple[bool, list[str]]:
+    has_kustomization = False
+    directories = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != ".git":
+                        directories.append(entry.path)
+                elif entry.name == "kustomization.yaml":
+                    has_kustomization = True
+    except OSError as e:
+        logger.warning(f"Skipping {path}: {e}")
+    return has_kustomization, directories
+
+
+def find_kustomization_dirs(deployment_dir: str, max_workers: int = 8) -> list[str]:
+    """
+    Find every directory containing a kustomization.yaml in the deployment directory.
+
+    The tree is walked one level at a time, scanning the directories of each
+    level in parallel. `.git` directories and symlinked directories are skipped.
+
+    Args:
+        deployment_dir (str): The deployment directory.
+        max_workers (int): The maximum number of directories to scan at the same time.
+
+    Returns:
+        list: The directories, relative to the deployment directory with `/`
+        separators and sorted, where `.` is the deployment directory itself.
+    """
+    found = []
+    level = [deployment_dir]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            next_level = []
+            for directory, (has_kustomization, directories) in zip(
+                level, executor.map(_scan_directory, level)
+            ):
+                if has_kustomization:
+                    relative = os.path.relpath(directory, deployment_dir)
+                    found.append(relative.replace(os.sep, "/"))
+                next_level += directories
+            level = next_level
+
+    return sorted(found)
+
+
+def _index_entries(text: str) -> dict[str, list[dict]]:
+    spans = scan_kustomization_spans(text)
+    document = None
+    entries = {}
+    for section, key in (("images", "images"), ("helmCharts", "charts")):
+        if section not in spans:
+            continue
+        section_entries = SpanEditor(text, spans).entries(section)
+        if section_entries is None:
+            # Flow style or anchors, which the span scan does not record
+            if document is None:
+                document = load_yaml(text) or {}
+            section_entries = [
+                {
+                    field: entry[field]
+                    for field in SPAN_FIELDS[section]
+                    if field in entry and _is_yaml_scalar(entry[field])
+                }
+                for entry in document.get(section) or []
+                if isinstance(entry, dict)
+            ]
+        entries[key] = [entry for entry in section_entries if "name" in entry]
+
+    return entries
+
+
+class KustomizationIndex:
+    """
+    An index of the images and charts declared by every overlay in a deployment directory.
+
+    For each overlay (a directory containing a kustomization.yaml), the index
+    records the fields of its images (name, newName, newTag, digest) and charts
+    (name, version, releaseName), so that the overlays referencing an image or
+    chart can be looked up without reading the repository.
+
+    The index can be saved to and loaded from a JSON file. Refreshing a loaded
+    index only reads the kustomization files whose mtime or size changed, and
+    only parses those whose git blob hash changed, e.g. not after a fresh
+    checkout that only touched the mtimes.
+    """
+
+    VERSION = 1
+
+    def __init__(self, deployment_dir: str, overlays: Optional[dict] = None) -> None:
+        self.deployment_dir = deployment_dir
+        self.overlays: dict[str, dict] = overlays or {}
+        self._by_name: Optional[dict[tuple[str, str], list[dict]]] = None
+
+    @classmethod
+    def load(cls, path: str, deployment_dir: str) -> "KustomizationIndex":
+        """
+        Load a saved index, or return an empty one if it is missing, of an
+        older version or of another deployment directory.
+
+        Args:
+            path (str): The path of the index file.
+            deployment_dir (str): The deployment directory.
+
+        Returns:
+            KustomizationIndex: The index, which still needs to be refreshed.
+        """
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return cls(deployment_dir)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring the index in {path}: {e}")
+            return cls(deployment_dir)
+
+        if not isinstance(saved, dict):
+            return cls(deployment_dir)
+        if (saved.get("version"), saved.get("deploymentDir")) != (
+            cls.VERSION,
+            deployment_dir,
+        ):
+            # Built by another version or for another deployment directory
+            return cls(deployment_dir)
+
+        return cls(deployment_dir, saved["overlays"])
+
+    def save(self, path: str) -> None:
+        """
+        Save the index as JSON.
+
+        Args:
+            path (str): The path of the index file.
+        """
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(
+                {
+                    "version": self.VERSION,
+                    "deploymentDir": self.deployment_dir,
+                    "overlays": self.overlays,
+                },
+                f,
+            )
+        os.replace(temporary, path)
+
+    def refresh(self, max_workers: int = 8) -> bool:
+        """
+        Bring the index up to date with the deployment directory.
+
+        Args:
+            max_workers (int): The maximum number of directories to scan and
+                files to read at the same time.
+
+        Returns:
+            bool: True if the index changed.
+        """
+        with metrics.phase("index_walk"):
+            overlays = find_kustomization_dirs(self.deployment_dir, max_workers)
+
+        with metrics.phase("index_refresh"):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                indexed = list(
+                    executor.map(
+                        lambda overlay: self._index_overlay(
+                            overlay, self.overlays.get(overlay)
+                        ),
+                        overlays,
+                    )
+                )
+
+        refreshed = {
+            overlay: entry
+            for overlay, entry in zip(overlays, indexed)
+            if entry is not None
+        }
+        changed = refreshed != self.overlays
+        self.overlays = refreshed
+        self._by_name = None
+        return changed
+
+    def _index_overlay(self, overlay: str, previous: Optional[dict]) -> Optional[dict]:
+        path = os.path.join(self.deployment_dir, overlay, "kustomization.yaml")
+        try:
+            stat_result = os.stat(path)
+            if previous and (previous["mtime"], previous["size"]) == (
+                stat_result.st_mtime_ns,
+                stat_result.st_size,
+            ):
+                return previous
+
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            logger.warning(f"Skipping {path}: {e}")
+            return None
+
+        metrics.count("index_files_hashed")
+        blob = git_blob_hash(data)
+        stamp = {"mtime": stat_result.st_mtime_ns, "size": stat_result.st_size}
+        if previous and previous["blob"] == blob:
+            return {**previous, **stamp}
+
+        metrics.count("index_files_parsed")
+        try:
+            entries = _index_entries(data.decode("utf-8"))
+        except (UnicodeDecodeError, yaml.YAMLError) as e:
+            logger.warning(f"Skipping {path}: {e}")
+            return None
+
+        return {**stamp, "blob": blob, **entries}
+
+    def find_images(self, name: str) -> list[dict]:
+        """
+        Find the overlays that declare an image with the given name or newName.
+
+        Args:
+            name (str): The image name.
+
+        Returns:
+            list: The overlay and the fields of each matching image, in overlay order.
+        """
+        return self._find("images", name, ("name", "newName"))
+
+    def find_charts(self, name: str) -> list[dict]:
+        """
+        Find the overlays that declare a chart with the given name.
+
+        Args:
+            name (str): The chart name.
+
+        Returns:
+            list: The overlay and the fields of each matching chart, in overlay order.
+        """
+        return self._find("charts", name, ("name",))
+
+    def _find(self, key: str, name: str, fields: tuple[str, ...]) -> list[dict]:
+        if self._by_name is None:
+            # Built on the first lookup, so that each lookup is a dictionary access
+            by_name: dict[tuple[str, str], list[dict]] = {}
+            for overlay, indexed in self.overlays.items():
+                for section in ("images", "charts"):
+                    for entry in indexed.get(section, []):
+                        values = {entry.get("name"), entry.get("newName")}
+                        for value in values - {None}:
+                            by_name.setdefault((section, value), []).append(
+                                {"overlay": overlay, **entry}
+                            )
+            self._by_name = by_name
+
+        return [
+            entry
+            for entry in self._by_name.get((key, name), [])
+            if any(entry.get(field) == name for field in fields)
+        ]
+
 
-def run(args: list[str]) -> int:
+# The indexes loaded by this process, by deployment directory
+_kustomization_indexes: dict[str, KustomizationIndex] = {}
+
+
+def load_kustomization_index(deployment_dir: str) -> KustomizationIndex:
+    """
+    Load the index of the deployment directory, refreshing it and saving it back
+    to the PROMOTE_INDEX_FILE env variable, if set, for the next run. The index
+    is kept in memory, so later calls in the same process only refresh it.
+
+    Args:
+        deployment_dir (str): The deployment directory.
+
+    Returns:
+        KustomizationIndex: The up to date index.
+    """
+    index_file = os.getenv("PROMOTE_INDEX_FILE")
+    if deployment_dir in _kustomization_indexes:
+        # Kept from an earlier lookup in this process, e.g. by `promote.py serve`
+        index = _kustomization_indexes[deployment_dir]
+    elif index_file:
+        index = KustomizationIndex.load(index_file, deployment_dir)
+    else:
+        index = KustomizationIndex(deployment_dir)
+    _kustomization_indexes[deployment_dir] = index
+
+    if index.refresh() and index_file:
+        try:
+            index.save(index_file)
+        except OSError as e:
+            logger.error(f"Failed to save the index to {index_file}: {e}")
+
+    return index
+
+
+# The backends that can be used to apply image updates to an overlay. The
+# kustomize backend runs `kustomize edit set image`, while the native backend
+# applies the same edit to the parsed kustomization.yaml in-process.
+IMAGE_BACKENDS = ("kustomize", "native")
+
+# Matches <image>:<tag> the same way `kustomize edit set image` does, where a
+# tag of `*` preserves the tag that is already set in the kustomization.
+IMAGE_TAG_PATTERN = re.compile(r"^(.*):([a-zA-Z0-9._-]*|\*)$")
+
+# The version of the format of promotion plans.
+PLAN_VERSION = 1
+
+# The order in which kustomize writes the fields of an image entry.
+IMAGE_FIELDS = ("name", "newName", "newTag", "digest")
+
+
+def run(args: list[str], cwd: Optional[str] = None) -> int:
     """
     Run the given command and log the output.
 
     Args:
         args (list): The command to run.
+        cwd (str): The directory to run the command in, defaulting to the
+            current working directory.
 
     Returns:
         int: The return code of the command.
@@ -76,7 +1510,9 @@ def run(args: list[str]) -> int:
     # Run the command, capturing the output and printing it to the stderr
     # This is done so that the output of the command is printed to the GitHub Action log
     # and not just the stdout of the script
-    output = subprocess.run(args, capture_output=True, text=True)
+    metrics.count("subprocesses")
+    with metrics.phase("subprocess", command=" ".join(args), cwd=cwd or os.getcwd()):
+        output = subprocess.run(args, capture_output=True, text=True, cwd=cwd)
     if output.stderr:
         logger.error(output.stderr)
     if output.stdout:
@@ -115,488 +1551,1841 @@ def merge_manifests(a: dict, b: dict) -> dict:
             if "charts" in b[overlay]:
                 a[overlay]["charts"] += b[overlay]["charts"]
 
-    return a
+    return a
+
+
+# For each section of the promotion input: the kind of entry, the fields that
+# set the promoted values, and the fields that must be unique across entries
+PROMOTION_FIELDS = {
+    "images": ("Image", ("newName", "newTag"), ("name", "newName")),
+    "charts": ("Chart", ("version",), ("name",)),
+}
+
+
+def validate_promotion_entries(
+    entries: list, section: str, require_overlays: bool = True
+) -> list[dict]:
+    """
+    Validate the entries of a list of images or charts in a single pass,
+    collecting every problem instead of stopping at the first.
+
+    Each entry must have a name, either set the promoted values or read them
+    with fromOverlay (optionally at a fromRef), and list its overlays, without
+    listing any overlay twice. Names (and image newNames) must be unique.
+
+    Args:
+        entries (list): The images or charts to validate.
+        section (str): images or charts.
+        require_overlays (bool): Whether the entries must have overlays, which
+            is not the case for the entries of a kustomization.
+
+    Returns:
+        list: The errors found, in the order of the entries. Each error is a
+        dict with the section, the index of the entry, its name if it has one,
+        the offending field, if any, and a message. If the entries are not a
+        list, that is the only error, without an index.
+
+    Example Usage:
+        errors = validate_promotion_entries(
+            [{"name": "app1", "overlays": ["dev", "dev"]}], "images"
+        )
+
+        print([error["message"] for error in errors])
+        # Output: ['Image app1 must set newName, newTag or both.',
+        #          'Image app1 targets the overlay dev more than once.']
+    """
+    if not isinstance(entries, list):
+        return [
+            {
+                "section": section,
+                "index": None,
+                "name": None,
+                "field": None,
+                "message": f"The {section} must be a list, got {type(entries).__name__}.",
+            }
+        ]
+
+    kind, value_fields, unique_fields = PROMOTION_FIELDS[section]
+    required = value_fields[0]
+    if len(value_fields) > 1:
+        required = f"{', '.join(value_fields)} or both"
+
+    # The index of the first entry with each value of the unique fields
+    seen: dict[str, dict] = {field: {} for field in unique_fields}
+    errors: list[dict] = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            errors.append(
+                {
+                    "section": section,
+                    "index": index,
+                    "name": None,
+                    "field": None,
+                    "message": f"{kind} {entry!r} must be an object.",
+                }
+            )
+            continue
+
+        # (field, message) for each problem with the entry
+        problems: list[tuple[Optional[str], str]] = []
+        name = entry.get("name")
+        label = entry if name is None else name
+        if name is None:
+            problems.append(
+                ("name", f"{kind} {entry} is missing the required 'name' field.")
+            )
+        elif not isinstance(name, str):
+            problems.append(("name", f"{kind} {entry} must have a string 'name'."))
+        if "fromRef" in entry and "fromOverlay" not in entry:
+            problems.append(
+                ("fromRef", f"{kind} {label} cannot set fromRef without fromOverlay.")
+            )
+        if "fromOverlay" in entry:
+            problems += [
+                (field, f"{kind} {label} cannot set {field} when fromOverlay is set.")
+                for field in value_fields
+                if field in entry
+            ]
+        elif not any(field in entry for field in value_fields):
+            problems.append((None, f"{kind} {label} must set {required}."))
+
+        overlays = entry.get("overlays")
+        if overlays is None:
+            if require_overlays:
+                problems.append(
+                    (
+                        "overlays",
+                        f"{kind} {label} is missing the required 'overlays' field.",
+                    )
+                )
+        elif isinstance(overlays, list):
+            # Targeting an overlay twice would edit the same entry of it twice
+            targeted: set = set()
+            for overlay in overlays:
+                if not isinstance(overlay, str):
+                    problems.append(
+                        ("overlays", f"{kind} {label} has a non-string overlay.")
+                    )
+                elif overlay in targeted:
+                    problems.append(
+                        (
+                            "overlays",
+                            f"{kind} {label} targets the overlay {overlay} more than once.",
+                        )
+                    )
+                else:
+                    targeted.add(overlay)
+        elif not isinstance(overlays, str):
+            problems.append(
+                (
+                    "overlays",
+                    f"{kind} {label} overlays must be a list of overlays or a pattern.",
+                )
+            )
+
+        for field in unique_fields:
+            value = entry.get(field)
+            if not isinstance(value, str):
+                continue
+            if value in seen[field]:
+                problems.append(
+                    (
+                        field,
+                        f"Found duplicate {kind.lower()} {field} {value} (also used by entry {seen[field][value]}). {kind}s must have unique {field}s.",
+                    )
+                )
+            else:
+                seen[field][value] = index
+
+        errors += [
+            {
+                "section": section,
+                "index": index,
+                "name": name,
+                "field": field,
+                "message": message,
+            }
+            for field, message in problems
+        ]
+
+    return errors
+
+
+def validate_promotions(images: list, charts: list) -> list[dict]:
+    """
+    Validate the images and charts to update, collecting every problem.
+
+    Args:
+        images (list): The images to update, as in IMAGES_TO_UPDATE.
+        charts (list): The charts to update, as in CHARTS_TO_UPDATE.
+
+    Returns:
+        list: The errors found, as returned by `validate_promotion_entries`,
+        the images' first.
+    """
+    errors = validate_promotion_entries(images, "images")
+    errors += validate_promotion_entries(charts, "charts")
+    return errors
+
+
+def _validate_section(entries, section: str) -> bool:
+    # Entries given as a dict are those of a kustomization, which have no overlays
+    from_kustomization = isinstance(entries, dict)
+    if from_kustomization:
+        entries = list(entries.values())
+
+    errors = validate_promotion_entries(entries, section, not from_kustomization)
+    for error in errors:
+        logger.error(error["message"])
+
+    return not errors
+
+
+def validate_images(images):
+    """
+    Validate a list of images to ensure they have the required fields and that the names and newNames are unique.
+
+    Args:
+        images (list): The list of images to validate.
+
+    Returns:
+        bool: True if all images are valid, False otherwise, after logging
+        every problem found.
+    """
+    return _validate_section(images, "images")
+
+
+def validate_charts(charts):
+    """
+    Validate that the charts to update have the required fields.
+
+    Args:
+        charts (list): The list of charts to update.
+
+    Returns:
+        bool: True if all charts are valid, False otherwise, after logging
+        every problem found.
+    """
+    return _validate_section(charts, "charts")
+
+
+def read_images_from_overlay(
+    overlay: str, deployment_dir: str, ref: Optional[str] = None
+) -> dict[str, dict]:
+    """
+    Read the images from the specified overlay in a deployment directory and return a dictionary mapping image names to their corresponding image dictionaries.
+
+    Args:
+        overlay (str): The name of the overlay to read the images from.
+        deployment_dir (str): The directory containing the overlays.
+        ref (str): If set, read the overlay as it was at this git revision
+            instead of from the deployment directory.
+
+    Returns:
+        dict: A dictionary mapping image names to their corresponding image dictionaries.
+    """
+    if ref is not None:
+        return read_kustomization_at_ref(
+            overlay, ref, deployment_dir, "images", _images_from_kustomization
+        )
+
+    kustomization_file = os.path.join(deployment_dir, overlay, "kustomization.yaml")
+    try:
+        # Read the images from the kustomization.yaml file, reusing the parsed
+        # and validated images if this overlay has already been read.
+        return kustomization_cache.derived(
+            kustomization_file,
+            "images",
+            lambda kustomize: _images_from_kustomization(
+                overlay, kustomization_file, kustomize
+            ),
+            section="images",
+        )
+    except FileNotFoundError:
+        raise OverlayNotFoundError(
+            f"Kustomization file {kustomization_file} does not exist."
+        ) from None
+    except yaml.YAMLError as e:
+        raise KustomizationError(
+            f"Kustomization file {kustomization_file} is invalid: {e}"
+        ) from e
+
+
+def _images_from_kustomization(
+    overlay: str, kustomization_file: str, kustomize: dict
+) -> dict[str, dict]:
+    images = {}
+    if "images" not in kustomize:
+        raise KustomizationError(
+            f"Overlay {overlay} ({kustomization_file}) does not have any images."
+        )
+    for image in kustomize["images"]:
+        if "name" not in image:
+            raise KustomizationError(
+                f"Image {image} ({kustomization_file}) is missing the required 'name' field."
+            )
+        # Add the image to the list of images
+        images[image["name"]] = image
+
+    # Validate that the images have the required fields
+    if not validate_images(images):
+        raise KustomizationError(f"Overlay {overlay} has invalid images.")
+
+    return images
+
+
+def read_charts_from_overlay(
+    overlay: str, deployment_dir: str, ref: Optional[str] = None
+) -> dict[str, dict]:
+    """
+    Read the charts from the specified overlay by opening the kustomization.yaml file of the overlay and extracting the chart information.
+
+    Args:
+        overlay (str): The name of the overlay to read the charts from.
+        deployment_dir (str): The directory path containing the overlays.
+        ref (str): If set, read the overlay as it was at this git revision
+            instead of from the deployment directory.
+
+    Returns:
+        dict: A dictionary mapping chart names to the chart dictionary.
+
+    Raises:
+        FileNotFoundError: If the kustomization.yaml file does not exist.
+        yaml.YAMLError: If the kustomization.yaml file is invalid.
+    """
+    if ref is not None:
+        return read_kustomization_at_ref(
+            overlay, ref, deployment_dir, "charts", _charts_from_kustomization
+        )
+
+    kustomization_file = os.path.join(deployment_dir, overlay, "kustomization.yaml")
+    try:
+        # Read the charts from the kustomization.yaml file, reusing the parsed
+        # and validated charts if this overlay has already been read.
+        return kustomization_cache.derived(
+            kustomization_file,
+            "charts",
+            lambda kustomize: _charts_from_kustomization(
+                overlay, kustomization_file, kustomize
+            ),
+            section="helmCharts",
+        )
+    except FileNotFoundError:
+        raise OverlayNotFoundError(
+            f"Kustomization file {kustomization_file} does not exist."
+        ) from None
+    except yaml.YAMLError as e:
+        raise KustomizationError(
+            f"Kustomization file {kustomization_file} is invalid: {e}"
+        ) from e
+
+
+def _charts_from_kustomization(
+    overlay: str, kustomization_file: str, kustomize: dict
+) -> dict[str, dict]:
+    charts = {}
+    if "helmCharts" not in kustomize:
+        raise KustomizationError(
+            f"Overlay {overlay} ({kustomization_file}) does not have any charts."
+        )
+    for chart in kustomize["helmCharts"]:
+        if "name" not in chart:
+            raise KustomizationError(
+                f"Chart {chart} ({kustomization_file}) is missing the required 'name' field."
+            )
+        # Add the chart to the list of charts
+        charts[chart["name"]] = chart
+
+    # Validate that the charts have the required fields
+    if not validate_charts(charts):
+        raise KustomizationError(f"Overlay {overlay} has invalid charts.")
+
+    return charts
+
+
+# The overlay of a kustomization at the root of the deployment directory, as
+# returned by find_kustomization_dirs
+ROOT_OVERLAY = "."
+
+
+def is_overlay_pattern(overlay: str) -> bool:
+    """
+    Return whether an overlay is given as a glob pattern.
+    """
+    return any(character in overlay for character in "*?[")
+
+
+@functools.lru_cache(maxsize=None)
+def overlay_pattern_regex(pattern: str) -> "re.Pattern[str]":
+    """
+    Compile an overlay glob pattern to a regular expression matching overlay paths.
+
+    `*` and `?` match within a single directory name, `[...]` matches one of
+    the characters in the brackets and `**` matches any number of directories,
+    so `clusters/**/us-east-*` matches both `clusters/us-east-1` and
+    `clusters/prod/eks/us-east-2`.
+
+    Args:
+        pattern (str): The glob pattern.
+
+    Returns:
+        re.Pattern: The regular expression matching the whole overlay path.
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:[^/]+/)*")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and pattern.find("]", i + 2) != -1:
+            # A "]" right after the "[" is one of the characters
+            start, end = i + 1, pattern.find("]", i + 2)
+            characters = pattern[start:end]
+            if characters.startswith("!"):
+                characters = "^" + characters[1:]
+            parts.append("[" + characters.replace("\\", "\\\\") + "]")
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+
+    return re.compile("".join(parts) + r"\Z")
+
+
+def resolve_overlay_patterns(
+    images_to_update: list[dict], charts_to_update: list[dict], deployment_dir: str
+) -> tuple[list[dict], list[dict]]:
+    """
+    Expand the overlays and fromOverlay of the images and charts that are given as glob patterns.
+
+    - Each item of an `overlays` list can be a glob such as `env/prod-*` or
+      `clusters/**/us-east-*` (see `overlay_pattern_regex`), which expands to
+      every overlay (a directory with a kustomization.yaml) whose path matches.
+    - Instead of a list, `overlays` can be a single pattern, which only expands
+      to the matching overlays that declare an image or chart with the entry's
+      name. `"*"` expands to every overlay that declares it.
+    - `fromOverlay` can be a pattern that matches exactly one overlay.
+
+    An expanded pattern never includes the entry's fromOverlay, nor the
+    kustomization at the root of the deployment directory, which has to be
+    listed explicitly as `.` to be promoted into. A pattern that matches
+    nothing is an error. The overlays are discovered with a single walk of
+    the deployment directory, and the overlays declaring each image or chart
+    are looked up in the index of the deployment directory. Neither is done
+    unless a pattern needs it.
+
+    Args:
+        images_to_update (list): The list of images to update.
+        charts_to_update (list): The list of charts to update.
+        deployment_dir (str): The directory containing the overlays.
+
+    Returns:
+        tuple: The images and charts to update, with every `overlays` a list
+        of overlays and every fromOverlay an overlay.
+
+    Example Usage:
+        images, charts = resolve_overlay_patterns(
+            [{"name": "app1", "newTag": "v2", "overlays": ["env/*"]}], [], deployment_dir
+        )
+
+        print(images)
+        # Output: [{'name': 'app1', 'newTag': 'v2', 'overlays': ['env/dev', 'env/prod']}]
+    """
+    discovered: Optional[list[str]] = None
+    index: Optional[KustomizationIndex] = None
+
+    def expand(pattern: str) -> list[str]:
+        nonlocal discovered
+        if discovered is None:
+            with metrics.phase("discover_overlays"):
+                discovered = find_kustomization_dirs(deployment_dir)
+        regex = overlay_pattern_regex(pattern)
+        return [
+            overlay
+            for overlay in discovered
+            if overlay != ROOT_OVERLAY and regex.match(overlay)
+        ]
+
+    def declaring(entry: dict, section: str) -> list[str]:
+        nonlocal index
+        if index is None:
+            with metrics.phase("index"):
+                index = load_kustomization_index(deployment_dir)
+        if section == "images":
+            declared = index.find_images(entry["name"])
+        else:
+            declared = index.find_charts(entry["name"])
+        # Overlays can declare an image more than once, so keep the first of each
+        return list(
+            dict.fromkeys(
+                declaration["overlay"]
+                for declaration in declared
+                if declaration["name"] == entry["name"]
+            )
+        )
+
+    def resolve(entry: dict, section: str) -> dict:
+        kind = section[:-1]
+        resolved = dict(entry)
+
+        from_overlay = entry.get("fromOverlay")
+        if isinstance(from_overlay, str) and is_overlay_pattern(from_overlay):
+            matches = expand(from_overlay)
+            if len(matches) != 1:
+                raise ValidationError(
+                    f"The fromOverlay {from_overlay} of the {kind} {entry['name']} must match exactly one overlay, got {matches}."
+                )
+            resolved["fromOverlay"] = from_overlay = matches[0]
+
+        overlays = entry.get("overlays")
+        if isinstance(overlays, str):
+            regex = overlay_pattern_regex("**" if overlays == "*" else overlays)
+            matches = [
+                overlay
+                for overlay in declaring(entry, section)
+                if regex.match(overlay) and overlay not in (from_overlay, ROOT_OVERLAY)
+            ]
+            if not matches:
+                raise OverlayNotFoundError(
+                    f"No overlays matching {overlays} declare the {kind} {entry['name']}."
+                )
+            resolved["overlays"] = matches
+        elif isinstance(overlays, list) and any(
+            isinstance(overlay, str) and is_overlay_pattern(overlay)
+            for overlay in overlays
+        ):
+            expanded = []
+            for overlay in overlays:
+                if not is_overlay_pattern(overlay):
+                    expanded.append(overlay)
+                    continue
+                matches = [match for match in expand(overlay) if match != from_overlay]
+                if not matches:
+                    raise OverlayNotFoundError(
+                        f"The overlay pattern {overlay} of the {kind} {entry['name']} does not match any overlay."
+                    )
+                expanded += matches
+            resolved["overlays"] = list(dict.fromkeys(expanded))
+        else:
+            return resolved
+
+        logger.info(
+            f"Resolved the overlays {overlays} of the {kind} {entry['name']} to {', '.join(resolved['overlays'])}."
+        )
+        return resolved
+
+    return (
+        [resolve(image, "images") for image in images_to_update],
+        [resolve(chart, "charts") for chart in charts_to_update],
+    )
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ImagePromotion(NamedTuple):
+    """
+    An image to promote, parsed once from an entry of IMAGES_TO_UPDATE or of
+    the images of a kustomization.
+
+    Promotions are immutable tuples without a per-instance dict, so a single
+    promotion is shared by every overlay it targets instead of being copied
+    for each. The image and overlay names are interned, so the same names
+    repeated across thousands of entries are stored once.
+    """
+
+    name: str
+    new_name: Optional[str] = None
+    new_tag: Optional[str] = None
+    from_overlay: Optional[str] = None
+    from_ref: Optional[str] = None
+    overlays: tuple = ()
+
+    @classmethod
+    def from_dict(cls, image: dict) -> "ImagePromotion":
+        """
+        Parse an image that has already been validated with `validate_images`.
+        """
+        return cls(
+            _intern(image["name"]),
+            _intern(image.get("newName")),
+            image.get("newTag"),
+            _intern(image.get("fromOverlay")),
+            image.get("fromRef"),
+            tuple(_intern(overlay) for overlay in image.get("overlays", ())),
+        )
+
+    def kustomize_edit(self) -> tuple[str, dict]:
+        """
+        Return the `kustomize edit set image` argument that promotes the image,
+        and the image as it is recorded in the promotion manifest.
+
+        Raises:
+            ValueError: If the image has neither a name nor a newName.
+        """
+        new_name = self.name if self.new_name is None else self.new_name
+        if new_name and self.new_tag:
+            return f"{self.name}={new_name}:{self.new_tag}", {
+                "name": self.name,
+                "newName": new_name,
+                "newTag": self.new_tag,
+            }
+        if new_name:
+            return f"{self.name}={new_name}", {"name": self.name, "newName": new_name}
+        raise ValueError(f"Image {self.name} is missing required fields.")
+
+
+class ChartPromotion(NamedTuple):
+    """
+    A helm chart to promote, parsed once from an entry of CHARTS_TO_UPDATE or
+    of the helmCharts of a kustomization. See ImagePromotion.
+    """
+
+    name: str
+    version: Optional[str] = None
+    release_name: Optional[str] = None
+    from_overlay: Optional[str] = None
+    from_ref: Optional[str] = None
+    overlays: tuple = ()
+
+    @classmethod
+    def from_dict(cls, chart: dict) -> "ChartPromotion":
+        """
+        Parse a chart that has already been validated with `validate_charts`.
+        """
+        return cls(
+            _intern(chart["name"]),
+            chart.get("version"),
+            chart.get("releaseName"),
+            _intern(chart.get("fromOverlay")),
+            chart.get("fromRef"),
+            tuple(_intern(overlay) for overlay in chart.get("overlays", ())),
+        )
+
+
+class OverlayState(NamedTuple):
+    """
+    The images and charts to promote into an overlay, with every fromOverlay
+    already resolved.
+    """
+
+    images: tuple[ImagePromotion, ...]
+    charts: tuple[ChartPromotion, ...]
+
+
+def overlay_states(
+    images_to_update: list[ImagePromotion],
+    charts_to_update: list[ChartPromotion],
+    deployment_dir: str,
+) -> dict[str, OverlayState]:
+    """
+    Group the images and charts to update by the overlays they target.
+
+    Each fromOverlay is resolved once per entry, and the resolved promotion is
+    shared by all of the entry's overlays.
+
+    Args:
+        images_to_update (list): The images to update.
+        charts_to_update (list): The charts to update.
+        deployment_dir (str): The directory containing the overlays.
+
+    Returns:
+        dict: The state of each overlay, image overlays first, in the order
+        they were given.
+    """
+    # The images and charts of each overlay, collected before they are frozen
+    overlays: dict[str, tuple[list, list]] = {}
+
+    def state(overlay: str) -> tuple[list, list]:
+        if overlay not in overlays:
+            overlays[overlay] = ([], [])
+        return overlays[overlay]
+
+    for image in images_to_update:
+        resolved = image
+        if image.from_overlay is not None:
+            images = read_images_from_overlay(
+                image.from_overlay, deployment_dir, image.from_ref
+            )
+            if image.name not in images:
+                raise KustomizationError(
+                    f"Image {image.name} not found in {image.from_overlay}."
+                )
+            resolved = ImagePromotion.from_dict(images[image.name])
+        for overlay in image.overlays:
+            state(overlay)[0].append(resolved)
+
+    for chart in charts_to_update:
+        resolved_charts = [chart]
+        if chart.from_overlay is not None:
+            charts = read_charts_from_overlay(
+                chart.from_overlay, deployment_dir, chart.from_ref
+            )
+            resolved_charts = [
+                ChartPromotion.from_dict(overlay_chart)
+                for overlay_chart in charts.values()
+                if overlay_chart["name"] == chart.name
+            ]
+        for overlay in chart.overlays:
+            state(overlay)[1].extend(resolved_charts)
+
+    return {
+        overlay: OverlayState(tuple(images), tuple(charts))
+        for overlay, (images, charts) in overlays.items()
+    }
+
+
+def get_images_from_overlays(images_to_update, deployment_dir):
+    """
+    Get the list of images to update for each overlay.
+
+    Args:
+        images_to_update (list): The list of images to update, where each image is represented as a dictionary with the following keys:
+            - name (str): The name of the image.
+            - newName (str): The new name of the image.
+            - newTag (str): The new tag of the image.
+            - fromOverlay (str): The name of the overlay to get the image from.
+            - fromRef (str): The git revision to read the fromOverlay at.
+            - overlays (list): The list of overlays to update the image in.
+        deployment_dir (str): The directory containing the overlays.
+
+    Returns:
+        dict: A dictionary mapping overlays to the list of images to update for each overlay.
+    """
+    overlays_to_images = {}
+    for image in images_to_update:
+        # Add the image to the list of images for each env
+        for overlay in image["overlays"]:
+            if overlay not in overlays_to_images:
+                overlays_to_images[overlay] = []
+            # If the image has a fromOverlay, get the image from that overlay
+            if "fromOverlay" in image:
+                images = read_images_from_overlay(
+                    image["fromOverlay"], deployment_dir, image.get("fromRef")
+                )
+                overlays_to_images[overlay].append(images[image["name"]])
+            else:
+                overlays_to_images[overlay].append(image)
+
+    return overlays_to_images
+
+
+def get_charts_from_overlays(charts_to_update, deployment_dir):
+    """
+    Get the list of charts to update for each overlay.
+
+    Args:
+        charts_to_update (list): The list of charts to update, where each chart is represented as a dictionary with the following keys:
+            - name (str): The name of the chart.
+            - version (str): The new version of the chart.
+            - overlays (list): The list of overlays to update the chart in.
+        deployment_dir (str): The directory containing the overlays.
+
+    Returns:
+        dict: A dictionary mapping overlays to the list of charts to update for each overlay.
+    """
+    overlays_to_charts = {}
+    for chart in charts_to_update:
+        # Add the chart to the list of charts for each overlay
+        for overlay in chart["overlays"]:
+            if overlay not in overlays_to_charts:
+                overlays_to_charts[overlay] = []
+
+            if "fromOverlay" in chart:
+                charts = read_charts_from_overlay(
+                    chart["fromOverlay"], deployment_dir, chart.get("fromRef")
+                )
+                logger.debug(charts)
+                for overlayChart in charts.values():
+                    logger.debug(overlayChart)
+                    if overlayChart["name"] == chart["name"]:
+                        overlays_to_charts[overlay].append(overlayChart)
+            else:
+                overlays_to_charts[overlay].append(chart)
+
+    return overlays_to_charts
+
+
+def generate_kustomize_args(
+    overlay: str, images: list, promotion_manifest: dict
+) -> tuple[list[str], dict]:
+    """
+    Generate the arguments to pass to the `kustomize edit set image` command for a given overlay and list of images.
+    It also updates the promotion manifest with the images that are being passed to `kustomize`.
+
+    Args:
+        overlay (str): The overlay to generate the kustomize arguments for.
+        images (list): The list of images to generate the kustomize arguments for.
+        promotion_manifest (dict): The promotion manifest to add the images to.
+
+    Returns:
+        tuple: A tuple containing the generated kustomize arguments (list) and the updated promotion manifest (dict).
+
+    Example Usage:
+        overlay = "dev"
+        images = [
+            {"name": "app1", "newName": "new-app1", "newTag": "v2"},
+            {"name": "app2", "newName": "new-app2"},
+            {"name": "app3"}
+        ]
+        promotion_manifest = {}
+
+        kustomize_args, updated_manifest = generate_kustomize_args(overlay, images, promotion_manifest)
+
+        print(kustomize_args)
+        # Output: ['app1=new-app1:v2', 'app2=new-app2', 'app3=app3']
+
+        print(updated_manifest)
+        # Output: {'dev': {'images': [{'name': 'app1', 'newName': 'new-app1', 'newTag': 'v2'}, {'name': 'app2', 'newName': 'new-app2'}, {'name': 'app3'}]}}
+    """
+
+    kustomize_args = []
+    for image in images:
+        if not isinstance(image, ImagePromotion):
+            image = ImagePromotion.from_dict(image)
+        if overlay not in promotion_manifest:
+            promotion_manifest[overlay] = {}
+        if "images" not in promotion_manifest[overlay]:
+            promotion_manifest[overlay]["images"] = []
+
+        kustomize_arg, manifest_image = image.kustomize_edit()
+        kustomize_args.append(kustomize_arg)
+        promotion_manifest[overlay]["images"].append(manifest_image)
+
+    return kustomize_args, promotion_manifest
+
+
+def parse_kustomize_image_arg(arg: str) -> dict[str, str]:
+    """
+    Parse an argument to `kustomize edit set image` into an image entry.
+
+    Args:
+        arg (str): The argument, in one of the forms accepted by kustomize:
+            `name=newName`, `name=newName:newTag`, `name=newName@digest`,
+            `name:newTag` or `name@digest`.
+
+    Returns:
+        dict: The image entry, containing only the fields that were set.
+
+    Raises:
+        ValueError: If the argument is not a valid image argument.
+
+    Example Usage:
+        parse_kustomize_image_arg("app1=new-app1:v2")
+        # Output: {'name': 'app1', 'newName': 'new-app1', 'newTag': 'v2'}
+    """
+    name, separator, overwrite = arg.partition("=")
+    if not separator:
+        overwrite = arg
+
+    image = {}
+    if "@" in overwrite:
+        image_name, _, image["digest"] = overwrite.partition("@")
+    elif match := IMAGE_TAG_PATTERN.match(overwrite):
+        image_name, image["newTag"] = match.group(1), match.group(2)
+    elif overwrite and separator:
+        image_name = overwrite
+    else:
+        raise ValueError(f"Invalid image argument: {arg}")
+
+    if separator:
+        image["name"] = name
+        image["newName"] = image_name
+    else:
+        image["name"] = image_name
+
+    if not image["name"]:
+        raise ValueError(f"Invalid image argument: {arg}")
+
+    return image
+
+
+def set_kustomization_images(kustomization: dict, kustomize_args: list[str]) -> dict:
+    """
+    Apply `kustomize edit set image` to a parsed kustomization in-process.
+
+    Images that are already declared in the kustomization are updated, keeping
+    their newName if the argument does not set one and their newTag/digest if
+    the argument sets neither (or sets them to `*`). Images that are not
+    declared yet are added. As with kustomize, the images are sorted by name.
+
+    Args:
+        kustomization (dict): The parsed kustomization.yaml, updated in place.
+        kustomize_args (list): The arguments that would be passed to
+            `kustomize edit set image`, as generated by `generate_kustomize_args`.
+
+    Returns:
+        dict: The updated kustomization.
+
+    Raises:
+        ValueError: If one of the arguments is not a valid image argument.
+    """
+    updates = {}
+    for arg in kustomize_args:
+        image = parse_kustomize_image_arg(arg)
+        updates[image["name"]] = image
+
+    images = {}
+    for existing in kustomization.get("images") or []:
+        name = existing.get("name")
+        update = updates.pop(name, None)
+        if update is None:
+            images[name] = existing
+            continue
+
+        image = dict(existing)
+        if update.get("newName"):
+            image["newName"] = update["newName"]
+        tag, digest = update.get("newTag"), update.get("digest")
+        if tag or digest:
+            image.pop("newTag", None)
+            image.pop("digest", None)
+            if tag and tag != "*":
+                image["newTag"] = tag
+            elif tag == "*" and "newTag" in existing:
+                image["newTag"] = existing["newTag"]
+            if digest and digest != "*":
+                image["digest"] = digest
+            elif digest == "*" and "digest" in existing:
+                image["digest"] = existing["digest"]
+        images[name] = image
+
+    for name, update in updates.items():
+        images[name] = {
+            field: update[field]
+            for field in IMAGE_FIELDS
+            if update.get(field) and update[field] != "*"
+        }
+
+    kustomization["images"] = [
+        _order_image_fields(images[name])
+        for name in sorted(images, key=lambda name: str(name))
+    ]
+
+    return kustomization
+
+
+def splice_kustomization_images(editor: SpanEditor, kustomize_args: list[str]) -> bool:
+    """
+    Apply `kustomize edit set image` to a kustomization by splicing the new
+    values into its text, if the edit only changes fields that are already set.
+
+    Args:
+        editor (SpanEditor): The editor for the kustomization.yaml file.
+        kustomize_args (list): The arguments that would be passed to
+            `kustomize edit set image`, as generated by `generate_kustomize_args`.
+
+    Returns:
+        bool: True if the edit was spliced, False if it adds or removes images
+        or fields (or reorders the images), in which case it must be applied
+        with `set_kustomization_images` instead.
+
+    Raises:
+        ValueError: If one of the arguments is not a valid image argument.
+    """
+    current = editor.entries("images")
+    if current is None:
+        return False
+    desired = set_kustomization_images({"images": current}, kustomize_args)["images"]
+    if [(image.get("name"), set(image)) for image in desired] != [
+        (image.get("name"), set(image)) for image in current
+    ]:
+        return False
+
+    for i, image in enumerate(desired):
+        for field, value in image.items():
+            editor.set("images", i, field, value)
+
+    return True
+
+
+def _order_image_fields(image: dict) -> dict:
+    ordered = {field: image[field] for field in IMAGE_FIELDS if field in image}
+    ordered.update(image)
+    return ordered
+
+
+def get_image_backend() -> str:
+    """
+    Get the backend used to update images from the PROMOTE_IMAGE_BACKEND env variable.
+
+    Returns:
+        str: Either kustomize (the default) or native.
+    """
+    backend = os.getenv("PROMOTE_IMAGE_BACKEND") or "kustomize"
+    if backend not in IMAGE_BACKENDS:
+        raise ValidationError(
+            f"Unknown image backend {backend}. Valid backends are: {', '.join(IMAGE_BACKENDS)}."
+        )
+
+    return backend
+
+
+def update_kustomize_images(
+    env: str,
+    deployment_dir: str,
+    images: list,
+    promotion_manifest: dict,
+    backend: str = "kustomize",
+) -> dict[str, dict[str, list]]:
+    """
+    Uses kustomize to update the images for the given environment.
+
+    Args:
+        env (str): The environment to update the images for.
+        deployment_dir (str): The directory containing the kustomize directories.
+        images (list): The list of images to update.
+        promotion_manifest (dict): The promotion manifest to add the images to.
+        backend (str): kustomize to run `kustomize edit set image`, or native to
+            apply the same edit to the kustomization.yaml in-process.
+
+    Returns:
+        dict: The updated promotion manifest.
+    """
+    return update_kustomize_overlay(
+        env, deployment_dir, images, [], promotion_manifest, backend
+    )
+
+
+def update_kustomize_charts(
+    overlay: str, deployment_dir: str, charts: list, promotion_manifest: dict
+) -> dict:
+    """
+    Update the charts in a kustomization.yaml file for a specific overlay in a deployment directory.
+
+    Args:
+        overlay (str): The name of the overlay for which the charts need to be updated.
+        deployment_dir (str): The path to the deployment directory.
+        charts (list): A list of dictionaries containing the name and version of the charts to be updated.
+        promotion_manifest (dict): A dictionary to store the promotion manifest.
+
+    Returns:
+        dict: The updated promotion manifest containing the updated charts for the overlay.
+    """
+    return update_kustomize_overlay(
+        overlay, deployment_dir, [], charts, promotion_manifest
+    )
+
+
+def update_kustomize_overlay(
+    overlay: str,
+    deployment_dir: str,
+    images: list,
+    charts: list,
+    promotion_manifest: dict,
+    backend: str = "kustomize",
+) -> dict:
+    """
+    Update the images and charts of an overlay with a single read and write of
+    its kustomization.yaml file.
+
+    Args:
+        overlay (str): The overlay to update.
+        deployment_dir (str): The directory containing the overlays.
+        images (list): The list of images to update in the overlay.
+        charts (list): The list of charts to update in the overlay.
+        promotion_manifest (dict): The promotion manifest to add the images and charts to.
+        backend (str): kustomize to run `kustomize edit set image`, or native to
+            apply the same edit to the kustomization.yaml in-process.
+
+    Returns:
+        dict: The updated promotion manifest.
+    """
+    edits = plan_overlay(
+        overlay,
+        deployment_dir,
+        [ImagePromotion.from_dict(image) for image in images],
+        [ChartPromotion.from_dict(chart) for chart in charts],
+    )
+    return merge_manifests(
+        promotion_manifest, apply_overlay_plan(overlay, deployment_dir, edits, backend)
+    )
+
+
+def promotion_input_hash(images_to_update: list, charts_to_update: list) -> str:
+    """
+    Hash the promotion input, so that plans can be cached and looked up by it.
+
+    Args:
+        images_to_update (list): The list of images to update.
+        charts_to_update (list): The list of charts to update.
+
+    Returns:
+        str: The hex digest of the SHA-256 hash of the input.
+    """
+    canonical = json.dumps(
+        {"images": images_to_update, "charts": charts_to_update},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def plan_promotion(
+    images_to_update: list, charts_to_update: list, deployment_dir: str
+) -> dict:
+    """
+    Plan the promotion of the given images and charts without changing any files.
+
+    All fromOverlay references are resolved, and each target overlay is mapped
+    to the ordered list of edits that will be applied to it, together with the
+    values before and after each edit. The plan only contains JSON types, so it
+    can be written to a file, cached by its inputHash, diffed and applied later
+    with `apply_plan`.
+
+    Args:
+        images_to_update (list): The list of images to update.
+        charts_to_update (list): The list of charts to update.
+        deployment_dir (str): The directory containing the overlays.
+
+    Returns:
+        dict: The promotion plan.
+
+    Example Usage:
+        plan = plan_promotion(
+            [{"name": "app1", "newTag": "v2", "overlays": ["dev"]}], [], deployment_dir
+        )
+
+        print(plan)
+        # Output: {'version': 1, 'inputHash': '...', 'overlays': {'dev': [
+        #     {'kind': 'image', 'name': 'app1', 'set': {'newName': 'app1', 'newTag': 'v2'},
+        #      'before': {'newTag': 'v1'}, 'after': {'newName': 'app1', 'newTag': 'v2'}}
+        # ]}}
+    """
+    # Resolve the overlays given as patterns, keeping the inputs for the hash
+    resolved_images, resolved_charts = resolve_overlay_patterns(
+        images_to_update, charts_to_update, deployment_dir
+    )
+
+    # Parse the entries once, and share them between the overlays they target
+    images = [ImagePromotion.from_dict(image) for image in resolved_images]
+    charts = [ChartPromotion.from_dict(chart) for chart in resolved_charts]
+
+    # Group the images and charts by overlay, so that each overlay is read and
+    # written once even if it receives both images and charts.
+    with metrics.phase("resolve_from_overlay"):
+        states = overlay_states(images, charts, deployment_dir)
+
+    overlays = {}
+    for overlay, state in states.items():
+        overlays[overlay] = plan_overlay(
+            overlay, deployment_dir, state.images, state.charts
+        )
+
+    return {
+        "version": PLAN_VERSION,
+        "inputHash": promotion_input_hash(images_to_update, charts_to_update),
+        "overlays": overlays,
+    }
+
+
+def plan_overlay(
+    overlay: str,
+    deployment_dir: str,
+    images: Sequence[ImagePromotion],
+    charts: Sequence[ChartPromotion],
+) -> list[dict]:
+    """
+    Plan the edits that update the given images and charts in an overlay.
+
+    Args:
+        overlay (str): The overlay to update.
+        deployment_dir (str): The directory containing the overlays.
+        images (list): The list of images to update in the overlay, with any
+            fromOverlay already resolved.
+        charts (list): The list of charts to update in the overlay, with any
+            fromOverlay already resolved.
+
+    Returns:
+        list: The edits to apply to the overlay, images first.
+    """
+    kustomize_dir = os.path.join(deployment_dir, overlay)
+    kustomization_path = os.path.join(kustomize_dir, "kustomization.yaml")
+
+    # Validate that the kustomize directory for the overlay exists
+    if not os.path.isdir(kustomize_dir):
+        raise OverlayNotFoundError(
+            f"Kustomize directory for {overlay} does not exist. ({kustomize_dir})"
+        )
+
+    edits = []
+    current_images, helm_charts = {}, None
+    try:
+        if images:
+            declared = read_kustomization_entries(kustomization_path, "images") or []
+            current_images = {image.get("name"): image for image in declared}
+        for image in images:
+            kustomize_arg, manifest_image = image.kustomize_edit()
+            before = current_images.get(image.name)
+            after = set_kustomization_images(
+                {"images": [before] if before else []}, [kustomize_arg]
+            )["images"][0]
+            edits.append(
+                {
+                    "kind": "image",
+                    "name": image.name,
+                    "set": _without_name(manifest_image),
+                    "before": _without_name(before) if before else None,
+                    "after": _without_name(after),
+                }
+            )
+
+        if charts:
+            helm_charts = read_kustomization_entries(kustomization_path, "helmCharts")
+    except FileNotFoundError:
+        raise OverlayNotFoundError(
+            f"Kustomization file {kustomization_path} does not exist."
+        ) from None
+    except (yaml.YAMLError, ValueError) as e:
+        raise KustomizationError(
+            f"Kustomization file {kustomization_path} is invalid: {e}"
+        ) from e
+
+    # If the helmCharts key is not present, fail
+    if charts and helm_charts is None:
+        raise ChartNotFoundError(f"helmCharts key not found in {kustomization_path}.")
+
+    # Using the existing kustomization file, find the charts to update
+    for chart in charts:
+        logger.debug(chart)
+        found = False
+
+        # Search kustomize["helmCharts"] for the chart
+        for i, helm_chart in enumerate(helm_charts or []):
+            if helm_chart.get("name") == chart.name:
+                found = True
+                edit: dict[str, Any] = {
+                    "kind": "chart",
+                    "name": chart.name,
+                    "index": i,
+                    "set": {"version": chart.version},
+                    "before": {"version": helm_chart.get("version")},
+                    "after": {"version": chart.version},
+                }
+                if chart.release_name is not None:
+                    edit["releaseName"] = chart.release_name
+                edits.append(edit)
+
+        if not found:
+            raise ChartNotFoundError(
+                f"Chart {chart.name} not found in {kustomization_path}."
+            )
 
+    return edits
 
-def find_duplicates(images: list, field: str) -> set:
+
+def read_kustomization_entries(
+    kustomization_path: str, section: str
+) -> Optional[list[dict]]:
     """
-    Find duplicate values for a specified field in a list of images.
+    Read the image or chart fields of the entries of a kustomization section.
 
     Args:
-        images (list): The list of images to check for duplicates.
-        field (str): The field name to check for duplicates.
+        kustomization_path (str): The path to the kustomization.yaml file.
+        section (str): images or helmCharts.
 
     Returns:
-        set: A set containing the duplicate values for the specified field.
+        list: For each entry, its fields listed in SPAN_FIELDS, or None if the
+        section is not declared.
+
+    Raises:
+        FileNotFoundError: If the kustomization.yaml file does not exist.
+        yaml.YAMLError: If the kustomization.yaml file is invalid.
     """
-    duplicates = set()
-    image_names = [image[field] for image in images if field in image]
-    seen = set()
-    for image_name in image_names:
-        if image_name in seen:
-            duplicates.add(image_name)
-        else:
-            seen.add(image_name)
+    entries = kustomization_cache.splice(kustomization_path).entries(section)
+    if entries is not None:
+        return entries
 
-    return duplicates
+    entries = (kustomization_cache.load(kustomization_path) or {}).get(section)
+    if entries is None:
+        return None
+    return [
+        {
+            field: entry[field]
+            for field in SPAN_FIELDS[section]
+            if isinstance(entry, dict) and field in entry
+        }
+        for entry in entries
+    ]
 
 
-def validate_images(images):
+def _without_name(entry: dict) -> dict:
+    return {field: value for field, value in entry.items() if field != "name"}
+
+
+class StagedWrites:
     """
-    Validate a list of images to ensure they have the required fields and that the names and newNames are unique.
+    The new contents of the kustomization files of a promotion, written together
+    once every overlay has been updated.
 
-    Args:
-        images (list): The list of images to validate.
+    The files are only replaced, each with a rename of a temporary file in the
+    same directory, after all of them have been written, so that a promotion
+    that fails partway leaves the deployment directory untouched rather than
+    half-promoted. Files whose contents did not change are not rewritten.
 
-    Returns:
-        bool: True if all images are valid, False otherwise.
+    Example Usage:
+        staged = StagedWrites()
+        staged.stage("env/dev/kustomization.yaml", contents)
+        staged.commit()
     """
-    originally_dict = False
-    # Convert to list if it is a dict (which is the case when we are validating
-    # images from a promotion file)
-    if isinstance(images, dict):
-        originally_dict = True
-        images = list(images.values())
 
-    # Ensure that all image names are unique
-    duplicates = find_duplicates(images, "name")
-    if len(duplicates) > 0:
-        logger.fatal(
-            f"Found duplicate image names: {' '.join(duplicates)}. Images must have unique names."
-        )
-        sys.exit(1)
+    def __init__(self):
+        self.contents: dict[str, str] = {}
+        self.lock = threading.Lock()
 
-    # Ensure that all image newNames are unique
-    duplicates = find_duplicates(images, "newName")
-    if len(duplicates) > 0:
-        logger.fatal(
-            f"Found duplicate image newNames: {' '.join(duplicates)}. Image newNames must have unique names."
-        )
-        sys.exit(1)
+    def stage(self, path: str, contents: str) -> None:
+        """
+        Stage the new contents of a file.
 
-    for image in images:
-        # Validate that the image has the required fields
-        if "name" not in image:
-            logger.fatal(f"Image {image} is missing the required 'name' field.")
-            return False
-        if "fromOverlay" in image:
-            if "newName" in image:
-                logger.fatal(
-                    f"Image {image} cannot set newName when fromOverlay is set."
-                )
-                return False
-            if "newTag" in image:
-                logger.fatal(
-                    f"Image {image} cannot set newTag when fromOverlay is set."
-                )
-                return False
-        else:
-            if ("newTag" not in image) and ("newName" not in image):
-                logger.fatal(f"Image {image} must set newName, newTag or both.")
-                return False
-        # Validate that the image has the required fields if it was not a dict,
-        # which means that it is coming from a promotion file and not from a
-        # kustomization.yaml file.
-        if not originally_dict and "overlays" not in image:
-            logger.fatal(f"Image {image} is missing the required 'overlays' field.")
-            return False
+        Args:
+            path (str): The path of the file.
+            contents (str): Its new contents.
+        """
+        with self.lock:
+            self.contents[path] = contents
 
-    return True
+    def commit(self) -> list[str]:
+        """
+        Write the staged files whose contents changed.
 
+        Returns:
+            list: The paths of the files that were written.
 
-def validate_charts(charts):
+        Raises:
+            OSError: If a file cannot be written, in which case none of them are.
+        """
+        with self.lock:
+            staged, self.contents = self.contents, {}
+
+        temporaries = {}
+        try:
+            for path, contents in staged.items():
+                if kustomization_cache.text(path) == contents:
+                    continue
+                # Replace the file a symlink points to, rather than the symlink
+                path = os.path.realpath(path)
+                temporary = f"{path}.{os.getpid()}.tmp"
+                with open(temporary, "w") as f:
+                    f.write(contents)
+                os.chmod(temporary, stat.S_IMODE(os.stat(path).st_mode))
+                temporaries[path] = temporary
+                metrics.count("bytes_written", len(contents.encode()))
+        except OSError:
+            for temporary in temporaries.values():
+                with contextlib.suppress(OSError):
+                    os.remove(temporary)
+            raise
+
+        for path, temporary in temporaries.items():
+            os.replace(temporary, path)
+            kustomization_cache.invalidate(path)
+            metrics.count("files_written")
+
+        return list(temporaries)
+
+
+def apply_overlay_plan(
+    overlay: str,
+    deployment_dir: str,
+    edits: list[dict],
+    backend: str = "kustomize",
+    staged: Optional[StagedWrites] = None,
+) -> dict:
     """
-    Validate that the charts to update have the required fields.
+    Apply the planned edits to an overlay.
+
+    The values before each edit are checked against the kustomization.yaml
+    first, so that a plan that was made against a different version of the
+    overlay is not applied. Edits that have already been applied (e.g. by a
+    previous attempt) are accepted as they are.
 
     Args:
-        charts (list): The list of charts to update.
+        overlay (str): The overlay to update.
+        deployment_dir (str): The directory containing the overlays.
+        edits (list): The edits planned for the overlay by `plan_overlay`.
+        backend (str): kustomize to run `kustomize edit set image`, or native to
+            apply the same edit to the kustomization.yaml in-process.
+        staged (StagedWrites): Stage the new kustomization.yaml here, to be
+            written together with the other overlays, rather than writing it
+            straight away.
 
     Returns:
-        bool: True if all charts are valid, False otherwise.
+        dict: The promotion manifest for the overlay.
     """
-    originally_dict = False
-    # Convert to list if it is a dict (which is the case when we are validating
-    # charts from a promotion file)
-    if isinstance(charts, dict):
-        originally_dict = True
-        charts = list(charts.values())
+    kustomize_dir = os.path.join(deployment_dir, overlay)
+    kustomization_path = os.path.join(kustomize_dir, "kustomization.yaml")
 
-    # Ensure that all chart names are unique
-    duplicates = find_duplicates(charts, "name")
-    if len(duplicates) > 0:
-        logger.fatal(
-            f"Found duplicate chart names: {' '.join(duplicates)}. Charts must have unique names."
-        )
-        sys.exit(1)
+    image_edits = [edit for edit in edits if edit["kind"] == "image"]
+    chart_edits = [edit for edit in edits if edit["kind"] == "chart"]
+    if image_edits:
+        logger.info(f"Updating images for {overlay}...")
+    if chart_edits:
+        logger.info(f"Updating charts for {overlay}...")
 
-    for chart in charts:
-        # Validate that the chart has the required fields
-        if "name" not in chart:
-            logger.fatal(f"Chart {chart} is missing the required 'name' field.")
-            return False
-        if "fromOverlay" in chart:
-            if "version" in chart:
-                logger.fatal(
-                    f"Chart {chart} cannot set version when fromOverlay is set."
-                )
-                return False
+    try:
+        applied = check_overlay_plan(kustomization_path, edits)
+    except FileNotFoundError:
+        raise OverlayNotFoundError(
+            f"Kustomization file {kustomization_path} does not exist."
+        ) from None
+    except (yaml.YAMLError, ValueError) as e:
+        raise KustomizationError(f"Cannot apply the plan for {overlay}: {e}") from e
+
+    # Leave an overlay that is already up to date alone, without running
+    # kustomize or rewriting the file
+    if applied:
+        logger.info(f"{overlay} is already up to date.")
+        return manifest_from_plan({"overlays": {overlay: edits}})
+
+    kustomize_args = [
+        ImagePromotion(
+            edit["name"], edit["set"].get("newName"), edit["set"].get("newTag")
+        ).kustomize_edit()[0]
+        for edit in image_edits
+    ]
+
+    chart_versions = [(edit["index"], edit["set"]["version"]) for edit in chart_edits]
+    contents: Optional[str]
+    try:
+        if kustomize_args and backend == "kustomize":
+            contents = edit_kustomization_with_kustomize(
+                overlay, kustomization_path, kustomize_args, chart_versions
+            )
         else:
-            if "version" not in chart:
-                logger.fatal(f"Chart {chart} must set version.")
-                return False
-        # Validate that the chart has the required fields if it was not a dict,
-        # which means that it is coming from a promotion file and not from a
-        # kustomization.yaml file.
-        if not originally_dict and "overlays" not in chart:
-            logger.fatal(f"Chart {chart} is missing the required 'overlays' field.")
-            return False
-
-    return True
-
-
-def read_images_from_overlay(overlay: str, deployment_dir: str) -> dict[str, dict]:
+            contents = edit_kustomization(
+                kustomization_path, kustomize_args, chart_versions
+            )
+    except (OSError, yaml.YAMLError, ValueError) as e:
+        raise KustomizationError(f"Failed to update {overlay}: {e}") from e
+
+    # Stage the updated kustomization file, writing it now if there is nothing
+    # else to write it with
+    if contents is not None:
+        writes = staged if staged is not None else StagedWrites()
+        writes.stage(kustomization_path, contents)
+        if staged is None:
+            try:
+                writes.commit()
+            except OSError as e:
+                raise PromotionError(
+                    f"Failed to write {kustomization_path}: {e}"
+                ) from e
+
+    return manifest_from_plan({"overlays": {overlay: edits}})
+
+
+def edit_kustomization_with_kustomize(
+    overlay: str,
+    kustomization_path: str,
+    kustomize_args: list[str],
+    chart_versions: list[tuple[int, str]],
+) -> str:
     """
-    Read the images from the specified overlay in a deployment directory and return a dictionary mapping image names to their corresponding image dictionaries.
+    Apply image and chart edits to a copy of a kustomization.yaml file, running
+    `kustomize edit set image` for the images.
+
+    kustomize edits the file in place, so it is run on a copy in a temporary
+    directory, leaving the original to be replaced by `StagedWrites`.
 
     Args:
-        overlay (str): The name of the overlay to read the images from.
-        deployment_dir (str): The directory containing the overlays.
+        overlay (str): The overlay of the kustomization.yaml file.
+        kustomization_path (str): The path to the kustomization.yaml file.
+        kustomize_args (list): The arguments to pass to `kustomize edit set image`.
+        chart_versions (list): The index of each helmCharts entry to update and
+            its new version.
 
     Returns:
-        dict: A dictionary mapping image names to their corresponding image dictionaries.
+        str: The new contents of the file.
     """
-    images = {}
-    kustomization_file = os.path.join(deployment_dir, overlay, "kustomization.yaml")
-    try:
-        # Open the kustomization.yaml file for the overlay
-        with open(kustomization_file) as f:
-            # Read the images from the kustomization.yaml file
-            kustomize = yaml.safe_load(f)
-            if "images" not in kustomize:
-                logger.fatal(
-                    f"Overlay {overlay} ({kustomization_file}) does not have any images."
-                )
-                sys.exit(1)
-            for image in kustomize["images"]:
-                if "name" not in image:
-                    logger.fatal(
-                        f"Image {image} ({kustomization_file}) is missing the required 'name' field."
-                    )
-                    sys.exit(1)
-                # Add the image to the list of images
-                images[image["name"]] = image
-    except FileNotFoundError:
-        logger.fatal(f"Kustomization file {kustomization_file} does not exist.")
-        sys.exit(1)
-    except yaml.YAMLError as e:
-        logger.fatal(f"Kustomization file {kustomization_file} is invalid: {e}")
-        sys.exit(1)
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch_path = os.path.join(scratch, "kustomization.yaml")
+        with open(scratch_path, "w") as f:
+            f.write(kustomization_cache.text(kustomization_path))
 
-    # Validate that the images have the required fields
-    if not validate_images(images):
-        logger.fatal(f"Overlay {overlay} has invalid images.")
-        sys.exit(1)
+        # Run the kustomize edit set image command, failing the script if it fails
+        try:
+            run(["kustomize", "edit", "set", "image", *kustomize_args], scratch)
+        except subprocess.CalledProcessError:
+            raise CommandError(f"Failed to update images in {overlay}.") from None
 
-    return images
+        try:
+            contents = edit_kustomization(scratch_path, [], chart_versions)
+            if contents is None:
+                contents = kustomization_cache.text(scratch_path)
+        finally:
+            kustomization_cache.invalidate(scratch_path)
+
+    return contents
 
 
-def read_charts_from_overlay(overlay: str, deployment_dir: str) -> dict[str, dict]:
+def check_overlay_plan(kustomization_path: str, edits: list[dict]) -> bool:
     """
-    Read the charts from the specified overlay by opening the kustomization.yaml file of the overlay and extracting the chart information.
+    Check that the planned edits of an overlay can be applied to its current
+    kustomization.yaml.
 
     Args:
-        overlay (str): The name of the overlay to read the charts from.
-        deployment_dir (str): The directory path containing the overlays.
+        kustomization_path (str): The path to the kustomization.yaml file.
+        edits (list): The edits planned for the overlay by `plan_overlay`.
 
     Returns:
-        dict: A dictionary mapping chart names to the chart dictionary.
+        bool: True if every edit has already been applied, so that there is
+        nothing left to change.
 
     Raises:
-        FileNotFoundError: If the kustomization.yaml file does not exist.
-        yaml.YAMLError: If the kustomization.yaml file is invalid.
+        ValueError: If the current value of an edited field is neither the
+            planned value before nor after the edit.
     """
-    charts = {}
-    kustomization_file = os.path.join(deployment_dir, overlay, "kustomization.yaml")
-    try:
-        # Open the kustomization.yaml file for the overlay
-        with open(kustomization_file) as f:
-            # Read the charts from the kustomization.yaml file
-            kustomize = yaml.safe_load(f)
-            if "helmCharts" not in kustomize:
-                logger.fatal(
-                    f"Overlay {overlay} ({kustomization_file}) does not have any charts."
+    images, charts = {}, []
+    if any(edit["kind"] == "image" for edit in edits):
+        for image in read_kustomization_entries(kustomization_path, "images") or []:
+            images[image.get("name")] = _without_name(image)
+    if any(edit["kind"] == "chart" for edit in edits):
+        charts = read_kustomization_entries(kustomization_path, "helmCharts") or []
+
+    applied = True
+    for edit in edits:
+        if edit["kind"] == "image":
+            current = images.get(edit["name"])
+        else:
+            chart = charts[edit["index"]] if edit["index"] < len(charts) else {}
+            if chart.get("name") != edit["name"]:
+                raise ValueError(
+                    f"chart {edit['name']} is no longer at the planned index"
                 )
-                sys.exit(1)
-            for chart in kustomize["helmCharts"]:
-                if "name" not in chart:
-                    logger.fatal(
-                        f"Chart {chart} ({kustomization_file}) is missing the required 'name' field."
-                    )
-                    sys.exit(1)
-                # Add the chart to the list of charts
-                charts[chart["name"]] = chart
-    except FileNotFoundError:
-        logger.fatal(f"Kustomization file {kustomization_file} does not exist.")
-        sys.exit(1)
-    except yaml.YAMLError as e:
-        logger.fatal(f"Kustomization file {kustomization_file} is invalid: {e}")
-        sys.exit(1)
-
-    # Validate that the charts have the required fields
-    if not validate_charts(charts):
-        logger.fatal(f"Overlay {overlay} has invalid charts.")
-        sys.exit(1)
+            current = {"version": chart.get("version")}
+        if current != edit["after"]:
+            if current != edit["before"]:
+                raise ValueError(
+                    f"{edit['kind']} {edit['name']} is {current}, but the plan expected {edit['before']}"
+                )
+            applied = False
 
-    return charts
+    return applied
 
 
-def get_images_from_overlays(images_to_update, deployment_dir):
+def manifest_from_plan(plan: dict) -> dict:
     """
-    Get the list of images to update for each overlay.
+    Build the promotion manifest of a plan.
 
     Args:
-        images_to_update (list): The list of images to update, where each image is represented as a dictionary with the following keys:
-            - name (str): The name of the image.
-            - newName (str): The new name of the image.
-            - newTag (str): The new tag of the image.
-            - fromOverlay (str): The name of the overlay to get the image from.
-            - overlays (list): The list of overlays to update the image in.
-        deployment_dir (str): The directory containing the overlays.
+        plan (dict): The promotion plan, as returned by `plan_promotion`.
 
     Returns:
-        dict: A dictionary mapping overlays to the list of images to update for each overlay.
+        dict: A dictionary mapping each overlay to the images and charts that
+        are promoted to it.
     """
-    overlays_to_images = {}
-    for image in images_to_update:
-        # Add the image to the list of images for each env
-        for overlay in image["overlays"]:
-            if overlay not in overlays_to_images:
-                overlays_to_images[overlay] = []
-            # If the image has a fromOverlay, get the image from that overlay
-            if "fromOverlay" in image:
-                images = read_images_from_overlay(image["fromOverlay"], deployment_dir)
-                overlays_to_images[overlay].append(images[image["name"]])
-            else:
-                overlays_to_images[overlay].append(image)
+    promotion_manifest: dict = {}
+    for overlay, edits in plan["overlays"].items():
+        for edit in edits:
+            entry = {"name": edit["name"], **edit["set"]}
+            if "releaseName" in edit:
+                entry["releaseName"] = edit["releaseName"]
+            section = "images" if edit["kind"] == "image" else "charts"
+            promotion_manifest.setdefault(overlay, {}).setdefault(section, [])
+            promotion_manifest[overlay][section].append(entry)
 
-    return overlays_to_images
+    return promotion_manifest
 
 
-def get_charts_from_overlays(charts_to_update, deployment_dir):
+def changed_overlays(plan: dict) -> list[str]:
     """
-    Get the list of charts to update for each overlay.
+    List the overlays that a promotion plan changes.
+
+    An overlay is unchanged if every edit planned for it sets the values that
+    it already has, e.g. when a promotion is retried or triggered twice.
 
     Args:
-        charts_to_update (list): The list of charts to update, where each chart is represented as a dictionary with the following keys:
-            - name (str): The name of the chart.
-            - version (str): The new version of the chart.
-            - overlays (list): The list of overlays to update the chart in.
-        deployment_dir (str): The directory containing the overlays.
+        plan (dict): The promotion plan, as returned by `plan_promotion`.
 
     Returns:
-        dict: A dictionary mapping overlays to the list of charts to update for each overlay.
+        list: The overlays with at least one edit that changes a value.
     """
-    overlays_to_charts = {}
-    for chart in charts_to_update:
-        # Add the chart to the list of charts for each overlay
-        for overlay in chart["overlays"]:
-            if overlay not in overlays_to_charts:
-                overlays_to_charts[overlay] = []
-
-            if "fromOverlay" in chart:
-                charts = read_charts_from_overlay(chart["fromOverlay"], deployment_dir)
-                logger.debug(charts)
-                for overlayChart in charts.values():
-                    logger.debug(overlayChart)
-                    if overlayChart["name"] == chart["name"]:
-                        overlays_to_charts[overlay].append(overlayChart)
-            else:
-                overlays_to_charts[overlay].append(chart)
-
-    return overlays_to_charts
+    return [
+        overlay
+        for overlay, edits in plan["overlays"].items()
+        if any(edit["before"] != edit["after"] for edit in edits)
+    ]
 
 
-def generate_kustomize_args(
-    overlay: str, images: list, promotion_manifest: dict
-) -> tuple[list[str], dict]:
+def apply_plan(
+    plan: dict, deployment_dir: str, backend: str = "kustomize", max_workers: int = 1
+) -> dict:
     """
-    Generate the arguments to pass to the `kustomize edit set image` command for a given overlay and list of images.
-    It also updates the promotion manifest with the images that are being passed to `kustomize`.
+    Apply a promotion plan to the overlays in the deployment directory.
 
     Args:
-        overlay (str): The overlay to generate the kustomize arguments for.
-        images (list): The list of images to generate the kustomize arguments for.
-        promotion_manifest (dict): The promotion manifest to add the images to.
+        plan (dict): The promotion plan, as returned by `plan_promotion`.
+        deployment_dir (str): The directory containing the overlays.
+        backend (str): kustomize to run `kustomize edit set image`, or native to
+            apply the same edit to the kustomization.yaml in-process.
+        max_workers (int): The maximum number of overlays to update at the same time.
 
     Returns:
-        tuple: A tuple containing the generated kustomize arguments (list) and the updated promotion manifest (dict).
+        dict: The promotion manifest.
+    """
+    if plan.get("version") != PLAN_VERSION:
+        raise ValidationError(
+            f"Unsupported promotion plan version {plan.get('version')}."
+        )
 
-    Example Usage:
-        overlay = "dev"
-        images = [
-            {"name": "app1", "newName": "new-app1", "newTag": "v2"},
-            {"name": "app2", "newName": "new-app2"},
-            {"name": "app3"}
-        ]
-        promotion_manifest = {}
+    # Stage every overlay before writing any of them, so that a failure leaves
+    # all of the overlays as they were
+    staged = StagedWrites()
 
-        kustomize_args, updated_manifest = generate_kustomize_args(overlay, images, promotion_manifest)
+    def apply_overlay(overlay: str, edits: list[dict]) -> dict:
+        with metrics.phase("apply_overlay", overlay=overlay):
+            return apply_overlay_plan(overlay, deployment_dir, edits, backend, staged)
 
-        print(kustomize_args)
-        # Output: ['app1=new-app1:v2', 'app2=new-app2', 'app3=app3']
+    promotion_manifest = update_overlays(apply_overlay, plan["overlays"], max_workers)
+    with metrics.phase("write"):
+        try:
+            staged.commit()
+        except OSError as e:
+            raise PromotionError(f"Failed to write the promoted overlays: {e}") from e
 
-        print(updated_manifest)
-        # Output: {'dev': {'images': [{'name': 'app1', 'newName': 'new-app1', 'newTag': 'v2'}, {'name': 'app2', 'newName': 'new-app2'}, {'name': 'app3'}]}}
-    """
+    for overlay, overlay_manifest in promotion_manifest.items():
+        if overlay_manifest.get("images"):
+            logger.info(f"Images in {overlay} updated successfully.")
+        if overlay_manifest.get("charts"):
+            logger.info(f"Charts in {overlay} updated successfully.")
 
-    kustomize_args = []
-    for image in images:
-        name = image["name"]
-        new_name = image.get("newName", name)
-        new_tag = image.get("newTag")
-        if overlay not in promotion_manifest:
-            promotion_manifest[overlay] = {}
-        if "images" not in promotion_manifest[overlay]:
-            promotion_manifest[overlay]["images"] = []
+    return promotion_manifest
 
-        if new_name and new_tag:
-            kustomize_args.append(f"{name}={new_name}:{new_tag}")
-            promotion_manifest[overlay]["images"].append(
-                {"name": name, "newName": new_name, "newTag": new_tag}
-            )
-        elif new_name:
-            kustomize_args.append(f"{name}={new_name}")
-            promotion_manifest[overlay]["images"].append(
-                {"name": name, "newName": new_name}
-            )
-        else:
-            raise ValueError(f"Image {image} is missing required fields.")
 
-    return kustomize_args, promotion_manifest
+def load_plan(path: str) -> dict:
+    """
+    Load a promotion plan that was written by a previous run.
 
+    Args:
+        path (str): The path to the plan file.
 
-def update_kustomize_images(
-    env: str, deployment_dir: str, images: list, promotion_manifest: dict
-) -> dict[str, dict[str, list]]:
+    Returns:
+        dict: The promotion plan.
     """
-    Uses kustomize to update the images for the given environment.
+    try:
+        with open(path) as plan_file:
+            return json.load(plan_file)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValidationError(
+            f"Failed to load the promotion plan from {path}: {e}"
+        ) from e
+
+
+def edit_kustomization(
+    kustomization_path: str,
+    kustomize_args: list[str],
+    chart_versions: list[tuple[int, str]],
+) -> Optional[str]:
+    """
+    Apply image and chart edits to a kustomization.yaml file in memory.
+
+    The new values are spliced into the original text if they only change
+    fields that are already set, otherwise they are applied to the parsed
+    document. Either way, only the changed values are rewritten, so the
+    comments and formatting of the file are preserved.
 
     Args:
-        env (str): The environment to update the images for.
-        deployment_dir (str): The directory containing the kustomize directories.
-        images (list): The list of images to update.
-        promotion_manifest (dict): The promotion manifest to add the images to.
+        kustomization_path (str): The path to the kustomization.yaml file.
+        kustomize_args (list): The arguments that would be passed to
+            `kustomize edit set image`, as generated by `generate_kustomize_args`.
+        chart_versions (list): The index of each helmCharts entry to update and
+            its new version, as built by `apply_overlay_plan` from the chart
+            edits planned by `plan_overlay`.
 
     Returns:
-        dict: The updated promotion manifest.
+        str: The new contents of the file, or None if they did not change.
+
+    Raises:
+        ValueError: If one of the image arguments is not valid.
     """
-    kustomize_dir = os.path.join(deployment_dir, env)
+    editor = kustomization_cache.splice(kustomization_path)
+    spliced = not kustomize_args or splice_kustomization_images(editor, kustomize_args)
+    if spliced and all(
+        editor.set("helmCharts", i, "version", version) for i, version in chart_versions
+    ):
+        return editor.dump() if editor.changed() else None
+
+    document = kustomization_cache.edit(kustomization_path)
+    if kustomize_args:
+        set_kustomization_images(document.data, kustomize_args)
+    for i, version in chart_versions:
+        document.data["helmCharts"][i]["version"] = version
+    return document.dump() if document.changed() else None
 
-    # Validate that the kustomize directory for the env exists
-    if not os.path.isdir(kustomize_dir):
-        logger.fatal(f"Kustomize directory for {env} does not exist. ({kustomize_dir})")
-        exit(1)
-    else:
-        logger.info(f"Updating images for {env}...")
 
-    # Change to the kustomize directory for the env
-    os.chdir(kustomize_dir)
+def update_overlays(
+    update: Callable[[str, Any], dict],
+    overlays_to_updates: dict[str, Any],
+    max_workers: int = 1,
+) -> dict:
+    """
+    Apply an update to each overlay, optionally in parallel.
 
-    kustomize_args, promotion_manifest = generate_kustomize_args(
-        env, images, promotion_manifest
-    )
+    Args:
+        update (Callable): Updates a single overlay, given the overlay and its
+            updates, and returns the promotion manifest for it.
+        overlays_to_updates (dict): A dictionary mapping overlays to the images
+            and/or charts to update in each overlay.
+        max_workers (int): The maximum number of overlays to update at the same
+            time. Overlays are updated one after another if this is 1.
 
-    # Run the kustomize edit set image command, failing the script if it fails
-    if kustomize_args:
-        try:
-            run(["kustomize", "edit", "set", "image", *kustomize_args])
-        except subprocess.CalledProcessError:
-            logger.fatal(f"Failed to update images in {env}.")
-            exit(1)
+    Returns:
+        dict: The promotion manifests of the overlays, merged in the order of
+        the overlays regardless of the order in which they were updated.
+    """
+    if max_workers > 1 and len(overlays_to_updates) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            manifests = list(
+                executor.map(lambda item: update(*item), overlays_to_updates.items())
+            )
     else:
-        logger.info(f"No images to update in {env}.")
+        manifests = [update(*item) for item in overlays_to_updates.items()]
 
-    # Change back to the original directory
-    os.chdir(deployment_dir)
+    promotion_manifest: dict = {}
+    for manifest in manifests:
+        merge_manifests(promotion_manifest, manifest)
 
     return promotion_manifest
 
 
-def update_kustomize_charts(
-    overlay: str, deployment_dir: str, charts: list, promotion_manifest: dict
-) -> dict:
+def write_metrics() -> None:
     """
-    Update the charts in a kustomization.yaml file for a specific overlay in a deployment directory.
+    Write the recorded metrics as JSON to the PROMOTE_METRICS_FILE env variable, if set.
+
+    The metrics are written to a file rather than stdout, so that they do not
+    end up in the promotion manifest that is captured from stdout.
+    """
+    metrics_file = os.getenv("PROMOTE_METRICS_FILE")
+    if not metrics_file:
+        return
+
+    try:
+        with open(metrics_file, "w") as f:
+            json.dump(metrics.to_dict(), f, indent=2)
+    except OSError as e:
+        logger.error(f"Failed to write metrics to {metrics_file}: {e}")
+
+
+def promoted_files(overlays: Iterable[str]) -> list[str]:
+    """
+    List the kustomization files of the promoted overlays.
 
     Args:
-        overlay (str): The name of the overlay for which the charts need to be updated.
-        deployment_dir (str): The path to the deployment directory.
-        charts (list): A list of dictionaries containing the name and version of the charts to be updated.
-        promotion_manifest (dict): A dictionary to store the promotion manifest.
+        overlays (Iterable): The promoted overlays, e.g. the promotion manifest.
+
+    Returns:
+        list: The paths of the kustomization.yaml files, relative to the
+        deployment directory.
+    """
+    return [posixpath.join(overlay, "kustomization.yaml") for overlay in overlays]
+
+
+def write_changed_files(overlays: Iterable[str]) -> None:
+    """
+    Write the kustomization files of the changed overlays to the PROMOTE_CHANGED_FILES env variable, if set.
+
+    The paths are written one per line, relative to the deployment directory,
+    so that the shell scripts only check and stage the files that promote.py
+    may have changed, rather than the whole deployment repository. An empty
+    file means that the promotion changed nothing.
+
+    Args:
+        overlays (Iterable): The changed overlays.
+    """
+    changed_files = os.getenv("PROMOTE_CHANGED_FILES")
+    if not changed_files:
+        return
+
+    try:
+        with open(changed_files, "w") as f:
+            f.writelines(f"{path}\n" for path in promoted_files(overlays))
+    except OSError as e:
+        raise PromotionError(
+            f"Failed to write the changed files to {changed_files}: {e}"
+        ) from e
+
+
+def write_trace() -> None:
+    """
+    Append the recorded phases as Chrome trace events to the PROMOTE_TRACE_FILE env variable, if set.
 
-    Returns:
-        dict: The updated promotion manifest containing the updated charts for the overlay.
+    The events are appended one JSON object per line, so that the shell scripts
+    that run promote.py can add their own events to the same file. The lines are
+    wrapped into a Chrome trace by `trace_finish` in trace.sh.
     """
-    kustomize_dir = os.path.join(deployment_dir, overlay)
+    trace_file = os.getenv("PROMOTE_TRACE_FILE")
+    if not trace_file:
+        return
 
-    # Validate that the kustomize directory for the env exists
-    if not os.path.isdir(kustomize_dir):
-        logger.fatal(
-            f"Kustomize directory for {overlay} does not exist. ({kustomize_dir})"
-        )
-        exit(1)
-    else:
-        logger.info(f"Updating charts for {overlay}...")
+    try:
+        with open(trace_file, "a") as f:
+            for event in metrics.trace_events():
+                f.write(json.dumps(event) + "\n")
+    except OSError as e:
+        logger.error(f"Failed to write the trace to {trace_file}: {e}")
 
-    # Change to the kustomize directory for the env
-    os.chdir(kustomize_dir)
 
-    # Read in existing kustomization.yaml file
-    with open("kustomization.yaml", "r") as kustomization_file:
-        kustomization = yaml.safe_load(kustomization_file)
+def get_max_workers() -> int:
+    """
+    Get the number of overlays to update in parallel from the PROMOTE_MAX_WORKERS env variable.
 
-    # If the helmCharts key is not present, fail
-    if "helmCharts" not in kustomization:
-        logger.fatal(f"helmCharts key not found in {kustomize_dir}/kustomization.yaml.")
-        exit(1)
+    Returns:
+        int: The maximum number of worker threads, defaulting to 1 (serial).
+    """
+    max_workers = os.getenv("PROMOTE_MAX_WORKERS") or "1"
+    if not max_workers.isdigit() or int(max_workers) < 1:
+        raise ValidationError(
+            f"PROMOTE_MAX_WORKERS must be a positive integer, got {max_workers}."
+        )
 
-    # Using the existing kustomization file, update the charts
-    for chart in charts:
-        logger.debug(chart)
-        found = False
+    return int(max_workers)
 
-        # Search kustomize["helmCharts"] for the chart
-        for i, helm_chart in enumerate(kustomization["helmCharts"]):
-            if helm_chart["name"] == chart["name"]:
-                found = True
-                # Update the chart
-                kustomization["helmCharts"][i]["version"] = chart["version"]
 
-                # Add to promotion manifest
-                if overlay not in promotion_manifest:
-                    promotion_manifest[overlay] = {}
-                if "charts" not in promotion_manifest[overlay]:
-                    promotion_manifest[overlay]["charts"] = []
-                promotion_manifest[overlay]["charts"].append(chart)
+def get_batch_window() -> float:
+    """
+    Get how long `promote.py serve` collects promotions into a batch from the PROMOTE_BATCH_WINDOW env variable.
 
-        if not found:
-            logger.fatal(
-                f"Chart {chart['name']} not found in {kustomize_dir}/kustomization.yaml."
-            )
-            exit(1)
+    Returns:
+        float: The batch window in seconds, defaulting to 0 (only batch the
+        promotions that are already queued).
+    """
+    batch_window = os.getenv("PROMOTE_BATCH_WINDOW") or "0"
+    try:
+        seconds = float(batch_window)
+    except ValueError:
+        seconds = -1
+    if seconds < 0:
+        raise ValidationError(
+            f"PROMOTE_BATCH_WINDOW must be a non-negative number of seconds, got {batch_window}."
+        )
 
-    # Write the updated kustomization file
-    with open("kustomization.yaml", "w") as kustomization_file:
-        yaml.dump(kustomization, kustomization_file)
+    return seconds
 
-    # Since pyYAML doesn't care at all about formatting,
-    # Run kustomize fmt to format the kustomization.yaml file
-    run(["kustomize", "cfg", "fmt", "kustomization.yaml"])
 
-    # Change back to the original directory
-    os.chdir(deployment_dir)
+def get_batch_size() -> int:
+    """
+    Get the maximum number of promotions `promote.py serve` applies as a batch from the PROMOTE_BATCH_SIZE env variable.
 
-    return promotion_manifest
+    Returns:
+        int: The maximum batch size, defaulting to 1 (no batching). 0 means no limit.
+    """
+    batch_size = os.getenv("PROMOTE_BATCH_SIZE") or "1"
+    if not batch_size.isdigit():
+        raise ValidationError(
+            f"PROMOTE_BATCH_SIZE must be a non-negative integer, got {batch_size}."
+        )
+
+    return int(batch_size)
 
 
 def validate_runtime_environment() -> None:
@@ -621,11 +3410,10 @@ def validate_runtime_environment() -> None:
     try:
         logger.debug("Validating that kustomize is available...")
         run(["kustomize", "version"])
-    except subprocess.CalledProcessError:
-        logger.fatal(
+    except (OSError, subprocess.CalledProcessError):
+        raise CommandError(
             "kustomize is not available. Please install kustomize before running this script."
-        )
-        exit(1)
+        ) from None
 
 
 def get_deployment_dir() -> str:
@@ -638,8 +3426,7 @@ def get_deployment_dir() -> str:
     # Validate that the kustomize directory exists
     deployment_dir = os.getenv("DEPLOYMENT_DIR", ".")
     if not os.path.isdir(deployment_dir):
-        logger.fatal(f"Deployment directory {deployment_dir} does not exist.")
-        exit(1)
+        raise ValidationError(f"Deployment directory {deployment_dir} does not exist.")
     else:
         logger.info(f"Using deployment directory: {deployment_dir}")
 
@@ -670,10 +3457,11 @@ def load_promotion_json(type: str) -> dict:
         try:
             promotion_json = json.loads(promotion_input)
         except json.JSONDecodeError as e:
-            logger.fatal(f"Provided {type} JSON object failed to parse.")
-            logger.fatal(f"Please provide a valid JSON list. Error: {e}")
-            logger.fatal(f"The input received was: {promotion_input}")
-            exit(1)
+            raise ValidationError(
+                f"Provided {type} JSON object failed to parse. "
+                f"Please provide a valid JSON list. Error: {e}\n"
+                f"The input received was: {promotion_input}"
+            ) from e
     else:
         logger.info(f"No {type} to update.")
         promotion_json = []
@@ -695,14 +3483,28 @@ def validate_promotion_lists(
         None
 
     Raises:
-        SystemExit: If there are no images or charts to update.
+        ValidationError: If there are no images or charts to update, or they
+            are invalid.
     """
+    # Validate that the images and charts to update are lists with the
+    # required fields, reporting every problem at once
+    errors = validate_promotions(images_to_update, charts_to_update)
+    if errors:
+        problems = [
+            f"Found {len(errors)} problems in the images and charts to update:",
+            *(
+                f"- {error['section']}: {error['message']}"
+                if error["index"] is None
+                else f"- {error['section']}[{error['index']}]: {error['message']}"
+                for error in errors
+            ),
+        ]
+        raise ValidationError("\n".join(problems), errors)
+
     if len(images_to_update) == 0 and len(charts_to_update) == 0:
-        logger.fatal("No images or charts to update. Please provide either (or both):")
-        logger.fatal(
+        raise ValidationError(
+            "No images or charts to update. Please provide either (or both):\n"
             "- A JSON object of images to update via the IMAGES_TO_UPDATE env var or via stdin in the following format:"
-        )
-        logger.fatal(
             """
             [
                 {
@@ -716,11 +3518,7 @@ def validate_promotion_lists(
                 }
             ]
             """
-        )
-        logger.fatal(
             "- A JSON object of charts to update via the CHARTS_TO_UPDATE env var or via stdin in the following format:"
-        )
-        logger.fatal(
             """
             [
                 {
@@ -736,62 +3534,1276 @@ def validate_promotion_lists(
             ]
             """
         )
-        exit(1)
 
-    # Validate that the images to update have the required fields
-    validate_images(images_to_update)
 
-    # Validate that the charts to update have the required fields
-    validate_charts(charts_to_update)
+class GitObjectStore:
+    """
+    Reads and writes the objects of a git repository without a working tree.
 
+    Objects are read through a single long-running `git cat-file --batch`
+    process, and new objects are written with `git hash-object`, `git mktree`
+    and `git commit-tree`, so the repository can be bare.
+    """
 
-def main():
-    validate_runtime_environment()
+    def __init__(self, git_dir: str) -> None:
+        self.git_dir = git_dir
+        self._lock = threading.Lock()
+        self._batch: Optional[subprocess.Popen] = None
+
+    def close(self) -> None:
+        """
+        Stop the `git cat-file --batch` process, if it was started.
+        """
+        with self._lock:
+            if self._batch is not None:
+                self._batch.communicate()
+                self._batch = None
+
+    def __enter__(self) -> "GitObjectStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def git(self, args: list[str], input: Optional[bytes] = None) -> str:
+        """
+        Run a git command against the repository and return its output.
+
+        Args:
+            args (list): The git command and its arguments, without `git`.
+            input (bytes): The data to write to the command's stdin.
+
+        Returns:
+            str: The stdout of the command, stripped.
+
+        Raises:
+            CalledProcessError: If the command fails.
+        """
+        command = ["git", f"--git-dir={self.git_dir}", *args]
+        metrics.count("subprocesses")
+        with metrics.phase("subprocess", command=" ".join(command), cwd=os.getcwd()):
+            output = subprocess.run(command, input=input, capture_output=True)
+        if output.returncode != 0:
+            logger.error(output.stderr.decode(errors="replace"))
+        output.check_returncode()
+        return output.stdout.decode().strip()
+
+    def read(self, revision: str) -> Optional[tuple[str, str, bytes]]:
+        """
+        Read an object.
+
+        Args:
+            revision (str): Any revision naming the object, e.g. a sha,
+                `<ref>^{commit}` or `<ref>:<path>`.
+
+        Returns:
+            tuple: The sha, type and contents of the object, or None if it does
+            not exist.
+        """
+        with self._lock:
+            if self._batch is None:
+                # Found objects always get a header of this fixed format
+                self._batch = subprocess.Popen(
+                    [
+                        "git",
+                        f"--git-dir={self.git_dir}",
+                        "cat-file",
+                        "--batch=%(objectname) %(objecttype) %(objectsize)",
+                    ],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+                metrics.count("subprocesses")
+            assert self._batch.stdin and self._batch.stdout
+            try:
+                self._batch.stdin.write(revision.encode() + b"\n")
+                self._batch.stdin.flush()
+                header = self._batch.stdout.readline().decode().split()
+            except OSError as e:
+                raise CommandError(
+                    f"git cat-file failed to read {revision}: {e}"
+                ) from e
+            # Missing objects echo the revision, which can contain spaces
+            if header and header[-1] in ("missing", "ambiguous"):
+                return None
+            if len(header) != 3 or not header[2].isdigit():
+                # The process died, or replied with something unexpected
+                raise CommandError(
+                    f"git cat-file failed to read {revision}: {' '.join(header) or 'no output'}."
+                )
+            sha, type, size = header
+            data = self._batch.stdout.read(int(size) + 1)[:-1]
+
+        metrics.count("git_objects_read")
+        return sha, type, data
+
+    def resolve(self, revision: str) -> Optional[str]:
+        """
+        Return the sha of the commit a revision points to, or None if there is none.
+        """
+        found = self.read(f"{revision}^{{commit}}")
+        return found[0] if found else None
+
+    def read_blob(self, commit: str, path: str) -> Optional[bytes]:
+        """
+        Read the file at a path in a commit, or None if there is no such file.
+        """
+        found = self.read(f"{commit}:{path}")
+        if found is None or found[1] != "blob":
+            return None
+        return found[2]
+
+    def read_tree(self, tree: str) -> list[tuple[str, str, str]]:
+        """
+        Read the (mode, name, sha) of each entry of a tree.
+        """
+        found = self.read(tree)
+        if found is None or found[1] != "tree":
+            raise ValueError(f"{tree} is not a tree")
+        sha, _, data = found
+        hash_size = len(sha) // 2
+        entries = []
+        i = 0
+        while i < len(data):
+            # <mode> <name>\0<binary sha>
+            nul = data.index(b"\0", i)
+            mode, _, rest = data[i:nul].partition(b" ")
+            start = nul + 1
+            end = start + hash_size
+            name = rest.decode("utf-8", "surrogateescape")
+            entries.append((mode.decode(), name, data[start:end].hex()))
+            i = end
+        return entries
+
+    def find_files(self, tree: str, name: str, prefix: str = "") -> list[str]:
+        """
+        Find the paths of the files with the given name in a tree and its subtrees.
+        """
+        paths = []
+        for mode, entry, sha in self.read_tree(tree):
+            if mode == "40000":
+                paths += self.find_files(sha, name, f"{prefix}{entry}/")
+            elif entry == name and mode in ("100644", "100755"):
+                paths.append(f"{prefix}{entry}")
+        return paths
+
+    def write_blob(self, data: bytes) -> str:
+        """
+        Write a blob and return its sha.
+        """
+        return self.git(["hash-object", "-w", "--stdin"], input=data)
+
+    def write_tree(self, tree: str, files: dict[str, str]) -> str:
+        """
+        Write a copy of a tree with some of its files replaced.
+
+        Only the trees on the paths of the replaced files are read and written
+        again; every other tree and blob is reused as is.
+
+        Args:
+            tree (str): The sha of the tree to copy.
+            files (dict): The sha of the new blob at each path to replace.
+
+        Returns:
+            str: The sha of the new tree.
+        """
+        entries = {name: (mode, sha) for mode, name, sha in self.read_tree(tree)}
+        subtrees: dict[str, dict[str, str]] = {}
+        for path, blob in files.items():
+            name, _, rest = path.partition("/")
+            if rest:
+                subtrees.setdefault(name, {})[rest] = blob
+            else:
+                mode = entries.get(name, ("100644", ""))[0]
+                entries[name] = (mode, blob)
+        for name, subtree_files in subtrees.items():
+            entries[name] = ("40000", self.write_tree(entries[name][1], subtree_files))
+
+        types = {"40000": "tree", "160000": "commit"}
+        listing = b""
+        for name, (mode, sha) in entries.items():
+            line = f"{mode} {types.get(mode, 'blob')} {sha}\t{name}\0"
+            listing += line.encode("utf-8", "surrogateescape")
+        return self.git(["mktree", "-z", "--missing"], input=listing)
+
+    def commit(self, tree: str, parent: str, message: str) -> str:
+        """
+        Write a commit of a tree on top of a parent commit and return its sha.
+        """
+        return self.git(
+            ["commit-tree", tree, "-p", parent, "-F", "-"], input=message.encode()
+        )
 
-    deployment_dir = get_deployment_dir()
 
-    # Read in the images to update from stdin or the IMAGES_TO_UPDATE env variable
-    images_to_update = load_promotion_json("images")
+# The object store and the path of the deployment directory within its
+# repository, by deployment directory, for reading overlays at other revisions
+_git_object_stores: dict[str, tuple[GitObjectStore, str]] = {}
+
+# The images or charts read from the kustomization.yaml blobs of other
+# revisions, by blob and kind. Blobs never change, so they never go stale.
+_kustomizations_at_refs: dict[tuple[str, str], dict] = {}
+
+
+def git_object_store(deployment_dir: str) -> tuple[GitObjectStore, str]:
+    """
+    Get the object store of the git repository containing the deployment directory.
+
+    The store, and with it its `git cat-file --batch` process, is shared by
+    every read from the deployment directory in this process.
+
+    Args:
+        deployment_dir (str): The deployment directory.
+
+    Returns:
+        tuple: The object store, and the path of the deployment directory
+        relative to the root of the repository, with a trailing `/` unless it
+        is the root.
+    """
+    if deployment_dir not in _git_object_stores:
+        metrics.count("subprocesses")
+        try:
+            output = subprocess.run(
+                ["git", "rev-parse", "--absolute-git-dir", "--show-prefix"],
+                cwd=deployment_dir,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError):
+            raise CommandError(
+                f"Deployment directory {deployment_dir} is not in a git repository, which fromRef requires."
+            ) from None
+        git_dir, _, prefix = output.partition("\n")
+        _git_object_stores[deployment_dir] = (GitObjectStore(git_dir), prefix.strip())
+
+    return _git_object_stores[deployment_dir]
+
+
+def read_kustomization_at_ref(
+    overlay: str,
+    ref: str,
+    deployment_dir: str,
+    kind: str,
+    build: Callable[[str, str, dict], dict[str, dict]],
+) -> dict[str, dict]:
+    """
+    Read the images or charts of an overlay as it was at a git revision.
+
+    The kustomization.yaml is read through the long-running `git cat-file
+    --batch` process of the repository, without checking anything out, and
+    validated the same way as one read from the deployment directory.
+
+    Args:
+        overlay (str): The overlay to read.
+        ref (str): The git revision, e.g. a tag, branch or sha.
+        deployment_dir (str): The deployment directory.
+        kind (str): images or charts.
+        build (Callable): Builds the images or charts from the parsed
+            kustomization, as `_images_from_kustomization(overlay, file, kustomize)`.
+
+    Returns:
+        dict: A dictionary mapping names to the image or chart dictionaries.
+    """
+    store, prefix = git_object_store(deployment_dir)
+    path = posixpath.normpath(posixpath.join(prefix, overlay, "kustomization.yaml"))
+    kustomization_file = f"{ref}:{path}"
+    found = store.read(kustomization_file)
+    if found is None or found[1] != "blob":
+        raise OverlayNotFoundError(
+            f"Kustomization file {kustomization_file} does not exist."
+        )
+
+    blob, _, data = found
+    if (blob, kind) not in _kustomizations_at_refs:
+        section = "images" if kind == "images" else "helmCharts"
+        try:
+            kustomize = load_kustomization_section(data.decode("utf-8"), section)
+        except (UnicodeDecodeError, yaml.YAMLError) as e:
+            raise KustomizationError(
+                f"Kustomization file {kustomization_file} is invalid: {e}"
+            ) from e
+        _kustomizations_at_refs[(blob, kind)] = build(
+            f"{overlay}@{ref}", kustomization_file, kustomize
+        )
+
+    return _kustomizations_at_refs[(blob, kind)]
+
+
+def kustomization_paths(images: list[dict], charts: list[dict]) -> Optional[list[str]]:
+    """
+    List the kustomization.yaml files, relative to the deployment directory,
+    that a promotion reads or writes.
+
+    Args:
+        images (list): The list of images to update.
+        charts (list): The list of charts to update.
+
+    Returns:
+        list: The paths, or None if overlay patterns are used, in which case
+        every kustomization.yaml may be needed.
+    """
+    overlays = []
+    for entry in images + charts:
+        targets = entry.get("overlays")
+        if not isinstance(targets, list):
+            return None
+        # A fromOverlay read at another revision is read from the repository
+        from_overlay = None if "fromRef" in entry else entry.get("fromOverlay")
+        for overlay in targets + [from_overlay]:
+            if not isinstance(overlay, str):
+                continue
+            if is_overlay_pattern(overlay):
+                return None
+            overlays.append(overlay)
+
+    return [
+        posixpath.normpath(posixpath.join(overlay, "kustomization.yaml"))
+        for overlay in dict.fromkeys(overlays)
+    ]
+
+
+def promote_in_repository(
+    git_dir: str,
+    ref: str,
+    images: list[dict],
+    charts: list[dict],
+    backend: str = "native",
+    max_workers: int = 1,
+    message: Optional[str] = None,
+) -> tuple[dict, Optional[str]]:
+    """
+    Promote images and charts by committing directly to a ref of a git repository,
+    which may be bare, without checking it out.
+
+    Only the kustomization.yaml files that the promotion needs are read from the
+    commit the ref points to, into a scratch directory where the promotion is
+    planned and applied as usual. The files that changed are written back as
+    blobs, the trees on their paths are rewritten, and the new commit is
+    written on top and the ref moved to it, unless the ref moved in the
+    meantime.
+
+    Args:
+        git_dir (str): The path of the git repository (its .git directory, if
+            it is not bare). The overlays are relative to its root.
+        ref (str): The branch to commit to, e.g. main, refs/heads/main or HEAD.
+        images (list): The list of images to update.
+        charts (list): The list of charts to update.
+        backend (str): The image backend.
+        max_workers (int): The maximum number of overlays to update at the same time.
+        message (str): The commit message, defaulting to one listing the overlays.
+
+    Returns:
+        tuple: The promotion manifest, and the sha of the new commit or None
+        if nothing changed.
+    """
+    with GitObjectStore(git_dir) as store:
+        try:
+            full_ref = store.git(["rev-parse", "--symbolic-full-name", ref])
+        except subprocess.CalledProcessError:
+            full_ref = ""
+        parent = store.resolve(ref)
+        if not full_ref.startswith("refs/heads/") or parent is None:
+            raise ValidationError(f"{ref} is not a branch of the repository {git_dir}.")
+
+        paths = kustomization_paths(images, charts)
+        if paths is None:
+            paths = store.find_files(f"{parent}^{{tree}}", "kustomization.yaml")
+
+        with tempfile.TemporaryDirectory() as scratch:
+            originals = {}
+            with metrics.phase("read_blobs"):
+                for path in paths:
+                    data = store.read_blob(parent, path)
+                    if data is None:
+                        # Reported by the plan, like a missing file in a checkout
+                        continue
+                    os.makedirs(
+                        os.path.join(scratch, os.path.dirname(path)), exist_ok=True
+                    )
+                    with open(os.path.join(scratch, path), "wb") as f:
+                        f.write(data)
+                    originals[path] = data
+
+            # Index the scratch directory in memory only, so that it does not
+            # replace the index of the deployment directory in PROMOTE_INDEX_FILE
+            _kustomization_indexes[scratch] = KustomizationIndex(scratch)
+            # Read fromRef overlays from the repository rather than the scratch directory
+            _git_object_stores[scratch] = (store, "")
+            try:
+                plan = plan_promotion(images, charts, scratch)
+                promotion_manifest = apply_plan(plan, scratch, backend, max_workers)
+            finally:
+                del _kustomization_indexes[scratch]
+                del _git_object_stores[scratch]
+
+            with metrics.phase("write_objects"):
+                blobs = {}
+                for path, original in originals.items():
+                    with open(os.path.join(scratch, path), "rb") as f:
+                        data = f.read()
+                    if data != original:
+                        blobs[path] = store.write_blob(data)
+
+                if not blobs:
+                    logger.info(f"{ref} is already up to date.")
+                    return promotion_manifest, None
+
+                tree = store.write_tree(f"{parent}^{{tree}}", blobs)
+                if message is None:
+                    message = (
+                        f"Promote to {', '.join(promotion_manifest)}\n\n"
+                        f"MANIFEST_JSON: {json.dumps(promotion_manifest)}\n"
+                    )
+                commit = store.commit(tree, parent, message)
+                # Only move the ref if nobody else moved it since it was read
+                store.git(["update-ref", full_ref, commit, parent])
+
+    logger.info(f"Committed {commit} to {full_ref}.")
+    return promotion_manifest, commit
+
+
+class PromotionResult(NamedTuple):
+    """
+    The result of applying a promotion plan with `Promoter.apply`.
+    """
+
+    # The promotion manifest, as printed by promote.py
+    manifest: dict
+    # The plan that was applied
+    plan: dict
+    # The overlays whose kustomization files were rewritten
+    changed: list
+
+
+class Promoter:
+    """
+    Plans and applies promotions to a deployment directory.
+
+    This is the library interface to promote.py: unlike the command line
+    entrypoints, it never exits and raises a PromotionError subclass instead,
+    so it can be called from other programs.
+
+    Example Usage:
+        promoter = Promoter("deploy", backend="native")
+        try:
+            result = promoter.promote(
+                [{"name": "app1", "newTag": "v2", "overlays": ["prod"]}], []
+            )
+        except PromotionError as e:
+            print(e.to_dict())
+        else:
+            print(result.manifest, result.changed)
+    """
+
+    def __init__(
+        self, deployment_dir: str, backend: str = "kustomize", max_workers: int = 1
+    ) -> None:
+        if backend not in IMAGE_BACKENDS:
+            raise ValidationError(
+                f"Unknown image backend {backend}. Valid backends are: {', '.join(IMAGE_BACKENDS)}."
+            )
+        if max_workers < 1:
+            raise ValidationError(
+                f"max_workers must be a positive integer, got {max_workers}."
+            )
+        self.deployment_dir = deployment_dir
+        self.backend = backend
+        self.max_workers = max_workers
+
+    def plan(self, images: list[dict], charts: list[dict]) -> dict:
+        """
+        Validate the images and charts to update and plan their promotion.
+
+        Args:
+            images (list): The images to update, as in IMAGES_TO_UPDATE.
+            charts (list): The charts to update, as in CHARTS_TO_UPDATE.
+
+        Returns:
+            dict: The promotion plan, as returned by `plan_promotion`.
+        """
+        with metrics.phase("validate"):
+            validate_promotion_lists(images, charts)
+
+        # Resolve the images and charts to the edits to make in each overlay
+        with metrics.phase("plan"):
+            return plan_promotion(images, charts, self.deployment_dir)
+
+    def apply(
+        self, plan: dict, dry_run: bool = False, recheck: bool = False
+    ) -> PromotionResult:
+        """
+        Apply a promotion plan to the deployment directory.
+
+        Args:
+            plan (dict): The promotion plan.
+            dry_run (bool): Only report what would be promoted, without
+                changing any files.
+            recheck (bool): Apply every overlay of the plan, even those the
+                plan records as unchanged, to check that they still have the
+                planned values. Used for plans made by a previous run.
+
+        Returns:
+            PromotionResult: The promotion manifest, the plan and the overlays
+            that were changed.
+        """
+        changed = list(plan["overlays"]) if recheck else changed_overlays(plan)
+
+        if dry_run:
+            return PromotionResult(manifest_from_plan(plan), plan, [])
+
+        if not changed:
+            # Every overlay already has the promoted values, so there is
+            # nothing to write and no subprocess to run
+            logger.info("Every overlay is already up to date, nothing to promote.")
+            return PromotionResult(manifest_from_plan(plan), plan, [])
+
+        # kustomize is only needed to update images with the kustomize backend
+        if self.backend == "kustomize":
+            with metrics.phase("validate_runtime_environment"):
+                validate_runtime_environment()
+
+        # Iterate through the overlays, updating the images and charts in each
+        with metrics.phase("apply"):
+            promotion_manifest = apply_plan(
+                plan, self.deployment_dir, self.backend, self.max_workers
+            )
+
+        return PromotionResult(promotion_manifest, plan, changed)
+
+    def promote(self, images: list[dict], charts: list[dict]) -> PromotionResult:
+        """
+        Plan and apply the promotion of the given images and charts.
+
+        Args:
+            images (list): The images to update, as in IMAGES_TO_UPDATE.
+            charts (list): The charts to update, as in CHARTS_TO_UPDATE.
+
+        Returns:
+            PromotionResult: The result of applying the plan.
+        """
+        return self.apply(self.plan(images, charts))
+
+
+class PromotionJob:
+    """
+    A promotion submitted to a PromotionQueue, with its status and result.
 
-    # Read in the helm charts to update from stdin or the HELM_CHARTS_TO_UPDATE env variable
-    charts_to_update = load_promotion_json("charts")
+    The status moves from `queued` to `running` to either `succeeded`, with the
+    promotion manifest set, or `failed`, with the errors logged while it ran.
+    A job that was applied together with others also records the batch, and
+    the entries of its manifest that a later job in the batch superseded.
+    """
+
+    def __init__(self, id: int, images: list[dict], charts: list[dict]) -> None:
+        self.id = id
+        self.images = images
+        self.charts = charts
+        self.status = "queued"
+        self.manifest: Optional[dict] = None
+        self.superseded: list[dict] = []
+        self.batch: Optional[dict] = None
+        self.errors: list[str] = []
+        self.seconds: Optional[float] = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        """
+        Return the job as a JSON-serializable dictionary.
+        """
+        job: dict[str, Any] = {"id": self.id, "status": self.status}
+        if self.manifest is not None:
+            job["manifest"] = self.manifest
+        if self.superseded:
+            job["superseded"] = self.superseded
+        if self.batch is not None:
+            job["batch"] = self.batch
+        if self.errors:
+            job["errors"] = self.errors
+        if self.seconds is not None:
+            job["seconds"] = self.seconds
+        return job
+
+
+class _ErrorCollector(logging.Handler):
+    """
+    Collects the errors logged while a promotion job runs.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(logging.ERROR)
+        self.messages: list[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+@contextlib.contextmanager
+def _collect_errors() -> Iterator[list[str]]:
+    errors = _ErrorCollector()
+    logger.addHandler(errors)
+    try:
+        yield errors.messages
+    finally:
+        logger.removeHandler(errors)
+
+
+def coalesce_promotions(
+    requests: list[tuple[Any, list[dict], list[dict]]]
+) -> tuple[list[dict], list[dict], dict[tuple[str, str, str], Any]]:
+    """
+    Merge the images and charts of several promotion requests into one promotion.
+
+    Conflicts are resolved per overlay and image or chart name: the request that
+    comes last wins, replacing the whole entry of the earlier ones.
+
+    Args:
+        requests (list): (request id, images, charts) for each request, in the
+            order they were made.
+
+    Returns:
+        tuple: The images and charts to update, with one overlay per entry, and
+        the id of the request that owns each (overlay, section, name), where
+        section is images or charts.
+
+    Example Usage:
+        images, charts, owners = coalesce_promotions([
+            (1, [{"name": "app1", "newTag": "v1", "overlays": ["dev", "prod"]}], []),
+            (2, [{"name": "app1", "newTag": "v2", "overlays": ["dev"]}], []),
+        ])
+
+        print(owners)
+        # Output: {('dev', 'images', 'app1'): 2, ('prod', 'images', 'app1'): 1}
+    """
+    winners: dict[tuple[str, str, str], tuple[Any, dict]] = {}
+    for request_id, images, charts in requests:
+        for section, entries in (("images", images), ("charts", charts)):
+            for entry in entries:
+                for overlay in entry["overlays"]:
+                    key = (overlay, section, entry["name"])
+                    # Reassigning keeps the key in place, so the merged order is stable
+                    winners[key] = (request_id, {**entry, "overlays": [overlay]})
+
+    images_to_update = []
+    charts_to_update = []
+    for (_, section, _), (_, entry) in winners.items():
+        if section == "images":
+            images_to_update.append(entry)
+        else:
+            charts_to_update.append(entry)
+
+    owners = {key: request_id for key, (request_id, _) in winners.items()}
+    return images_to_update, charts_to_update, owners
+
+
+def attribute_manifest(
+    promotion_manifest: dict, owners: dict[tuple[str, str, str], Any]
+) -> dict[Any, dict]:
+    """
+    Split a promotion manifest into the manifests of the requests that own its entries.
+
+    Args:
+        promotion_manifest (dict): The manifest of a coalesced promotion.
+        owners (dict): The request owning each entry, as returned by
+            `coalesce_promotions`.
+
+    Returns:
+        dict: The manifest of each request, in the order the requests were made.
+    """
+    manifests: dict[Any, dict] = {request_id: {} for request_id in owners.values()}
+    for overlay, overlay_manifest in promotion_manifest.items():
+        for section, entries in overlay_manifest.items():
+            for entry in entries:
+                request_id = owners[(overlay, section, entry["name"])]
+                manifest = manifests[request_id].setdefault(overlay, {})
+                manifest.setdefault(section, []).append(entry)
+
+    return {
+        request_id: manifest
+        for request_id, manifest in sorted(manifests.items())
+        if manifest
+    }
+
+
+def commit_promotion(
+    deployment_dir: str, promotion_manifest: dict, requests: list
+) -> bool:
+    """
+    Commit the kustomization files of the promoted overlays as a single commit.
+
+    Args:
+        deployment_dir (str): The deployment directory, a git work tree.
+        promotion_manifest (dict): The manifest of the promotion.
+        requests (list): The ids of the promotion requests that were applied.
+
+    Returns:
+        bool: True if a commit was made, False if the files were unchanged.
+    """
+    # Only the promoted files are checked and committed, so anything else that
+    # is already staged in the repository is left out of the commit
+    paths = promoted_files(promotion_manifest)
+    git = ["git", "--literal-pathspecs"]
+    run([*git, "add", "--", *paths], cwd=deployment_dir)
+    staged = subprocess.run(
+        [*git, "diff", "--cached", "--quiet", "--", *paths], cwd=deployment_dir
+    )
+    if staged.returncode == 0:
+        logger.info("No changes to commit.")
+        return False
+
+    message = (
+        f"Promote to {', '.join(promotion_manifest)}\n\n"
+        f"REQUESTS: {', '.join(str(request_id) for request_id in requests)}\n"
+        f"MANIFEST_JSON: {json.dumps(promotion_manifest)}\n"
+    )
+    run([*git, "commit", "-m", message, "--", *paths], cwd=deployment_dir)
+    return True
+
+
+class PromotionQueue:
+    """
+    Applies submitted promotions to a deployment directory, one batch at a time.
+
+    A single worker thread applies the jobs in the order they were submitted,
+    so promotions never race on the same kustomization files. The overlays stay
+    parsed in the kustomization cache between jobs, so each job only rereads
+    the files that changed since the previous one.
+
+    Jobs submitted within `batch_window` seconds of the first job of a batch,
+    up to `batch_size` jobs (0 for no limit), are coalesced with
+    `coalesce_promotions` and applied together, and committed as one commit if
+    `commit` is set. By default every job is applied on its own.
+    """
+
+    def __init__(
+        self,
+        deployment_dir: str,
+        backend: str = "kustomize",
+        max_workers: int = 1,
+        history: int = 1000,
+        batch_window: float = 0.0,
+        batch_size: int = 1,
+        commit: bool = False,
+    ) -> None:
+        self.deployment_dir = deployment_dir
+        self.backend = backend
+        self.max_workers = max_workers
+        self.history = history
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.commit = commit
+        self._queue: queue.Queue = queue.Queue()
+        self._jobs: dict[int, PromotionJob] = {}
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._next_batch_id = 1
+        self._worker = threading.Thread(
+            target=self._work, name="promotion-worker", daemon=True
+        )
+
+    def start(self) -> None:
+        """
+        Start applying submitted jobs.
+        """
+        self._worker.start()
+
+    def stop(self) -> None:
+        """
+        Stop once the jobs submitted so far have been applied.
+        """
+        self._queue.put(None)
+        self._worker.join()
+
+    def submit(self, images: list[dict], charts: list[dict]) -> PromotionJob:
+        """
+        Queue a promotion of the given images and charts.
+
+        Args:
+            images (list): The images to update, as in IMAGES_TO_UPDATE.
+            charts (list): The charts to update, as in CHARTS_TO_UPDATE.
+
+        Returns:
+            PromotionJob: The queued job.
+        """
+        with self._lock:
+            job = PromotionJob(self._next_id, images, charts)
+            self._next_id += 1
+            self._jobs[job.id] = job
+
+            # Forget the oldest finished jobs
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs.values()))
+                if not oldest.done.is_set():
+                    break
+                del self._jobs[oldest.id]
+
+        self._queue.put(job)
+        return job
+
+    def get(self, id: int) -> Optional[PromotionJob]:
+        """
+        Get a submitted job by its id, if it has not been forgotten.
+        """
+        with self._lock:
+            return self._jobs.get(id)
+
+    def pending(self) -> int:
+        """
+        Return the number of jobs waiting to be applied.
+        """
+        return self._queue.qsize()
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            batch = [job]
+            stopping = False
+            deadline = time.monotonic() + self.batch_window
+            while self.batch_size == 0 or len(batch) < self.batch_size:
+                try:
+                    job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+
+            self.apply(batch)
+            if stopping:
+                return
+
+    def apply(self, jobs: list[PromotionJob]) -> None:
+        """
+        Validate, plan and apply a batch of jobs, recording the result on each job.
+
+        Each job is validated and planned on its own first, so that an invalid
+        job fails alone instead of failing the whole batch.
+
+        Args:
+            jobs (list): The jobs to apply, in the order they were submitted.
+        """
+        metrics.reset()
+        for job in jobs:
+            job.status = "running"
+
+        valid = []
+        for job in jobs:
+            with _collect_errors() as errors:
+                try:
+                    validate_promotion_lists(job.images, job.charts)
+                    job.images, job.charts = resolve_overlay_patterns(
+                        job.images, job.charts, self.deployment_dir
+                    )
+                    if len(jobs) > 1:
+                        plan_promotion(job.images, job.charts, self.deployment_dir)
+                    valid.append(job)
+                except PromotionError as e:
+                    # Record the reason on the job whatever the log level is
+                    errors.append(str(e))
+                    logger.warning(f"Promotion {job.id} failed: {e}")
+                    self.finish(job, "failed", errors=errors)
+                except Exception as e:
+                    logger.error(f"Promotion {job.id} failed: {e}")
+                    self.finish(job, "failed", errors=errors)
+
+        if not valid:
+            return
+
+        with _collect_errors() as errors:
+            try:
+                images, charts, owners = coalesce_promotions(
+                    [(job.id, job.images, job.charts) for job in valid]
+                )
+                plan = plan_promotion(images, charts, self.deployment_dir)
+                promotion_manifest = apply_plan(
+                    plan, self.deployment_dir, self.backend, self.max_workers
+                )
+                manifests = attribute_manifest(promotion_manifest, owners)
+
+                # Merge the manifests of the requests again, so that each entry
+                # of the combined manifest names the request it came from.
+                combined: dict = {}
+                for request_id, manifest in manifests.items():
+                    merge_manifests(
+                        combined,
+                        {
+                            overlay: {
+                                section: [
+                                    {**entry, "request": request_id}
+                                    for entry in entries
+                                ]
+                                for section, entries in overlay_manifest.items()
+                            }
+                            for overlay, overlay_manifest in manifest.items()
+                        },
+                    )
+
+                committed = self.commit and commit_promotion(
+                    self.deployment_dir, promotion_manifest, [job.id for job in valid]
+                )
+            except PromotionError as e:
+                errors.append(str(e))
+                logger.warning(f"Promotion batch failed: {e}")
+                for job in valid:
+                    self.finish(job, "failed", errors=errors)
+                return
+            except Exception as e:
+                logger.error(f"Promotion batch failed: {e}")
+                for job in valid:
+                    self.finish(job, "failed", errors=errors)
+                return
+
+        batch = None
+        if len(jobs) > 1 or self.commit:
+            batch = {
+                "id": self._next_batch_id,
+                "requests": [job.id for job in valid],
+                "manifest": combined,
+                "committed": committed,
+            }
+            self._next_batch_id += 1
+
+        for job in valid:
+            # The entries of this job that a later job in the batch replaced
+            requested = {
+                (overlay, section, entry["name"])
+                for section, entries in (("images", job.images), ("charts", job.charts))
+                for entry in entries
+                for overlay in entry["overlays"]
+            }
+            superseded = [
+                {"overlay": overlay, "section": section, "name": name, "by": owner}
+                for (overlay, section, name), owner in owners.items()
+                if (overlay, section, name) in requested and owner != job.id
+            ]
+            self.finish(
+                job,
+                "succeeded",
+                manifest=manifests.get(job.id, {}),
+                superseded=superseded,
+                batch=batch,
+            )
+
+    def finish(
+        self,
+        job: PromotionJob,
+        status: str,
+        manifest: Optional[dict] = None,
+        superseded: Optional[list[dict]] = None,
+        batch: Optional[dict] = None,
+        errors: Optional[list[str]] = None,
+    ) -> None:
+        """
+        Record the result of a job and wake up anyone waiting for it.
+        """
+        job.status = status
+        job.manifest = manifest
+        job.superseded = superseded or []
+        job.batch = batch
+        job.errors = list(errors or [])
+        job.seconds = metrics.to_dict()["seconds"]
+        job.done.set()
+
+
+class PromotionRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the promotion API of `promote.py serve`.
+
+    - `POST /promotions` queues a promotion. The body is a JSON object with
+      `images` and/or `charts` lists in the same format as IMAGES_TO_UPDATE and
+      CHARTS_TO_UPDATE. Responds with the queued job, or with the finished job
+      if `?wait=true` is given.
+    - `GET /promotions/<id>` returns the status of a job, and its manifest or
+      errors once it has finished.
+    - `GET /healthz` returns the number of jobs waiting to be applied.
+    """
+
+    def do_GET(self) -> None:
+        path = urllib.parse.urlsplit(self.path).path
+        promotions = self.server.promotions  # type: ignore[attr-defined]
+        if path == "/healthz":
+            self.respond(200, {"status": "ok", "pending": promotions.pending()})
+            return
+
+        match = re.fullmatch(r"/promotions/(\d+)", path)
+        job = promotions.get(int(match.group(1))) if match else None
+        if job is None:
+            self.respond(404, {"error": f"{path} not found"})
+            return
+
+        self.respond(200, job.to_dict())
+
+    def do_POST(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/promotions":
+            self.respond(404, {"error": f"{url.path} not found"})
+            return
 
-    # Exit with failure if there are no images or charts to update, printing usage information.
-    validate_promotion_lists(images_to_update, charts_to_update)
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self.respond(400, {"error": f"The request body is not valid JSON: {e}"})
+            return
+
+        if not isinstance(body, dict) or not all(
+            isinstance(body.get(type, []), list) for type in ("images", "charts")
+        ):
+            self.respond(
+                400, {"error": "Expected a JSON object with images and/or charts lists"}
+            )
+            return
+
+        promotions = self.server.promotions  # type: ignore[attr-defined]
+        job = promotions.submit(body.get("images", []), body.get("charts", []))
+        if urllib.parse.parse_qs(url.query).get("wait") == ["true"]:
+            job.done.wait()
+            self.respond(200 if job.status == "succeeded" else 422, job.to_dict())
+            return
+
+        self.respond(202, job.to_dict())
+
+    def respond(self, status: int, body: dict) -> None:
+        """
+        Send a JSON response.
+        """
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"{self.command} {self.path}: " + format % args)
+
+
+class PromotionHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
 
-    # Get the list of images for each overlay
-    overlays_to_images = get_images_from_overlays(images_to_update, deployment_dir)
+    def __init__(self, address: tuple[str, int], promotions: PromotionQueue) -> None:
+        super().__init__(address, PromotionRequestHandler)
+        self.promotions = promotions
 
-    # Get the list of charts for each overlay
-    overlays_to_charts = get_charts_from_overlays(charts_to_update, deployment_dir)
 
-    # Create promotion manifest dictionary to store the promotion manifest
-    promotion_manifest = {}
+class PromotionUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
 
-    # Iterate through the overlays to images, updating the images in each env
-    for env, images in overlays_to_images.items():
-        promotion_manifest = update_kustomize_images(
-            env, deployment_dir, images, promotion_manifest
+    def __init__(self, path: str, promotions: PromotionQueue) -> None:
+        # Replace the socket left behind by a previous server
+        with contextlib.suppress(FileNotFoundError):
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        super().__init__(path, PromotionRequestHandler)
+        self.promotions = promotions
+
+
+def make_promotion_server(
+    promotions: PromotionQueue,
+) -> socketserver.BaseServer:
+    """
+    Create the server for `promote.py serve`, listening on the PROMOTE_SERVE_SOCKET
+    Unix socket if set, or on the PROMOTE_SERVE_ADDRESS host:port otherwise.
+
+    Args:
+        promotions (PromotionQueue): The queue to submit promotions to.
+
+    Returns:
+        socketserver.BaseServer: The server, bound but not yet serving.
+    """
+    socket_path = os.getenv("PROMOTE_SERVE_SOCKET")
+    if socket_path:
+        logger.info(f"Listening on {socket_path}")
+        return PromotionUnixServer(socket_path, promotions)
+
+    address = os.getenv("PROMOTE_SERVE_ADDRESS") or "127.0.0.1:8080"
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise ValidationError(
+            f"PROMOTE_SERVE_ADDRESS must be host:port, got {address}."
         )
 
-        if promotion_manifest[env]["images"] != {}:
-            logger.info(f"Images in {env} updated successfully.")
+    logger.info(f"Listening on http://{host}:{port}")
+    return PromotionHTTPServer((host, int(port)), promotions)
+
+
+def warm_kustomization_cache(deployment_dir: str) -> int:
+    """
+    Parse every kustomization file in the deployment directory into the cache.
+
+    Args:
+        deployment_dir (str): The deployment directory.
+
+    Returns:
+        int: The number of kustomization files loaded.
+    """
+    loaded = 0
+    for overlay in find_kustomization_dirs(deployment_dir):
+        kustomization_file = os.path.join(deployment_dir, overlay, "kustomization.yaml")
+        try:
+            kustomization_cache.load(kustomization_file)
+            kustomization_cache.splice(kustomization_file)
+        except (OSError, yaml.YAMLError) as e:
+            logger.warning(f"Skipping {kustomization_file}: {e}")
+            continue
+        loaded += 1
+
+    return loaded
+
+
+def serve() -> None:
+    """
+    Run promote.py as a long-running daemon that applies promotions submitted over HTTP.
+
+    The deployment directory is parsed once at startup and stays warm between
+    promotions, so each promotion costs only its own plan and writes. Promotions
+    that queue up are applied together, and optionally committed together, as
+    configured by PROMOTE_BATCH_WINDOW, PROMOTE_BATCH_SIZE and
+    PROMOTE_BATCH_COMMIT. See PromotionRequestHandler for the API.
+    """
+    image_backend = get_image_backend()
+
+    # kustomize is only needed to update images with the kustomize backend
+    if image_backend == "kustomize":
+        validate_runtime_environment()
 
-    # Iterate through the overlays to charts, updating the charts in each env
-    for env, charts in overlays_to_charts.items():
-        promotion_manifest = update_kustomize_charts(
-            env, deployment_dir, charts, promotion_manifest
+    deployment_dir = get_deployment_dir()
+
+    promotions = PromotionQueue(
+        deployment_dir,
+        image_backend,
+        get_max_workers(),
+        batch_window=get_batch_window(),
+        batch_size=get_batch_size(),
+        commit=os.getenv("PROMOTE_BATCH_COMMIT") == "true",
+    )
+
+    loaded = warm_kustomization_cache(deployment_dir)
+    logger.info(f"Loaded {loaded} kustomization files from {deployment_dir}")
+
+    server = make_promotion_server(promotions)
+
+    # Shut down cleanly when the container is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    promotions.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        promotions.stop()
+
+
+def find_references(name: str) -> None:
+    """
+    Print the overlays that reference the image or chart with the given name as JSON.
+
+    Args:
+        name (str): The image name or newName, or the chart name.
+    """
+    deployment_dir = get_deployment_dir()
+    index = load_kustomization_index(deployment_dir)
+    print(
+        json.dumps(
+            {"images": index.find_images(name), "charts": index.find_charts(name)}
         )
+    )
 
-        if promotion_manifest[env]["charts"] != {}:
-            logger.info(f"Charts in {env} updated successfully.")
+
+def main():
+    metrics.reset()
+    try:
+        with metrics.phase("main"):
+            promote()
+    except PromotionError as e:
+        logger.fatal(str(e))
+        exit(1)
+    finally:
+        write_metrics()
+        write_trace()
+
+
+def promote():
+    promoter = Promoter(get_deployment_dir(), get_image_backend(), get_max_workers())
+
+    plan_to_apply = os.getenv("PROMOTE_APPLY_PLAN")
+    if plan_to_apply:
+        # Apply a plan that was made by a previous run
+        with metrics.phase("load_input"):
+            plan = load_plan(plan_to_apply)
+    else:
+        with metrics.phase("load_input"):
+            # Read in the images to update from stdin or the IMAGES_TO_UPDATE env variable
+            images_to_update = load_promotion_json("images")
+
+            # Read in the helm charts to update from stdin or the HELM_CHARTS_TO_UPDATE env variable
+            charts_to_update = load_promotion_json("charts")
+
+        git_dir = os.getenv("PROMOTE_GIT_DIR")
+        if git_dir:
+            # Fail if there are no images or charts to update, with usage information.
+            with metrics.phase("validate"):
+                validate_promotion_lists(images_to_update, charts_to_update)
+
+            if promoter.backend == "kustomize":
+                with metrics.phase("validate_runtime_environment"):
+                    validate_runtime_environment()
+
+            # Commit straight to a branch of the repository, without a working tree
+            with metrics.phase("promote_in_repository"):
+                promotion_manifest, _ = promote_in_repository(
+                    git_dir,
+                    os.getenv("PROMOTE_GIT_REF") or "HEAD",
+                    images_to_update,
+                    charts_to_update,
+                    promoter.backend,
+                    promoter.max_workers,
+                    os.getenv("PROMOTE_COMMIT_MESSAGE") or None,
+                )
+            print(json.dumps(promotion_manifest))
+            exit(0)
+
+        plan = promoter.plan(images_to_update, charts_to_update)
+
+    plan_file = os.getenv("PROMOTE_PLAN_FILE")
+    if plan_file:
+        try:
+            with open(plan_file, "w") as f:
+                json.dump(plan, f, indent=2)
+        except OSError as e:
+            raise PromotionError(
+                f"Failed to write the promotion plan to {plan_file}: {e}"
+            ) from e
+
+    # A plan made by a previous run is always applied, to check that the overlays
+    # still have the planned values
+    result = promoter.apply(
+        plan,
+        dry_run=os.getenv("PROMOTE_PLAN_ONLY") == "true",
+        recheck=bool(plan_to_apply),
+    )
+    write_changed_files(result.changed)
 
     # If we made it this far, all of the images and/or charts were updated successfully.
     # Write the promotion manifest to stdout so it can be captured by the caller.
-    print(json.dumps(promotion_manifest))
+    print(json.dumps(result.manifest))
 
     exit(0)
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        if sys.argv[1:] == ["serve"]:
+            serve()
+        elif sys.argv[1:2] == ["find"] and len(sys.argv) == 3:
+            find_references(sys.argv[2])
+        else:
+            main()
+    except PromotionError as e:
+        logger.fatal(str(e))
+        sys.exit(1)
@@ -0,0 +1,286 @@
+import logging
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+import promote as promote
+
+
+class TestPromoteInRepository(unittest.TestCase):
+    def setUp(self):
+        self.level = promote.logger.level
+        promote.logger.setLevel(logging.CRITICAL)
+        self.tmp = tempfile.TemporaryDirectory()
+        environment = mock.patch.dict(
+            os.environ,
+            {
+                "GIT_AUTHOR_NAME": "test",
+                "GIT_AUTHOR_EMAIL": "test@example.com",
+                "GIT_COMMITTER_NAME": "test",
+                "GIT_COMMITTER_EMAIL": "test@example.com",
+            },
+        )
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        # Build the repository in a work tree, then promote against a bare clone
+        work_tree = os.path.join(self.tmp.name, "work")
+        files = {
+            "env/dev/kustomization.yaml": "images:\n- name: foo\n  newName: foo\n  newTag: v1 # dev\n",
+            "env/prod/kustomization.yaml": "images:\n- name: foo\n  newName: foo\n  newTag: v0\n",
+            "env/prod/deployment.yaml": "kind: Deployment\n",
+            "README.md": "deploy\n",
+        }
+        for path, text in files.items():
+            os.makedirs(os.path.join(work_tree, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(work_tree, path), "w") as f:
+                f.write(text)
+        self.git(work_tree, "init", "-q", "-b", "main")
+        self.git(work_tree, "add", ".")
+        self.git(work_tree, "commit", "-q", "-m", "Initial commit")
+        self.git_dir = os.path.join(self.tmp.name, "deploy.git")
+        self.git(self.tmp.name, "clone", "-q", "--bare", work_tree, self.git_dir)
+        self.initial = self.git(self.git_dir, "rev-parse", "main")
+        promote.kustomization_cache.clear()
+
+    def tearDown(self):
+        promote.kustomization_cache.clear()
+        promote.logger.setLevel(self.level)
+        self.tmp.cleanup()
+
+    def git(self, cwd, *args):
+        return subprocess.run(
+            ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+        ).stdout.strip()
+
+    def test_commit(self):
+        manifest, commit = promote.promote_in_repository(
+            self.git_dir,
+            "main",
+            [{"name": "foo", "newTag": "v2", "overlays": ["env/prod"]}],
+            [],
+        )
+        self.assertEqual(
+            manifest,
+            {
+                "env/prod": {
+                    "images": [{"name": "foo", "newName": "foo", "newTag": "v2"}]
+                }
+            },
+        )
+        self.assertEqual(self.git(self.git_dir, "rev-parse", "main"), commit)
+        self.assertEqual(self.git(self.git_dir, "rev-parse", "main^"), self.initial)
+        self.assertEqual(
+            self.git(self.git_dir, "show", "main:env/prod/kustomization.yaml"),
+            "images:\n- name: foo\n  newName: foo\n  newTag: v2",
+        )
+        self.assertEqual(
+            self.git(self.git_dir, "diff", "--name-only", self.initial, "main"),
+            "env/prod/kustomization.yaml",
+        )
+
+    def test_from_overlay_pattern(self):
+        manifest, commit = promote.promote_in_repository(
+            self.git_dir,
+            "HEAD",
+            [{"name": "foo", "fromOverlay": "env/dev", "overlays": "*"}],
+            [],
+        )
+        self.assertEqual(list(manifest), ["env/prod"])
+        self.assertEqual(
+            self.git(self.git_dir, "show", "main:env/prod/kustomization.yaml"),
+            "images:\n- name: foo\n  newName: foo\n  newTag: v1",
+        )
+
+    def test_unchanged(self):
+        _, commit = promote.promote_in_repository(
+            self.git_dir,
+            "main",
+            [{"name": "foo", "newTag": "v1", "overlays": ["env/dev"]}],
+            [],
+        )
+        self.assertIsNone(commit)
+        self.assertEqual(self.git(self.git_dir, "rev-parse", "main"), self.initial)
+
+    def test_from_ref(self):
+        work_tree = os.path.join(self.tmp.name, "work")
+        self.git(work_tree, "tag", "release-1")
+        with open(os.path.join(work_tree, "env/dev/kustomization.yaml"), "w") as f:
+            f.write("images:\n- name: foo\n  newName: foo\n  newTag: v3\n")
+        self.git(work_tree, "commit", "-q", "-am", "Promote v3 to dev")
+        self.git(work_tree, "push", "-q", "--tags", self.git_dir, "main")
+
+        manifest, _ = promote.promote_in_repository(
+            self.git_dir,
+            "main",
+            [
+                {
+                    "name": "foo",
+                    "fromOverlay": "env/dev",
+                    "fromRef": "release-1",
+                    "overlays": ["env/prod"],
+                }
+            ],
+            [],
+        )
+        self.assertEqual(manifest["env/prod"]["images"][0]["newTag"], "v1")
+
+    def test_not_a_branch(self):
+        with self.assertRaises(promote.ValidationError):
+            promote.promote_in_repository(
+                self.git_dir,
+                self.initial,
+                [{"name": "foo", "newTag": "v2", "overlays": ["env/dev"]}],
+                [],
+            )
+
+
+class TestFromRef(unittest.TestCase):
+    def setUp(self):
+        self.level = promote.logger.level
+        promote.logger.setLevel(logging.CRITICAL)
+        self.tmp = tempfile.TemporaryDirectory()
+        environment = mock.patch.dict(
+            os.environ,
+            {
+                "GIT_AUTHOR_NAME": "test",
+                "GIT_AUTHOR_EMAIL": "test@example.com",
+                "GIT_COMMITTER_NAME": "test",
+                "GIT_COMMITTER_EMAIL": "test@example.com",
+            },
+        )
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        # The deployment directory is a subdirectory of the repository
+        self.deployment_dir = os.path.join(self.tmp.name, "deploy")
+        self.write(
+            "images:\n- name: foo\n  newTag: v1\nhelmCharts:\n- name: bar\n  version: 1.0.0\n"
+        )
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "Initial commit")
+        self.git("tag", "release-1")
+        self.write(
+            "images:\n- name: foo\n  newTag: v2\nhelmCharts:\n- name: bar\n  version: 2.0.0\n"
+        )
+        promote.kustomization_cache.clear()
+        promote.metrics.reset()
+
+    def tearDown(self):
+        store, _ = promote._git_object_stores.pop(self.deployment_dir, (None, None))
+        if store is not None:
+            store.close()
+        promote._kustomizations_at_refs.clear()
+        promote.kustomization_cache.clear()
+        promote.logger.setLevel(self.level)
+        self.tmp.cleanup()
+
+    def write(self, text):
+        os.makedirs(os.path.join(self.deployment_dir, "env", "dev"), exist_ok=True)
+        with open(
+            os.path.join(self.deployment_dir, "env", "dev", "kustomization.yaml"), "w"
+        ) as f:
+            f.write(text)
+
+    def git(self, *args):
+        return subprocess.run(
+            ["git", *args], cwd=self.tmp.name, check=True, capture_output=True
+        )
+
+    def test_read_at_ref(self):
+        images = promote.get_images_from_overlays(
+            [
+                {"name": "foo", "fromOverlay": "env/dev", "overlays": ["env/prod"]},
+                {
+                    "name": "foo",
+                    "fromOverlay": "env/dev",
+                    "fromRef": "release-1",
+                    "overlays": ["env/qa"],
+                },
+            ],
+            self.deployment_dir,
+        )
+        self.assertEqual(images["env/prod"][0]["newTag"], "v2")
+        self.assertEqual(images["env/qa"][0]["newTag"], "v1")
+
+        charts = promote.get_charts_from_overlays(
+            [
+                {
+                    "name": "bar",
+                    "fromOverlay": "env/dev",
+                    "fromRef": "release-1",
+                    "overlays": ["env/qa"],
+                }
+            ],
+            self.deployment_dir,
+        )
+        self.assertEqual(charts["env/qa"][0]["version"], "1.0.0")
+
+        # Both reads went through one rev-parse and a single cat-file process
+        self.assertEqual(promote.metrics.counters["git_objects_read"], 2)
+        self.assertEqual(promote.metrics.counters["subprocesses"], 2)
+
+    def test_missing_at_ref(self):
+        with self.assertRaises(promote.OverlayNotFoundError):
+            promote.read_images_from_overlay(
+                "env/prod", self.deployment_dir, "release-1"
+            )
+        with self.assertRaises(promote.OverlayNotFoundError):
+            promote.read_images_from_overlay(
+                "env/dev", self.deployment_dir, "release-2"
+            )
+
+    def test_missing_path_with_space_at_ref(self):
+        with self.assertRaises(promote.OverlayNotFoundError):
+            promote.read_images_from_overlay(
+                "env/a b", self.deployment_dir, "release-1"
+            )
+
+    def test_path_with_space_at_ref(self):
+        os.makedirs(os.path.join(self.deployment_dir, "env", "a b"))
+        with open(
+            os.path.join(self.deployment_dir, "env", "a b", "kustomization.yaml"), "w"
+        ) as f:
+            f.write("images:\n- name: foo\n  newTag: v3\n")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "Add an overlay with a space")
+        self.git("tag", "release-2")
+
+        images = promote.read_images_from_overlay(
+            "env/a b", self.deployment_dir, "release-2"
+        )
+        self.assertEqual(images["foo"]["newTag"], "v3")
+
+    def test_invalid_encoding_at_ref(self):
+        with open(
+            os.path.join(self.deployment_dir, "env", "dev", "kustomization.yaml"), "wb"
+        ) as f:
+            f.write(b"images:\n- name: foo\n  newTag: \xff\n")
+        self.git("commit", "-q", "-am", "Break the encoding")
+        self.git("tag", "release-2")
+        with self.assertRaises(promote.KustomizationError):
+            promote.read_images_from_overlay(
+                "env/dev", self.deployment_dir, "release-2"
+            )
+
+    def test_dead_cat_file(self):
+        store, _ = promote.git_object_store(self.deployment_dir)
+        store.read("release-1")
+        store._batch.kill()
+        store._batch.wait()
+        with self.assertRaises(promote.CommandError):
+            store.read("release-1:deploy/env/dev/kustomization.yaml")
+        store._batch = None
+
+    def test_from_ref_requires_from_overlay(self):
+        self.assertFalse(
+            promote.validate_images(
+                [{"name": "foo", "newTag": "v1", "fromRef": "release-1"}]
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
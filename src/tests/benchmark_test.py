@@ -0,0 +1,50 @@
+import logging
+import os
+import tempfile
+import unittest
+import benchmark as benchmark
+import promote as promote
+
+
+class TestGenerateDeploymentRepo(unittest.TestCase):
+    def test_layout(self):
+        with tempfile.TemporaryDirectory() as root:
+            targets = benchmark.generate_deployment_repo(root, 12, 2, 1, 3, depth=3)
+            self.assertEqual(
+                targets[11], os.path.join("group-0", "group-1", "overlay-11")
+            )
+            promote.kustomization_cache.clear()
+            self.assertEqual(
+                promote.read_images_from_overlay("source", root)["image-1"]["newTag"],
+                "2.0.0",
+            )
+            kustomization = promote.kustomization_cache.load(
+                os.path.join(root, targets[11], "kustomization.yaml")
+            )
+            self.assertEqual(kustomization["resources"], ["../../../base"])
+            self.assertEqual(len(kustomization["helmCharts"][0]["valuesInline"]), 3)
+            promote.kustomization_cache.clear()
+
+
+class TestMeasure(unittest.TestCase):
+    def setUp(self):
+        self.level = promote.logger.level
+        promote.logger.setLevel(logging.WARNING)
+
+    def tearDown(self):
+        promote.logger.setLevel(self.level)
+        promote.kustomization_cache.clear()
+
+    def test_measure(self):
+        dimensions = {
+            "overlays": 2,
+            "images": 2,
+            "charts": 1,
+            "values_size": 1,
+            "depth": 1,
+        }
+        result = benchmark.measure(dimensions, 1, {"PROMOTE_IMAGE_BACKEND": "native"})
+        for phase in ["load_input", "validate", "plan", "apply"]:
+            self.assertIn(phase, result["phases"])
+        self.assertGreater(result["main"], 0)
+        self.assertGreater(result["peakMemoryMiB"], 0)
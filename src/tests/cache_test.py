@@ -0,0 +1,122 @@
+import os
+import tempfile
+import unittest
+import yaml
+import promote as promote
+
+kustomization = """images:
+- name: foo
+  newName: quz
+  newTag: whizbang
+helmCharts:
+- name: lighthouse
+  version: 1.0.0
+"""
+
+
+class TestKustomizationCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.deployment_dir = self.tmp.name
+        os.makedirs(os.path.join(self.deployment_dir, "env", "dev"))
+        self.kustomization_file = os.path.join(
+            self.deployment_dir, "env", "dev", "kustomization.yaml"
+        )
+        with open(self.kustomization_file, "w") as f:
+            f.write(kustomization)
+        promote.kustomization_cache.clear()
+
+    def tearDown(self):
+        promote.kustomization_cache.clear()
+        self.tmp.cleanup()
+
+    def test_parsed_once(self):
+        images_to_update = [
+            {"name": "foo", "fromOverlay": "env/dev", "overlays": ["a", "b", "c"]}
+        ]
+        charts_to_update = [
+            {"name": "lighthouse", "fromOverlay": "env/dev", "overlays": ["a", "b"]}
+        ]
+        overlays_to_images = promote.get_images_from_overlays(
+            images_to_update, self.deployment_dir
+        )
+        overlays_to_charts = promote.get_charts_from_overlays(
+            charts_to_update, self.deployment_dir
+        )
+        # Only the images and the helmCharts sections are parsed, once each
+        self.assertEqual(promote.kustomization_cache.parses, 0)
+        self.assertEqual(promote.kustomization_cache.section_parses, 2)
+        self.assertEqual(
+            overlays_to_images["c"],
+            [{"name": "foo", "newName": "quz", "newTag": "whizbang"}],
+        )
+        self.assertEqual(
+            overlays_to_charts["b"], [{"name": "lighthouse", "version": "1.0.0"}]
+        )
+
+    def test_reparsed_when_changed(self):
+        promote.read_images_from_overlay("env/dev", self.deployment_dir)
+        with open(self.kustomization_file, "w") as f:
+            f.write(kustomization.replace("whizbang", "whizbang-2"))
+        images = promote.read_images_from_overlay("env/dev", self.deployment_dir)
+        self.assertEqual(promote.kustomization_cache.section_parses, 2)
+        self.assertEqual(images["foo"]["newTag"], "whizbang-2")
+
+    def test_parsed_document_is_reused(self):
+        promote.kustomization_cache.load(self.kustomization_file)
+        promote.read_charts_from_overlay("env/dev", self.deployment_dir)
+        self.assertEqual(promote.kustomization_cache.parses, 1)
+        self.assertEqual(promote.kustomization_cache.section_parses, 0)
+
+    def test_missing_file(self):
+        with self.assertRaises(promote.OverlayNotFoundError):
+            promote.read_images_from_overlay("env/prod", self.deployment_dir)
+
+
+class TestLoadKustomizationSection(unittest.TestCase):
+    def test_only_requested_fields(self):
+        text = """resources: [../../base]
+helmCharts:
+- name: lighthouse
+  version: 1.0.0
+  releaseName: tillamook
+  valuesInline:
+    beams: [1, 2, 3]
+    keeper: {name: bob}
+- {name: foghorn, version: "2.0"}
+patches:
+- patch: |
+    - op: replace
+"""
+        self.assertEqual(
+            promote.load_kustomization_section(text, "helmCharts"),
+            {
+                "helmCharts": [
+                    {
+                        "name": "lighthouse",
+                        "version": "1.0.0",
+                        "releaseName": "tillamook",
+                    },
+                    {"name": "foghorn", "version": "2.0"},
+                ]
+            },
+        )
+        self.assertEqual(promote.load_kustomization_section(text, "images"), {})
+        self.assertEqual(promote.load_kustomization_section("", "images"), {})
+
+    def test_aliases_fall_back_to_full_parse(self):
+        text = """tag: &tag v1
+images:
+- name: foo
+  newTag: *tag
+- <<: {name: bar}
+  newTag: v2
+"""
+        self.assertEqual(
+            promote.load_kustomization_section(text, "images")["images"],
+            [{"name": "foo", "newTag": "v1"}, {"name": "bar", "newTag": "v2"}],
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(yaml.YAMLError):
+            promote.load_kustomization_section("images: []\nfoo: [\n", "images")
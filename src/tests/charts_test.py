@@ -1,4 +1,11 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
 import unittest
+from unittest import mock
 import promote as promote
 
 overlay_no_name_or_version = [{"name": "lighthouse", "overlays": ["bar"]}]
@@ -83,3 +90,308 @@ class TestGetChartsFromOverlays(unittest.TestCase):
                 ]
             },
         )
+
+
+class TestUpdateKustomizeCharts(unittest.TestCase):
+    kustomization = """images:
+- name: foo
+  newName: foo
+  newTag: old
+helmCharts:
+- name: lighthouse
+  version: 1.0.0 # pinned
+  valuesInline:
+    beam: bright
+"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, "env", "dev"))
+        self.kustomization_file = os.path.join(
+            self.tmp.name, "env", "dev", "kustomization.yaml"
+        )
+        with open(self.kustomization_file, "w") as f:
+            f.write(self.kustomization)
+        promote.kustomization_cache.clear()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        promote.kustomization_cache.clear()
+        self.tmp.cleanup()
+
+    def test_update_version(self):
+        new_version = [{"name": "lighthouse", "version": "1.1.0", "overlays": ["bar"]}]
+        self.assertEqual(
+            promote.update_kustomize_charts("env/dev", self.tmp.name, new_version, {}),
+            {"env/dev": {"charts": [{"name": "lighthouse", "version": "1.1.0"}]}},
+        )
+        with open(self.kustomization_file) as f:
+            self.assertEqual(f.read(), self.kustomization.replace("1.0.0", "1.1.0"))
+        self.assertEqual(promote.kustomization_cache.parses, 0)
+
+    def test_update_images_and_charts(self):
+        new_version = [{"name": "lighthouse", "version": "1.1.0", "overlays": ["bar"]}]
+        new_tag = [{"name": "foo", "newTag": "new", "overlays": ["bar"]}]
+        self.assertEqual(
+            promote.update_kustomize_overlay(
+                "env/dev", self.tmp.name, new_tag, new_version, {}, "native"
+            ),
+            {
+                "env/dev": {
+                    "images": [{"name": "foo", "newName": "foo", "newTag": "new"}],
+                    "charts": [{"name": "lighthouse", "version": "1.1.0"}],
+                }
+            },
+        )
+        with open(self.kustomization_file) as f:
+            self.assertEqual(
+                f.read(),
+                self.kustomization.replace("1.0.0", "1.1.0").replace("old", "new"),
+            )
+        self.assertEqual(promote.kustomization_cache.reads, 1)
+        self.assertEqual(promote.kustomization_cache.parses, 0)
+
+    def test_missing_chart(self):
+        with self.assertRaises(promote.ChartNotFoundError):
+            promote.update_kustomize_charts(
+                "env/dev",
+                self.tmp.name,
+                [{"name": "foghorn", "version": "1.0.0", "overlays": ["env/dev"]}],
+                {},
+            )
+
+
+class TestPlanPromotion(unittest.TestCase):
+    kustomization = """images:
+- name: foo
+  newTag: old
+helmCharts:
+- name: lighthouse
+  version: 1.0.0
+"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for overlay in ("env/dev", "env/prod"):
+            os.makedirs(os.path.join(self.tmp.name, overlay))
+            with open(
+                os.path.join(self.tmp.name, overlay, "kustomization.yaml"), "w"
+            ) as f:
+                f.write(self.kustomization)
+        promote.kustomization_cache.clear()
+
+    def tearDown(self):
+        promote.kustomization_cache.clear()
+        self.tmp.cleanup()
+
+    def test_plan_and_apply(self):
+        plan = promote.plan_promotion(
+            [{"name": "foo", "newTag": "new", "overlays": ["env/prod"]}],
+            [
+                {
+                    "name": "lighthouse",
+                    "fromOverlay": "env/dev",
+                    "overlays": ["env/prod"],
+                }
+            ],
+            self.tmp.name,
+        )
+        self.assertEqual(
+            plan["overlays"],
+            {
+                "env/prod": [
+                    {
+                        "kind": "image",
+                        "name": "foo",
+                        "set": {"newName": "foo", "newTag": "new"},
+                        "before": {"newTag": "old"},
+                        "after": {"newName": "foo", "newTag": "new"},
+                    },
+                    {
+                        "kind": "chart",
+                        "name": "lighthouse",
+                        "index": 0,
+                        "set": {"version": "1.0.0"},
+                        "before": {"version": "1.0.0"},
+                        "after": {"version": "1.0.0"},
+                    },
+                ]
+            },
+        )
+        manifest = promote.manifest_from_plan(plan)
+        self.assertEqual(promote.apply_plan(plan, self.tmp.name, "native"), manifest)
+        # Applying the plan again is a no-op
+        self.assertEqual(promote.apply_plan(plan, self.tmp.name, "native"), manifest)
+
+    def test_changed_overlays(self):
+        plan = promote.plan_promotion(
+            [{"name": "foo", "newTag": "new", "overlays": ["env/prod"]}],
+            [{"name": "lighthouse", "version": "1.0.0", "overlays": ["env/dev"]}],
+            self.tmp.name,
+        )
+        self.assertEqual(promote.changed_overlays(plan), ["env/prod"])
+
+        # An overlay that already has the planned values is left alone
+        promote.metrics.reset()
+        promote.apply_plan(plan, self.tmp.name, "native")
+        self.assertEqual(promote.metrics.counters["files_written"], 1)
+        promote.metrics.reset()
+        promote.apply_plan(plan, self.tmp.name, "native")
+        self.assertNotIn("files_written", promote.metrics.counters)
+
+    def test_noop_promotion(self):
+        for overlay in ("env/dev", "env/prod"):
+            with open(
+                os.path.join(self.tmp.name, overlay, "kustomization.yaml"), "w"
+            ) as f:
+                f.write(
+                    self.kustomization.replace("  newTag", "  newName: foo\n  newTag")
+                )
+        changed_files = os.path.join(self.tmp.name, "changed-files.txt")
+        environment = {
+            "DEPLOYMENT_DIR": self.tmp.name,
+            "IMAGES_TO_UPDATE": json.dumps(
+                [{"name": "foo", "newTag": "old", "overlays": ["env/dev", "env/prod"]}]
+            ),
+            "PROMOTE_CHANGED_FILES": changed_files,
+            "PROMOTE_IMAGE_BACKEND": "kustomize",
+        }
+        promote.metrics.reset()
+        stdout = io.StringIO()
+        with mock.patch.dict(os.environ, environment), contextlib.redirect_stdout(
+            stdout
+        ):
+            with self.assertRaises(SystemExit) as exited:
+                promote.promote()
+        self.assertEqual(exited.exception.code, 0)
+
+        # Nothing is written and kustomize is never run, not even to check for it
+        self.assertEqual(list(json.loads(stdout.getvalue())), ["env/dev", "env/prod"])
+        self.assertNotIn("subprocesses", promote.metrics.counters)
+        self.assertNotIn("files_written", promote.metrics.counters)
+        with open(changed_files) as f:
+            self.assertEqual(f.read(), "")
+
+    def test_apply_with_kustomize(self):
+        # A stub kustomize that sets images like `kustomize edit set image` and
+        # records the directory it was run in
+        bin_dir = os.path.join(self.tmp.name, "bin")
+        os.makedirs(bin_dir)
+        calls = os.path.join(self.tmp.name, "calls.txt")
+        kustomize = os.path.join(bin_dir, "kustomize")
+        with open(kustomize, "w") as f:
+            f.write(
+                f"""#!{sys.executable}
+import os, sys, yaml
+with open({calls!r}, "a") as f:
+    f.write(os.getcwd() + "\\n")
+with open("kustomization.yaml") as f:
+    kustomization = yaml.safe_load(f)
+for arg in sys.argv[4:]:
+    name, _, image = arg.partition("=")
+    new_name, _, new_tag = image.partition(":")
+    for entry in kustomization["images"]:
+        if entry["name"] == name:
+            entry["newName"] = new_name
+            entry["newTag"] = new_tag
+with open("kustomization.yaml", "w") as f:
+    yaml.safe_dump(kustomization, f, sort_keys=False)
+"""
+            )
+        os.chmod(kustomize, 0o755)
+
+        plan = promote.plan_promotion(
+            [{"name": "foo", "newTag": "new", "overlays": ["env/prod"]}],
+            [{"name": "lighthouse", "version": "2.0.0", "overlays": ["env/prod"]}],
+            self.tmp.name,
+        )
+        path = os.path.join(self.tmp.name, "env/prod", "kustomization.yaml")
+        staged = promote.StagedWrites()
+        path_env = bin_dir + os.pathsep + os.environ.get("PATH", "")
+        with mock.patch.dict(os.environ, {"PATH": path_env}):
+            manifest = promote.apply_overlay_plan(
+                "env/prod",
+                self.tmp.name,
+                plan["overlays"]["env/prod"],
+                "kustomize",
+                staged,
+            )
+        self.assertEqual(
+            manifest,
+            {
+                "env/prod": {
+                    "images": [{"name": "foo", "newName": "foo", "newTag": "new"}],
+                    "charts": [{"name": "lighthouse", "version": "2.0.0"}],
+                }
+            },
+        )
+
+        # kustomize ran once, on a copy of the kustomization file
+        with open(calls) as f:
+            ran_in = f.read().splitlines()
+        self.assertEqual(len(ran_in), 1)
+        self.assertNotEqual(
+            os.path.realpath(ran_in[0]),
+            os.path.realpath(os.path.dirname(path)),
+        )
+
+        # The image and chart edits are staged together, and the original file
+        # is only replaced at commit
+        expected = (
+            "images:\n- name: foo\n  newTag: new\n  newName: foo\n"
+            "helmCharts:\n- name: lighthouse\n  version: 2.0.0\n"
+        )
+        self.assertEqual(staged.contents, {path: expected})
+        with open(path) as f:
+            self.assertEqual(f.read(), self.kustomization)
+        self.assertEqual(staged.commit(), [path])
+        with open(path) as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_failed_apply_writes_nothing(self):
+        plan = promote.plan_promotion(
+            [{"name": "foo", "newTag": "new", "overlays": ["env/dev", "env/prod"]}],
+            [],
+            self.tmp.name,
+        )
+        with open(
+            os.path.join(self.tmp.name, "env/prod", "kustomization.yaml"), "w"
+        ) as f:
+            f.write(self.kustomization.replace("old", "other"))
+        with self.assertRaises(promote.KustomizationError):
+            promote.apply_plan(plan, self.tmp.name, "native")
+
+        # env/dev was updated before env/prod failed, but was never written
+        with open(os.path.join(self.tmp.name, "env/dev", "kustomization.yaml")) as f:
+            self.assertEqual(f.read(), self.kustomization)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tmp.name, "env/dev"))),
+            ["kustomization.yaml"],
+        )
+
+    def test_staged_writes_skip_unchanged_files(self):
+        path = os.path.join(self.tmp.name, "env/dev", "kustomization.yaml")
+        staged = promote.StagedWrites()
+        staged.stage(path, self.kustomization)
+        self.assertEqual(staged.commit(), [])
+
+        os.chmod(path, 0o640)
+        staged.stage(path, self.kustomization.replace("old", "new"))
+        self.assertEqual(staged.commit(), [path])
+        with open(path) as f:
+            self.assertEqual(f.read(), self.kustomization.replace("old", "new"))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+
+    def test_stale_plan(self):
+        plan = promote.plan_promotion(
+            [{"name": "foo", "newTag": "new", "overlays": ["env/prod"]}],
+            [],
+            self.tmp.name,
+        )
+        with open(
+            os.path.join(self.tmp.name, "env/prod", "kustomization.yaml"), "w"
+        ) as f:
+            f.write(self.kustomization.replace("old", "other"))
+        with self.assertRaises(promote.KustomizationError):
+            promote.apply_plan(plan, self.tmp.name, "native")
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 import promote as promote
 
@@ -35,6 +37,89 @@ class TestValidateImagesFromOverlays(unittest.TestCase):
         )
 
 
+class TestValidatePromotions(unittest.TestCase):
+    def test_collects_every_error(self):
+        errors = promote.validate_promotions(
+            [
+                {"name": "foo", "newTag": "v1", "overlays": ["dev", "dev"]},
+                {"newTag": "v1", "overlays": ["dev"]},
+                {"name": "foo", "newName": "quz", "fromOverlay": "dev"},
+                {"name": "bar", "newName": "quz", "overlays": ["dev"]},
+            ],
+            [{"name": "lighthouse", "fromRef": "v1", "overlays": "*"}],
+        )
+        self.assertEqual(
+            [
+                (error["section"], error["index"], error["name"], error["field"])
+                for error in errors
+            ],
+            [
+                ("images", 0, "foo", "overlays"),
+                ("images", 1, None, "name"),
+                ("images", 2, "foo", "newName"),
+                ("images", 2, "foo", "overlays"),
+                ("images", 2, "foo", "name"),
+                ("images", 3, "bar", "newName"),
+                ("charts", 0, "lighthouse", "fromRef"),
+                ("charts", 0, "lighthouse", None),
+            ],
+        )
+        self.assertEqual(
+            errors[4]["message"],
+            "Found duplicate image name foo (also used by entry 0). Images must have unique names.",
+        )
+
+    def test_validation_error(self):
+        with self.assertRaises(promote.ValidationError) as raised:
+            promote.validate_promotion_lists(
+                [{"name": "foo", "overlays": ["dev"]}, {"name": "foo"}], []
+            )
+        error = raised.exception.to_dict()
+        self.assertEqual(error["type"], "ValidationError")
+        self.assertEqual(len(error["errors"]), 4)
+        self.assertIn(
+            "images[1]: Image foo is missing the required 'overlays' field.",
+            error["message"],
+        )
+
+    def test_unhashable_overlay(self):
+        with self.assertRaises(promote.ValidationError) as raised:
+            promote.validate_promotion_lists(
+                [{"name": "a", "newTag": "1", "overlays": [{"a": 1}, "dev", "dev"]}],
+                [],
+            )
+        self.assertEqual(
+            [error["message"] for error in raised.exception.errors],
+            [
+                "Image a has a non-string overlay.",
+                "Image a targets the overlay dev more than once.",
+            ],
+        )
+
+    def test_not_a_list(self):
+        for images in [None, {"name": "foo", "newTag": "v1"}, "foo"]:
+            with self.assertRaises(promote.ValidationError) as raised:
+                promote.validate_promotion_lists(images, [])
+            self.assertEqual(
+                raised.exception.errors,
+                [
+                    {
+                        "section": "images",
+                        "index": None,
+                        "name": None,
+                        "field": None,
+                        "message": f"The images must be a list, got {type(images).__name__}.",
+                    }
+                ],
+            )
+
+    def test_kustomization_entries(self):
+        # The images of a kustomization have no overlays
+        self.assertTrue(
+            promote.validate_images({"foo": {"name": "foo", "newTag": "v1"}})
+        )
+
+
 class TestGetImagesFromOverlays(unittest.TestCase):
     def test_empty(self):
         self.assertEqual(promote.get_images_from_overlays([], "."), {})
@@ -73,6 +158,44 @@ class TestGetImagesFromOverlays(unittest.TestCase):
         )
 
 
+class TestImagePromotion(unittest.TestCase):
+    def test_from_dict(self):
+        image = promote.ImagePromotion.from_dict(overlay_new_name_and_tag[0])
+        self.assertEqual(
+            image,
+            promote.ImagePromotion("foo", "quz", "whizbang", overlays=("bar",)),
+        )
+        self.assertEqual(
+            image.kustomize_edit(),
+            (
+                "foo=quz:whizbang",
+                {"name": "foo", "newName": "quz", "newTag": "whizbang"},
+            ),
+        )
+        with self.assertRaises(AttributeError):
+            image.new_tag = "other"
+
+    def test_names_are_interned(self):
+        first, second = (
+            promote.ImagePromotion.from_dict(
+                {"name": "".join(["f", "oo"]), "newTag": "v1", "overlays": [overlay]}
+            )
+            for overlay in ["".join(["b", "ar"]), "".join(["ba", "r"])]
+        )
+        self.assertIs(first.name, second.name)
+        self.assertIs(first.overlays[0], second.overlays[0])
+
+    def test_overlay_states_share_promotions(self):
+        images = [promote.ImagePromotion("foo", new_tag="v1", overlays=("a", "b"))]
+        charts = [promote.ChartPromotion("bar", version="1.0.0", overlays=("b",))]
+        states = promote.overlay_states(images, charts, ".")
+        self.assertEqual(list(states), ["a", "b"])
+        self.assertIs(states["a"].images[0], states["b"].images[0])
+        self.assertEqual(
+            states["b"], promote.OverlayState(tuple(images), tuple(charts))
+        )
+
+
 class TestGenerateKustomizeArgs(unittest.TestCase):
     def test_empty(self):
         # Test that an empty list of images returns an empty list of args
@@ -113,3 +236,110 @@ class TestGenerateKustomizeArgs(unittest.TestCase):
                 },
             ),
         )
+
+
+class TestParseKustomizeImageArg(unittest.TestCase):
+    def test_new_name(self):
+        self.assertEqual(
+            promote.parse_kustomize_image_arg("foo=quz"),
+            {"name": "foo", "newName": "quz"},
+        )
+
+    def test_new_name_and_tag(self):
+        self.assertEqual(
+            promote.parse_kustomize_image_arg("foo=registry:5000/quz:whizbang"),
+            {"name": "foo", "newName": "registry:5000/quz", "newTag": "whizbang"},
+        )
+
+    def test_digest(self):
+        self.assertEqual(
+            promote.parse_kustomize_image_arg("foo@sha256:abc"),
+            {"name": "foo", "digest": "sha256:abc"},
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            promote.parse_kustomize_image_arg("foo")
+
+
+class TestSetKustomizationImages(unittest.TestCase):
+    def test_update_existing(self):
+        kustomization = {
+            "images": [
+                {"name": "foo", "newName": "quz", "digest": "sha256:abc"},
+                {"name": "bar", "newTag": "1.0.0"},
+            ]
+        }
+        self.assertEqual(
+            promote.set_kustomization_images(kustomization, ["foo=foo:whizbang"]),
+            {
+                "images": [
+                    {"name": "bar", "newTag": "1.0.0"},
+                    {"name": "foo", "newName": "foo", "newTag": "whizbang"},
+                ]
+            },
+        )
+
+    def test_keep_tag_when_only_name_is_set(self):
+        kustomization = {"images": [{"name": "foo", "newTag": "1.0.0"}]}
+        self.assertEqual(
+            promote.set_kustomization_images(kustomization, ["foo=quz"]),
+            {"images": [{"name": "foo", "newName": "quz", "newTag": "1.0.0"}]},
+        )
+
+    def test_add_missing(self):
+        kustomization = {"resources": ["../../base"]}
+        self.assertEqual(
+            promote.set_kustomization_images(
+                kustomization, ["foo=quz:whizbang", "app=app@sha256:abc"]
+            ),
+            {
+                "resources": ["../../base"],
+                "images": [
+                    {"name": "app", "newName": "app", "digest": "sha256:abc"},
+                    {"name": "foo", "newName": "quz", "newTag": "whizbang"},
+                ],
+            },
+        )
+
+
+class TestUpdateOverlays(unittest.TestCase):
+    overlays = ["env/dev", "env/staging", "env/prod"]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for overlay in self.overlays:
+            os.makedirs(os.path.join(self.tmp.name, overlay))
+            with open(self.kustomization_file(overlay), "w") as f:
+                f.write("images:\n- name: foo\n  newTag: old # current\n")
+        promote.kustomization_cache.clear()
+
+    def tearDown(self):
+        promote.kustomization_cache.clear()
+        self.tmp.cleanup()
+
+    def kustomization_file(self, overlay):
+        return os.path.join(self.tmp.name, overlay, "kustomization.yaml")
+
+    def test_parallel_native_update(self):
+        overlays_to_images = promote.get_images_from_overlays(
+            [{"name": "foo", "newTag": "new", "overlays": self.overlays}], "."
+        )
+        promotion_manifest = promote.update_overlays(
+            lambda env, images: promote.update_kustomize_images(
+                env, self.tmp.name, images, {}, "native"
+            ),
+            overlays_to_images,
+            max_workers=3,
+        )
+        self.assertEqual(list(promotion_manifest), self.overlays)
+        for overlay in self.overlays:
+            self.assertEqual(
+                promotion_manifest[overlay],
+                {"images": [{"name": "foo", "newName": "foo", "newTag": "new"}]},
+            )
+            with open(self.kustomization_file(overlay)) as f:
+                self.assertEqual(
+                    f.read(),
+                    "images:\n- name: foo\n  newTag: new # current\n  newName: foo\n",
+                )
@@ -0,0 +1,269 @@
+import os
+import subprocess
+import tempfile
+import unittest
+import promote as promote
+
+
+class TestKustomizationIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.deployment_dir = self.tmp.name
+        self.write(
+            "env/dev",
+            "images:\n- name: foo\n  newName: registry/foo\n  newTag: v1\n"
+            "helmCharts:\n- name: lighthouse\n  version: 1.0.0\n",
+        )
+        self.write(
+            "env/prod", "images: [{name: foo, newTag: v0, digest: sha256:abc}]\n"
+        )
+        self.write("base", "resources:\n- deployment.yaml\n")
+        os.makedirs(os.path.join(self.deployment_dir, ".git", "env"))
+        with open(
+            os.path.join(self.deployment_dir, ".git", "env", "kustomization.yaml"), "w"
+        ) as f:
+            f.write("images:\n- name: foo\n")
+        promote.metrics.reset()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, overlay, text):
+        os.makedirs(os.path.join(self.deployment_dir, overlay), exist_ok=True)
+        with open(
+            os.path.join(self.deployment_dir, overlay, "kustomization.yaml"), "w"
+        ) as f:
+            f.write(text)
+
+    def test_find_kustomization_dirs(self):
+        self.assertEqual(
+            promote.find_kustomization_dirs(self.deployment_dir, max_workers=2),
+            ["base", "env/dev", "env/prod"],
+        )
+
+    def test_git_blob_hash(self):
+        path = os.path.join(self.deployment_dir, "env", "dev", "kustomization.yaml")
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            expected = subprocess.run(
+                ["git", "hash-object", path], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("git is not available")
+        self.assertEqual(promote.git_blob_hash(data), expected)
+
+    def test_find(self):
+        index = promote.KustomizationIndex(self.deployment_dir)
+        self.assertTrue(index.refresh())
+        self.assertEqual(
+            index.find_images("foo"),
+            [
+                {
+                    "overlay": "env/dev",
+                    "name": "foo",
+                    "newName": "registry/foo",
+                    "newTag": "v1",
+                },
+                {
+                    "overlay": "env/prod",
+                    "name": "foo",
+                    "newTag": "v0",
+                    "digest": "sha256:abc",
+                },
+            ],
+        )
+        self.assertEqual(
+            [image["overlay"] for image in index.find_images("registry/foo")],
+            ["env/dev"],
+        )
+        self.assertEqual(
+            index.find_charts("lighthouse"),
+            [{"overlay": "env/dev", "name": "lighthouse", "version": "1.0.0"}],
+        )
+        self.assertEqual(index.find_images("bar"), [])
+
+    def test_refresh_is_incremental(self):
+        index_file = os.path.join(self.deployment_dir, "index.json")
+        index = promote.KustomizationIndex(self.deployment_dir)
+        index.refresh()
+        index.save(index_file)
+        self.assertEqual(promote.metrics.counters["index_files_parsed"], 3)
+
+        # Unchanged files are neither read nor parsed
+        promote.metrics.reset()
+        index = promote.KustomizationIndex.load(index_file, self.deployment_dir)
+        self.assertFalse(index.refresh())
+        self.assertEqual(promote.metrics.counters, {})
+
+        # A touched but unchanged file is hashed but not parsed
+        path = os.path.join(self.deployment_dir, "base", "kustomization.yaml")
+        stat_result = os.stat(path)
+        os.utime(path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10**9))
+        self.assertTrue(index.refresh())
+        self.assertEqual(promote.metrics.counters, {"index_files_hashed": 1})
+
+        # A changed file is parsed again
+        self.write("env/dev", "images:\n- name: foo\n  newTag: v2\n")
+        index.refresh()
+        self.assertEqual(promote.metrics.counters["index_files_parsed"], 1)
+        self.assertEqual(index.find_images("foo")[0]["newTag"], "v2")
+        self.assertEqual(index.find_charts("lighthouse"), [])
+
+    def test_load_other_deployment_dir(self):
+        index_file = os.path.join(self.deployment_dir, "index.json")
+        index = promote.KustomizationIndex(self.deployment_dir)
+        index.refresh()
+        index.save(index_file)
+        self.assertEqual(
+            promote.KustomizationIndex.load(index_file, "/elsewhere").overlays, {}
+        )
+
+
+class TestOverlayPatternRegex(unittest.TestCase):
+    def matches(self, pattern, overlays):
+        regex = promote.overlay_pattern_regex(pattern)
+        return [overlay for overlay in overlays if regex.match(overlay)]
+
+    def test_star_matches_one_directory(self):
+        self.assertEqual(
+            self.matches(
+                "env/prod-*", ["env/prod-us", "env/prod-us/canary", "env/dev"]
+            ),
+            ["env/prod-us"],
+        )
+
+    def test_double_star_matches_any_directories(self):
+        self.assertEqual(
+            self.matches(
+                "clusters/**/us-east-*",
+                [
+                    "clusters/us-east-1",
+                    "clusters/prod/eks/us-east-2",
+                    "clusters/prod/us-west-1",
+                ],
+            ),
+            ["clusters/us-east-1", "clusters/prod/eks/us-east-2"],
+        )
+
+    def test_character_classes(self):
+        self.assertEqual(
+            self.matches(
+                "env/prod-[!a]?", ["env/prod-b1", "env/prod-a1", "env/prod-b"]
+            ),
+            ["env/prod-b1"],
+        )
+        self.assertEqual(self.matches("env/[dev", ["env/[dev", "env/d"]), ["env/[dev"])
+
+
+class TestResolveOverlayPatterns(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.deployment_dir = self.tmp.name
+        for overlay in ["env/dev", "env/prod", "preview/pr-1"]:
+            os.makedirs(os.path.join(self.deployment_dir, overlay))
+            with open(
+                os.path.join(self.deployment_dir, overlay, "kustomization.yaml"), "w"
+            ) as f:
+                f.write(
+                    "images:\n- name: foo\n  newTag: v1\n"
+                    "helmCharts:\n- name: lighthouse\n  version: 1.0.0\n"
+                )
+        os.makedirs(os.path.join(self.deployment_dir, "env", "other"))
+        with open(
+            os.path.join(self.deployment_dir, "env", "other", "kustomization.yaml"), "w"
+        ) as f:
+            f.write("images:\n- name: bar\n  newTag: v1\n")
+        promote.kustomization_cache.clear()
+
+    def tearDown(self):
+        promote._kustomization_indexes.clear()
+        promote.kustomization_cache.clear()
+        self.tmp.cleanup()
+
+    def test_star(self):
+        images, charts = promote.resolve_overlay_patterns(
+            [{"name": "foo", "newTag": "v2", "overlays": "*"}],
+            [{"name": "lighthouse", "version": "2.0.0", "overlays": ["env/dev"]}],
+            self.deployment_dir,
+        )
+        self.assertEqual(images[0]["overlays"], ["env/dev", "env/prod", "preview/pr-1"])
+        self.assertEqual(charts[0]["overlays"], ["env/dev"])
+
+    def test_glob_and_from_overlay(self):
+        images, charts = promote.resolve_overlay_patterns(
+            [],
+            [{"name": "lighthouse", "fromOverlay": "env/dev", "overlays": "env/*"}],
+            self.deployment_dir,
+        )
+        self.assertEqual(charts[0]["overlays"], ["env/prod"])
+
+    def test_no_match(self):
+        with self.assertRaises(promote.OverlayNotFoundError):
+            promote.resolve_overlay_patterns(
+                [{"name": "baz", "newTag": "v2", "overlays": "*"}],
+                [],
+                self.deployment_dir,
+            )
+
+    def test_list_globs(self):
+        images, _ = promote.resolve_overlay_patterns(
+            [{"name": "foo", "newTag": "v2", "overlays": ["preview/pr-1", "env/*"]}],
+            [],
+            self.deployment_dir,
+        )
+        # List items match every overlay, including those not declaring the image
+        self.assertEqual(
+            images[0]["overlays"], ["preview/pr-1", "env/dev", "env/other", "env/prod"]
+        )
+
+    def test_from_overlay_pattern(self):
+        images, _ = promote.resolve_overlay_patterns(
+            [{"name": "foo", "fromOverlay": "env/d*", "overlays": ["**/p*"]}],
+            [],
+            self.deployment_dir,
+        )
+        self.assertEqual(
+            images[0],
+            {
+                "name": "foo",
+                "fromOverlay": "env/dev",
+                "overlays": ["env/prod", "preview/pr-1"],
+            },
+        )
+
+        with self.assertRaises(promote.ValidationError):
+            promote.resolve_overlay_patterns(
+                [{"name": "foo", "fromOverlay": "env/*", "overlays": ["preview/pr-1"]}],
+                [],
+                self.deployment_dir,
+            )
+
+    def test_root_overlay_is_not_matched(self):
+        with open(os.path.join(self.deployment_dir, "kustomization.yaml"), "w") as f:
+            f.write("images:\n- name: foo\n  newTag: v1\n")
+        images, _ = promote.resolve_overlay_patterns(
+            [
+                {"name": "foo", "newTag": "v2", "overlays": "*"},
+                {"name": "bar", "newTag": "v2", "overlays": ["**", "."]},
+            ],
+            [],
+            self.deployment_dir,
+        )
+        self.assertEqual(images[0]["overlays"], ["env/dev", "env/prod", "preview/pr-1"])
+        self.assertEqual(
+            images[1]["overlays"],
+            ["env/dev", "env/other", "env/prod", "preview/pr-1", "."],
+        )
+
+    def test_plan_promotion(self):
+        plan = promote.plan_promotion(
+            [{"name": "foo", "newTag": "v2", "overlays": "env/*"}],
+            [],
+            self.deployment_dir,
+        )
+        self.assertEqual(list(plan["overlays"]), ["env/dev", "env/prod"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+import promote as promote
+
+
+class TestMetrics(unittest.TestCase):
+    def test_phase(self):
+        metrics = promote.Metrics()
+        with metrics.phase("plan"):
+            pass
+        with metrics.phase("apply_overlay", overlay="env/dev"):
+            pass
+        with metrics.phase("apply_overlay", overlay="env/prod"):
+            pass
+
+        recorded = metrics.to_dict()
+        self.assertEqual(recorded["phases"]["plan"]["count"], 1)
+        self.assertEqual(recorded["phases"]["apply_overlay"]["count"], 2)
+        self.assertEqual(
+            [span["overlay"] for span in recorded["spans"]], ["env/dev", "env/prod"]
+        )
+
+    def test_phase_records_failures(self):
+        metrics = promote.Metrics()
+        with self.assertRaises(ValueError):
+            with metrics.phase("plan"):
+                raise ValueError()
+        self.assertEqual(metrics.to_dict()["phases"]["plan"]["count"], 1)
+
+    def test_count(self):
+        metrics = promote.Metrics()
+        metrics.count("files_read")
+        metrics.count("bytes_read", 10)
+        metrics.count("bytes_read", 5)
+        self.assertEqual(
+            metrics.to_dict()["counters"], {"files_read": 1, "bytes_read": 15}
+        )
+
+        metrics.reset()
+        self.assertEqual(metrics.to_dict()["counters"], {})
+
+    def test_write_metrics(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics_file = os.path.join(tmp, "metrics.json")
+            with mock.patch.dict(os.environ, {"PROMOTE_METRICS_FILE": metrics_file}):
+                promote.write_metrics()
+            with open(metrics_file) as f:
+                recorded = json.load(f)
+        self.assertEqual(
+            sorted(recorded), ["counters", "phases", "seconds", "spans", "yaml"]
+        )
+
+    def test_write_changed_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            changed_files = os.path.join(tmp, "changed-files.txt")
+            with mock.patch.dict(os.environ, {"PROMOTE_CHANGED_FILES": changed_files}):
+                promote.write_changed_files(
+                    {"env/dev": {"images": []}, "env/prod": {"charts": []}}
+                )
+            with open(changed_files) as f:
+                self.assertEqual(
+                    f.read(),
+                    "env/dev/kustomization.yaml\nenv/prod/kustomization.yaml\n",
+                )
+
+    def test_trace_events(self):
+        metrics = promote.Metrics()
+        with metrics.phase("apply"):
+            with metrics.phase("apply_overlay", overlay="env/dev"):
+                pass
+
+        events = metrics.trace_events()
+        self.assertEqual(events[0]["ph"], "M")
+        overlay, apply = events[1:]
+        self.assertEqual(overlay["name"], "apply_overlay")
+        self.assertEqual(overlay["args"], {"overlay": "env/dev"})
+        self.assertEqual(apply["name"], "apply")
+        self.assertNotIn("args", apply)
+        self.assertLessEqual(apply["ts"], overlay["ts"] + 1)
+        self.assertGreaterEqual(
+            apply["ts"] + apply["dur"] + 1, overlay["ts"] + overlay["dur"]
+        )
+
+    def test_write_trace_appends(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            trace_file = os.path.join(tmp, "trace.json")
+            with open(trace_file, "w") as f:
+                f.write('{"name": "entrypoint.sh", "ph": "X"}\n')
+            with mock.patch.dict(os.environ, {"PROMOTE_TRACE_FILE": trace_file}):
+                promote.write_trace()
+            with open(trace_file) as f:
+                events = [json.loads(line) for line in f]
+        self.assertEqual(events[0]["name"], "entrypoint.sh")
+        self.assertEqual(events[1]["name"], "process_name")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+import promote as promote
+
+
+class TestPromoter(unittest.TestCase):
+    def setUp(self):
+        self.level = promote.logger.level
+        promote.logger.setLevel(logging.CRITICAL)
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, "env", "dev"))
+        with open(self.kustomization_file(), "w") as f:
+            f.write(
+                "images:\n- name: foo\n  newName: foo\n  newTag: old\n"
+                "helmCharts:\n- name: bar\n  version: 1.0.0\n"
+            )
+        promote.kustomization_cache.clear()
+        self.promoter = promote.Promoter(self.tmp.name, "native")
+
+    def tearDown(self):
+        promote.kustomization_cache.clear()
+        promote.logger.setLevel(self.level)
+        self.tmp.cleanup()
+
+    def kustomization_file(self):
+        return os.path.join(self.tmp.name, "env", "dev", "kustomization.yaml")
+
+    def read(self):
+        with open(self.kustomization_file()) as f:
+            return f.read()
+
+    def test_promote(self):
+        result = self.promoter.promote(
+            [{"name": "foo", "newTag": "new", "overlays": ["env/dev"]}], []
+        )
+        self.assertEqual(
+            result.manifest,
+            {
+                "env/dev": {
+                    "images": [{"name": "foo", "newName": "foo", "newTag": "new"}]
+                }
+            },
+        )
+        self.assertEqual(result.changed, ["env/dev"])
+        self.assertIn("newTag: new", self.read())
+
+        # Promoting the same values again changes nothing
+        result = self.promoter.promote(
+            [{"name": "foo", "newTag": "new", "overlays": ["env/dev"]}], []
+        )
+        self.assertEqual(result.changed, [])
+
+    def test_dry_run(self):
+        plan = self.promoter.plan(
+            [], [{"name": "bar", "version": "2.0.0", "overlays": ["env/dev"]}]
+        )
+        result = self.promoter.apply(plan, dry_run=True)
+        self.assertEqual(
+            result.manifest,
+            {"env/dev": {"charts": [{"name": "bar", "version": "2.0.0"}]}},
+        )
+        self.assertEqual(result.changed, [])
+        self.assertIn("version: 1.0.0", self.read())
+
+    def test_errors(self):
+        with self.assertRaises(promote.ValidationError):
+            self.promoter.plan([], [])
+        with self.assertRaises(promote.ValidationError):
+            self.promoter.plan([{"name": "foo", "overlays": ["env/dev"]}], [])
+        with self.assertRaises(promote.OverlayNotFoundError):
+            self.promoter.plan(
+                [{"name": "foo", "newTag": "new", "overlays": ["env/prod"]}], []
+            )
+        with self.assertRaises(promote.KustomizationError) as raised:
+            self.promoter.plan(
+                [], [{"name": "baz", "version": "2.0.0", "overlays": ["env/dev"]}]
+            )
+        self.assertEqual(
+            raised.exception.to_dict(),
+            {
+                "type": "ChartNotFoundError",
+                "message": f"Chart baz not found in {self.kustomization_file()}.",
+            },
+        )
+        with self.assertRaises(promote.ValidationError):
+            promote.Promoter(self.tmp.name, "helm")
+
+    def test_main_exits_on_error(self):
+        environment = {
+            "DEPLOYMENT_DIR": self.tmp.name,
+            "PROMOTE_IMAGE_BACKEND": "native",
+            "IMAGES_TO_UPDATE": '[{"name": "foo", "newTag": "new", "overlays": ["env/prod"]}]',
+        }
+        with mock.patch.dict(os.environ, environment):
+            with self.assertRaises(SystemExit) as exited:
+                promote.main()
+        self.assertEqual(exited.exception.code, 1)
+
+    def test_main_exits_on_plan_file_error(self):
+        environment = {
+            "DEPLOYMENT_DIR": self.tmp.name,
+            "PROMOTE_IMAGE_BACKEND": "native",
+            "PROMOTE_PLAN_FILE": os.path.join(self.tmp.name, "missing", "plan.json"),
+            "IMAGES_TO_UPDATE": '[{"name": "foo", "newTag": "new", "overlays": ["env/dev"]}]',
+        }
+        with mock.patch.dict(os.environ, environment):
+            with self.assertRaises(SystemExit) as exited:
+                promote.main()
+        self.assertEqual(exited.exception.code, 1)
+        self.assertIn("newTag: old", self.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+from unittest import mock
+import yaml
+import promote as promote
+
+kustomization = """apiVersion: kustomize.config.k8s.io/v1beta1
+kind: Kustomization
+# Shared resources
+resources:
+- ../../base # the base
+images:
+- name: foo
+  newName: quz
+  newTag: "1.0" # pinned
+helmCharts:
+- name: lighthouse
+  version: 1.0.0
+  valuesInline:
+    beam: |
+      bright
+"""
+
+
+class TestRoundTripDocument(unittest.TestCase):
+    def test_unchanged(self):
+        document = promote.RoundTripDocument(kustomization)
+        self.assertFalse(document.changed())
+        self.assertEqual(document.dump(), kustomization)
+
+    def test_update_scalar(self):
+        document = promote.RoundTripDocument(kustomization)
+        document.data["images"][0]["newTag"] = "2.0"
+        document.data["helmCharts"][0]["version"] = "1.1.0"
+        self.assertEqual(
+            document.dump(),
+            kustomization.replace('"1.0"', '"2.0"').replace("1.0.0", "1.1.0"),
+        )
+
+    def test_add_key_and_item(self):
+        document = promote.RoundTripDocument(kustomization)
+        document.data["helmCharts"][0]["releaseName"] = "tillamook"
+        promote.set_kustomization_images(document.data, ["app=app:1.2.3"])
+        dumped = document.dump()
+        self.assertEqual(yaml.safe_load(dumped), document.data)
+        self.assertIn("# pinned", dumped)
+        self.assertIn(
+            "- name: app\n  newName: app\n  newTag: 1.2.3\n- name: foo", dumped
+        )
+        self.assertTrue(dumped.endswith("      bright\n  releaseName: tillamook\n"))
+
+    def test_fallback(self):
+        document = promote.RoundTripDocument("images: []\n")
+        document.data["images"].append({"name": "foo", "newTag": "1.0.0"})
+        self.assertEqual(document.dump(), "images:\n- name: foo\n  newTag: 1.0.0\n")
+
+
+@unittest.skipUnless(yaml.__with_libyaml__, "libyaml is not available")
+class TestYamlImplementations(unittest.TestCase):
+    # Non-ASCII text, since the spliced spans are character offsets
+    text = kustomization.replace("the base", "la b\u00e4se")
+
+    def edited(self):
+        document = promote.RoundTripDocument(self.text)
+        document.data["images"][0]["newTag"] = "2.0"
+        document.data["helmCharts"][0]["releaseName"] = "tillamook"
+        spans = promote.scan_kustomization_spans(self.text)
+        return (
+            promote.load_yaml(self.text),
+            document.dump(),
+            promote.SpanEditor(self.text, spans).entries("helmCharts"),
+            promote.dump_yaml_scalar("a" * 200),
+        )
+
+    def test_libyaml(self):
+        self.assertEqual(promote.yaml_implementation(), "libyaml")
+
+    def test_pure_python_fallback(self):
+        libyaml = self.edited()
+        with mock.patch.multiple(
+            promote, YamlLoader=yaml.SafeLoader, YamlDumper=yaml.SafeDumper
+        ):
+            self.assertEqual(promote.yaml_implementation(), "python")
+            self.assertEqual(self.edited(), libyaml)
+
+
+class TestSpanEditor(unittest.TestCase):
+    def test_spans(self):
+        spans = promote.scan_kustomization_spans(kustomization)
+        self.assertEqual(
+            promote.SpanEditor(kustomization, spans).entries("images"),
+            [{"name": "foo", "newName": "quz", "newTag": "1.0"}],
+        )
+        self.assertEqual(
+            [list(entry) for entry in spans["helmCharts"]], [["name", "version"]]
+        )
+
+    def test_splice_chart_version(self):
+        editor = promote.SpanEditor(
+            kustomization, promote.scan_kustomization_spans(kustomization)
+        )
+        self.assertTrue(editor.set("helmCharts", 0, "version", "1.1.0"))
+        self.assertFalse(editor.set("helmCharts", 0, "releaseName", "tillamook"))
+        self.assertTrue(editor.changed())
+        self.assertEqual(editor.dump(), kustomization.replace("1.0.0", "1.1.0"))
+
+    def test_splice_images(self):
+        editor = promote.SpanEditor(
+            kustomization, promote.scan_kustomization_spans(kustomization)
+        )
+        self.assertTrue(promote.splice_kustomization_images(editor, ["foo=quz:2.0"]))
+        self.assertEqual(editor.dump(), kustomization.replace('"1.0"', '"2.0"'))
+
+    def test_splice_images_needs_new_entry(self):
+        editor = promote.SpanEditor(
+            kustomization, promote.scan_kustomization_spans(kustomization)
+        )
+        self.assertFalse(promote.splice_kustomization_images(editor, ["app=app:1"]))
+
+    def test_flow_style_section(self):
+        spans = promote.scan_kustomization_spans("images: [{name: foo}]\n")
+        self.assertEqual(spans, {"images": None})
@@ -0,0 +1,301 @@
+import http.client
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import promote as promote
+
+
+class TestPromotionServer(unittest.TestCase):
+    def setUp(self):
+        self.level = promote.logger.level
+        promote.logger.setLevel(logging.CRITICAL)
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, "env", "dev"))
+        with open(self.kustomization_file(), "w") as f:
+            f.write("images:\n- name: foo\n  newName: foo\n  newTag: old\n")
+        promote.kustomization_cache.clear()
+
+        self.promotions = promote.PromotionQueue(self.tmp.name, "native")
+        self.server = promote.PromotionHTTPServer(("127.0.0.1", 0), self.promotions)
+        self.promotions.start()
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}
+        )
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.promotions.stop()
+        promote.kustomization_cache.clear()
+        promote.logger.setLevel(self.level)
+        self.tmp.cleanup()
+
+    def kustomization_file(self):
+        return os.path.join(self.tmp.name, "env", "dev", "kustomization.yaml")
+
+    def request(self, method, path, body=None):
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def test_warm_kustomization_cache(self):
+        self.assertEqual(promote.warm_kustomization_cache(self.tmp.name), 1)
+        reads = promote.kustomization_cache.reads
+        promote.kustomization_cache.load(self.kustomization_file())
+        self.assertEqual(promote.kustomization_cache.reads, reads)
+
+    def test_promote_and_wait(self):
+        images = [{"name": "foo", "newTag": "new", "overlays": ["env/dev"]}]
+        status, job = self.request(
+            "POST", "/promotions?wait=true", json.dumps({"images": images})
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(job["status"], "succeeded")
+        self.assertEqual(
+            job["manifest"],
+            {
+                "env/dev": {
+                    "images": [{"name": "foo", "newName": "foo", "newTag": "new"}]
+                }
+            },
+        )
+        with open(self.kustomization_file()) as f:
+            self.assertEqual(
+                f.read(), "images:\n- name: foo\n  newName: foo\n  newTag: new\n"
+            )
+
+        status, polled = self.request("GET", f"/promotions/{job['id']}")
+        self.assertEqual(status, 200)
+        self.assertEqual(polled, job)
+
+    def test_promote_queued(self):
+        images = [{"name": "foo", "newTag": "new", "overlays": ["env/dev"]}]
+        status, job = self.request(
+            "POST", "/promotions", json.dumps({"images": images})
+        )
+        self.assertEqual(status, 202)
+        self.promotions.get(job["id"]).done.wait()
+        status, job = self.request("GET", f"/promotions/{job['id']}")
+        self.assertEqual(job["status"], "succeeded")
+
+    def test_failed_promotion(self):
+        images = [{"name": "foo", "newTag": "new", "overlays": ["env/prod"]}]
+        status, job = self.request(
+            "POST", "/promotions?wait=true", json.dumps({"images": images})
+        )
+        self.assertEqual(status, 422)
+        self.assertEqual(job["status"], "failed")
+        self.assertTrue(job["errors"])
+
+        # The queue keeps applying promotions after a failure
+        images[0]["overlays"] = ["env/dev"]
+        status, job = self.request(
+            "POST", "/promotions?wait=true", json.dumps({"images": images})
+        )
+        self.assertEqual(job["status"], "succeeded")
+
+    def test_invalid_request(self):
+        status, _ = self.request("POST", "/promotions", "not json")
+        self.assertEqual(status, 400)
+        status, _ = self.request("POST", "/promotions", json.dumps({"images": {}}))
+        self.assertEqual(status, 400)
+        status, _ = self.request("GET", "/promotions/42")
+        self.assertEqual(status, 404)
+
+    def test_healthz(self):
+        status, health = self.request("GET", "/healthz")
+        self.assertEqual((status, health), (200, {"status": "ok", "pending": 0}))
+
+
+class TestCoalescePromotions(unittest.TestCase):
+    def test_last_writer_wins(self):
+        images, charts, owners = promote.coalesce_promotions(
+            [
+                (1, [{"name": "foo", "newTag": "v1", "overlays": ["dev", "prod"]}], []),
+                (2, [{"name": "foo", "newTag": "v2", "overlays": ["dev"]}], []),
+                (3, [], [{"name": "bar", "version": "1.0.0", "overlays": ["dev"]}]),
+            ]
+        )
+        self.assertEqual(
+            images,
+            [
+                {"name": "foo", "newTag": "v2", "overlays": ["dev"]},
+                {"name": "foo", "newTag": "v1", "overlays": ["prod"]},
+            ],
+        )
+        self.assertEqual(
+            charts, [{"name": "bar", "version": "1.0.0", "overlays": ["dev"]}]
+        )
+        self.assertEqual(
+            owners,
+            {
+                ("dev", "images", "foo"): 2,
+                ("prod", "images", "foo"): 1,
+                ("dev", "charts", "bar"): 3,
+            },
+        )
+
+    def test_attribute_manifest(self):
+        manifests = promote.attribute_manifest(
+            {
+                "dev": {
+                    "images": [{"name": "foo", "newTag": "v2"}],
+                    "charts": [{"name": "bar", "version": "1.0.0"}],
+                },
+                "prod": {"images": [{"name": "foo", "newTag": "v1"}]},
+            },
+            {
+                ("dev", "images", "foo"): 2,
+                ("prod", "images", "foo"): 1,
+                ("dev", "charts", "bar"): 3,
+            },
+        )
+        self.assertEqual(
+            manifests,
+            {
+                1: {"prod": {"images": [{"name": "foo", "newTag": "v1"}]}},
+                2: {"dev": {"images": [{"name": "foo", "newTag": "v2"}]}},
+                3: {"dev": {"charts": [{"name": "bar", "version": "1.0.0"}]}},
+            },
+        )
+
+
+class TestPromotionBatches(unittest.TestCase):
+    def setUp(self):
+        self.level = promote.logger.level
+        promote.logger.setLevel(logging.CRITICAL)
+        self.tmp = tempfile.TemporaryDirectory()
+        for overlay in ["env/dev", "env/prod"]:
+            os.makedirs(os.path.join(self.tmp.name, overlay))
+            with open(
+                os.path.join(self.tmp.name, overlay, "kustomization.yaml"), "w"
+            ) as f:
+                f.write("images:\n- name: foo\n  newName: foo\n  newTag: old\n")
+        environment = mock.patch.dict(
+            os.environ,
+            {
+                "GIT_AUTHOR_NAME": "test",
+                "GIT_AUTHOR_EMAIL": "test@example.com",
+                "GIT_COMMITTER_NAME": "test",
+                "GIT_COMMITTER_EMAIL": "test@example.com",
+            },
+        )
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "Initial commit")
+        promote.kustomization_cache.clear()
+
+    def tearDown(self):
+        promote.kustomization_cache.clear()
+        promote.logger.setLevel(self.level)
+        self.tmp.cleanup()
+
+    def git(self, *args):
+        return subprocess.run(
+            ["git", *args],
+            cwd=self.tmp.name,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    def test_batch_commit(self):
+        promotions = promote.PromotionQueue(
+            self.tmp.name, "native", batch_size=0, commit=True
+        )
+        # Queue the jobs before starting, so they are applied as one batch
+        jobs = [
+            promotions.submit(
+                [{"name": "foo", "newTag": "v1", "overlays": ["env/dev", "env/prod"]}],
+                [],
+            ),
+            promotions.submit(
+                [{"name": "foo", "newTag": "v2", "overlays": ["env/dev"]}], []
+            ),
+            promotions.submit(
+                [{"name": "foo", "newTag": "v3", "overlays": ["env/qa"]}], []
+            ),
+        ]
+        promotions.start()
+        promotions.stop()
+
+        first, second, invalid = jobs
+        self.assertEqual(invalid.status, "failed")
+        self.assertEqual(first.status, "succeeded")
+        self.assertEqual(
+            first.manifest,
+            {
+                "env/prod": {
+                    "images": [{"name": "foo", "newName": "foo", "newTag": "v1"}]
+                }
+            },
+        )
+        self.assertEqual(
+            first.superseded,
+            [
+                {
+                    "overlay": "env/dev",
+                    "section": "images",
+                    "name": "foo",
+                    "by": second.id,
+                }
+            ],
+        )
+        self.assertEqual(second.status, "succeeded")
+        self.assertIs(first.batch, second.batch)
+        self.assertEqual(first.batch["requests"], [first.id, second.id])
+        self.assertTrue(first.batch["committed"])
+        self.assertEqual(
+            first.batch["manifest"],
+            {
+                "env/dev": {
+                    "images": [
+                        {"name": "foo", "newName": "foo", "newTag": "v2", "request": 2}
+                    ]
+                },
+                "env/prod": {
+                    "images": [
+                        {"name": "foo", "newName": "foo", "newTag": "v1", "request": 1}
+                    ]
+                },
+            },
+        )
+
+        self.assertEqual(self.git("rev-list", "--count", "HEAD").strip(), "2")
+        self.assertEqual(self.git("status", "--porcelain"), "")
+
+    def test_batch_commit_leaves_other_staged_files(self):
+        with open(os.path.join(self.tmp.name, "README.md"), "w") as f:
+            f.write("staged\n")
+        self.git("add", "README.md")
+
+        promotions = promote.PromotionQueue(self.tmp.name, "native", commit=True)
+        job = promotions.submit(
+            [{"name": "foo", "newTag": "v1", "overlays": ["env/dev"]}], []
+        )
+        promotions.start()
+        promotions.stop()
+
+        self.assertEqual(job.status, "succeeded")
+        self.assertEqual(
+            self.git("show", "--name-only", "--format=", "HEAD").strip(),
+            "env/dev/kustomization.yaml",
+        )
+        self.assertEqual(self.git("status", "--porcelain"), "A  README.md\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
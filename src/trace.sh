@@ -0,0 +1,92 @@
+#!/bin/bash
+
+# Helpers for recording Chrome trace events from the action's shell scripts.
+# Source this file, then wrap the stages and commands to trace with
+# `trace_run`; the script itself is recorded as an event when it exits.
+# Events are appended one JSON object per line to the file named by
+# PROMOTE_TRACE_FILE (promote.py appends its own events to the same file) and
+# are wrapped into a Chrome trace, which can be opened in Perfetto
+# (https://ui.perfetto.dev), when the first script to source this file exits.
+# Nothing is recorded if PROMOTE_TRACE_FILE is unset or empty.
+
+# Print the current time in microseconds since the epoch
+function trace_now {
+  local -r now="${EPOCHREALTIME}"
+  echo "${now%[.,]*}${now#*[.,]}"
+}
+
+# Append a complete event to the trace file.
+#   $1: The name of the event
+#   $2: The start time in microseconds since the epoch
+#   $3: The end time in microseconds since the epoch
+#   $4: The exit status of the traced command
+function trace_event {
+  printf '{"name": "%s", "cat": "%s", "ph": "X", "ts": %d, "dur": %d, "pid": %d, "tid": %d, "args": {"status": %d}}\n' \
+    "$1" "$(basename "$0")" "$2" "$(($3 - $2))" "$$" "${BASHPID}" "$4" >> "${PROMOTE_TRACE_FILE}"
+}
+
+# Run the command given by the remaining arguments, recording it as an event
+# named by the first argument. The exit status of the command is returned.
+function trace_run {
+  local -r name="$1"
+  shift
+
+  if [[ -z "${PROMOTE_TRACE_FILE:-}" ]]; then
+    "$@"
+    return
+  fi
+
+  local -r start="$(trace_now)"
+  local -i status=0
+  "$@" || status=$?
+  trace_event "${name}" "${start}" "$(trace_now)" "${status}"
+  return "${status}"
+}
+
+# Record the commands run between `trace_begin` and `trace_end` with the same
+# name as one event. Unlike `trace_run`, this leaves `set -e` in effect for them.
+declare -A TRACE_STARTS=()
+
+function trace_begin {
+  TRACE_STARTS["$1"]="$(trace_now)"
+}
+
+function trace_end {
+  if [[ -n "${PROMOTE_TRACE_FILE:-}" ]]; then
+    trace_event "$1" "${TRACE_STARTS["$1"]}" "$(trace_now)" 0
+  fi
+}
+
+# Wrap the events recorded so far into a Chrome trace, replacing the file
+# they were recorded in.
+function trace_finish {
+  if [[ -z "${PROMOTE_TRACE_FILE:-}" || ! -f "${PROMOTE_TRACE_FILE}" ]]; then
+    return
+  fi
+
+  jq -s '{traceEvents: ., displayTimeUnit: "ms"}' "${PROMOTE_TRACE_FILE}" > "${PROMOTE_TRACE_FILE}.tmp"
+  mv "${PROMOTE_TRACE_FILE}.tmp" "${PROMOTE_TRACE_FILE}"
+}
+
+# Record the whole script as an event when it exits. The script that started
+# the trace also wraps it up, after every other traced process has finished.
+function trace_exit {
+  local -ir status=$?
+  trace_event "$(basename "$0")" "${TRACE_SCRIPT_START}" "$(trace_now)" "${status}"
+  if [[ "${PROMOTE_TRACE_PID}" == "$$" ]]; then
+    trace_finish
+  fi
+}
+
+if [[ -n "${PROMOTE_TRACE_FILE:-}" ]]; then
+  if [[ -z "${PROMOTE_TRACE_PID:-}" ]]; then
+    PROMOTE_TRACE_PID="$$"
+    export PROMOTE_TRACE_PID
+    rm -f "${PROMOTE_TRACE_FILE}"
+  fi
+
+  printf '{"name": "process_name", "ph": "M", "pid": %d, "args": {"name": "%s"}}\n' \
+    "$$" "$(basename "$0")" >> "${PROMOTE_TRACE_FILE}"
+  TRACE_SCRIPT_START="$(trace_now)"
+  trap trace_exit EXIT
+fi